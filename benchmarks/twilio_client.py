@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+""" Micro-benchmark: per-send latency of a fresh twilio Client per message
+(the old behaviour) vs. one long-lived pooled client.
+
+Runs against a local stub of the Messages API over plain HTTP, so the
+numbers only show connection setup and client construction overhead; with
+the real API every fresh client also pays for a TLS handshake.
+
+    python3 benchmarks/twilio_client.py [-n 500]
+"""
+import argparse
+import http.server
+import json
+import logging
+import os
+import socketserver
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from twilio.http.http_client import TwilioHttpClient
+from twilio.rest import Client
+
+from sms900.twilio_client import PooledTwilioHttpClient, create_twilio_client
+
+CONFIG = {
+    'twilio_account_sid': 'AC00000000000000000000000000000000',
+    'twilio_auth_token': 'secret',
+    'twilio_number': '+461234567',
+}
+
+MESSAGE = json.dumps({
+    'sid': 'SM00000000000000000000000000000000',
+    'account_sid': CONFIG['twilio_account_sid'],
+    'to': '+46700000000',
+    'from': CONFIG['twilio_number'],
+    'body': 'hello',
+    'num_segments': '1',
+    'status': 'queued',
+}).encode('utf-8')
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately; don't let Nagle and delayed
+    # ACKs add 40 ms to every keep-alive response.
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.send_response(201)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(MESSAGE)))
+        self.end_headers()
+        self.wfile.write(MESSAGE)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+def redirecting(base, stub_url):
+    """ Subclass an http client so that api.twilio.com goes to the stub """
+    class Redirecting(base):
+        def request(self, method, url, *args, **kwargs):
+            url = url.replace('https://api.twilio.com', stub_url)
+            return super().request(method, url, *args, **kwargs)
+
+    return Redirecting
+
+
+def send(client):
+    client.messages.create(to='+46700000000',
+                           from_=CONFIG['twilio_number'],
+                           body='hello')
+
+
+def measure(n, get_client):
+    samples = []
+    for _ in range(n):
+        start = time.perf_counter()
+        send(get_client())
+        samples.append((time.perf_counter() - start) * 1000)
+
+    return samples
+
+
+def report(name, samples):
+    samples = sorted(samples)
+    print("%-16s mean %7.3f ms  p50 %7.3f ms  p99 %7.3f ms" % (
+        name,
+        statistics.mean(samples),
+        samples[len(samples) // 2],
+        samples[int(len(samples) * 0.99) - 1]
+    ))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=500, help='Sends per variant')
+    args = parser.parse_args()
+
+    logging.getLogger('twilio').setLevel(logging.WARNING)
+
+    httpd = StubServer(('127.0.0.1', 0), StubHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    stub_url = 'http://127.0.0.1:%d' % httpd.server_address[1]
+
+    fresh_http_client = redirecting(TwilioHttpClient, stub_url)
+    pooled = create_twilio_client(
+        CONFIG,
+        http_client_class=redirecting(PooledTwilioHttpClient, stub_url)
+    )
+
+    # Warm up imports, the stub and the pool
+    measure(10, lambda: pooled)
+
+    report("fresh client", measure(
+        args.n,
+        lambda: Client(CONFIG['twilio_account_sid'],
+                       CONFIG['twilio_auth_token'],
+                       http_client=fresh_http_client())
+    ))
+    report("pooled client", measure(args.n, lambda: pooled))
+
+    httpd.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,12 @@
 #!/usr/bin/env python3
 """ bot.py - Main file to run the bot """
 import argparse
+import json
 import logging
+import sys
 
+from sms900.phonebook import SMS900InvalidAddressbookEntry
+from sms900.phonebook_io import SMS900InvalidImport
 from sms900.sms900 import SMS900
 
 logging.basicConfig(level=logging.INFO,
@@ -11,7 +15,42 @@ logging.basicConfig(level=logging.INFO,
 
 PARSER = argparse.ArgumentParser()
 PARSER.add_argument('-f', help='Use the given configuration file', default='config.json')
+SUBPARSERS = PARSER.add_subparsers(dest='command')
+
+IMPORT_PARSER = SUBPARSERS.add_parser(
+    'import-phonebook',
+    help='Import contacts from a vCard or CSV file (restart a running bot afterwards)'
+)
+IMPORT_PARSER.add_argument('file', help='The file to import, or - for stdin')
+IMPORT_PARSER.add_argument('--format', choices=['csv', 'vcf'],
+                           help='Default: guessed from the contents')
+
+EXPORT_PARSER = SUBPARSERS.add_parser('export-phonebook',
+                                      help='Export all contacts to stdout')
+EXPORT_PARSER.add_argument('--format', choices=['csv', 'vcf'], default='csv')
+
 ARGS = PARSER.parse_args()
 
 THEBOT = SMS900(ARGS.f)
-THEBOT.run()
+
+if ARGS.command == 'import-phonebook':
+    THEBOT.open_database()
+    if ARGS.file == '-':
+        DATA = sys.stdin.read()
+    else:
+        with open(ARGS.file, 'r', encoding='utf-8-sig') as file:
+            DATA = file.read()
+
+    try:
+        REPORT = THEBOT.import_phonebook(DATA, ARGS.format)
+    except (SMS900InvalidImport, SMS900InvalidAddressbookEntry) as err:
+        print("Import failed: %s" % err, file=sys.stderr)
+        sys.exit(1)
+
+    print(json.dumps(REPORT, indent=2))
+elif ARGS.command == 'export-phonebook':
+    THEBOT.open_database()
+    for chunk in THEBOT.export_phonebook(ARGS.format):
+        sys.stdout.write(chunk)
+else:
+    THEBOT.run()
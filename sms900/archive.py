@@ -0,0 +1,66 @@
+""" Full-text searchable archive of everything passing through the bot """
+from datetime import datetime
+import re
+
+
+class MessageArchive():
+    """ Stores SMS, MMS texts and IRC messages in an FTS5 table.
+
+    source is one of 'sms' (received), 'sms-out' (sent), 'mms' or 'irc'.
+    """
+
+    def __init__(self, db):
+        self.db = db
+
+    def add(self, source, nickname, msg, channel=None, recipient=None,
+            timestamp=None):
+        if not timestamp:
+            timestamp = datetime.now().astimezone()
+
+        self.db.execute(
+            "insert into archive(msg, nickname, recipient, channel, source, timestamp)"
+            " values (?, ?, ?, ?, ?, ?)",
+            (msg, nickname, recipient, channel, source, timestamp.timestamp())
+        )
+
+    def search(self, query, page=1, per_page=10):
+        """ Returns (total number of hits, [hit, ...]) for the given page,
+        best match first. """
+        match = self._get_match_expression(query)
+        if not match:
+            return (0, [])
+
+        offset = (max(page, 1) - 1) * per_page
+
+        total = self.db.execute(
+            "select count(*) from archive where archive match ?",
+            (match,)
+        ).fetchone()[0]
+
+        rows = self.db.execute(
+            "select timestamp, source, nickname, recipient, channel, msg,"
+            "  snippet(archive, 0, '[', ']', '...', 12)"
+            " from archive where archive match ?"
+            " order by rank limit ? offset ?",
+            (match, per_page, offset)
+        ).fetchall()
+
+        return (total, [{
+            'timestamp': datetime.fromtimestamp(row[0]).astimezone(),
+            'source': row[1],
+            'nickname': row[2],
+            'recipient': row[3],
+            'channel': row[4],
+            'msg': row[5],
+            'snippet': row[6],
+        } for row in rows])
+
+    def _get_match_expression(self, query):
+        # Treat the query as plain words (all of which must match) rather
+        # than FTS5 syntax; a trailing * still does prefix matching.
+        terms = []
+        for m in re.finditer(r'(\S+?)(\*?)(?=\s|$)', query):
+            term = m.group(1).replace('"', '""')
+            terms.append('"%s"%s' % (term, m.group(2)))
+
+        return " ".join(terms)
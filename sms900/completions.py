@@ -0,0 +1,109 @@
+""" Run AI completions concurrently with the main loop """
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import threading
+
+
+class CompletionExecutor():
+    """ Runs completion jobs on a bounded thread pool.
+
+    Triggers are coalesced per key (i.e. channel): all triggers that arrive
+    while a request for the key is waiting to start, or is running, result
+    in a single follow-up request. Apart from the jobs themselves everything
+    here runs on the main loop, which is driven by these events:
+
+    START_COMPLETION    -- {'key': ...}, call start()
+    COMPLETION_FINISHED -- {'key': ..., 'result': ..., 'failed': ...}, call finished()
+    """
+
+    def __init__(self, queue_event, max_in_flight=2, coalesce_delay=1.0):
+        self.queue_event = queue_event
+        self.max_in_flight = max_in_flight
+        self.coalesce_delay = coalesce_delay
+
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_in_flight,
+            thread_name_prefix='completion'
+        )
+
+        self.pending = {}
+        self.running = set()
+
+    def trigger(self, key, data):
+        """ Request a completion for key. Returns False if the request was
+        merged into one that is already waiting. """
+        if key in self.pending:
+            self.pending[key] = self._merge(self.pending[key], data)
+            logging.info("Coalesced completion request for %s", key)
+            return False
+
+        self.pending[key] = data
+
+        # If the key is running, finished() will start the next request
+        if key not in self.running:
+            self._queue_start(key, self.coalesce_delay)
+
+        return True
+
+    def start(self, key, prepare):
+        """ Start the pending request for key, if there is capacity.
+        prepare(data) is called here and returns the job to run. """
+        if key not in self.pending or key in self.running:
+            return
+
+        if len(self.running) >= self.max_in_flight:
+            logging.info("Completion for %s deferred, %d in flight",
+                         key, len(self.running))
+            return
+
+        job = prepare(self.pending.pop(key))
+        self.running.add(key)
+
+        future = self.executor.submit(job)
+        future.add_done_callback(
+            lambda f: self._on_done(key, f)
+        )
+
+    def finished(self, key):
+        self.running.discard(key)
+
+        for pending_key in list(self.pending.keys()):
+            if pending_key not in self.running:
+                self._queue_start(pending_key, 0)
+
+    def _on_done(self, key, future):
+        result = None
+        failed = False
+        try:
+            result = future.result()
+        except Exception:
+            logging.exception("Completion for %s failed", key)
+            failed = True
+
+        self.queue_event('COMPLETION_FINISHED', {
+            'key': key,
+            'result': result,
+            'failed': failed,
+        })
+
+    def _queue_start(self, key, delay):
+        if delay <= 0:
+            self.queue_event('START_COMPLETION', {'key': key})
+            return
+
+        timer = threading.Timer(delay, self.queue_event, [
+            'START_COMPLETION', {'key': key}
+        ])
+        timer.daemon = True
+        timer.start()
+
+    def _merge(self, old, new):
+        # A "comment on the last N lines" request wins over a plain one
+        merged = dict(old)
+        if 'include_all_length' in new:
+            merged['include_all_length'] = max(
+                new['include_all_length'],
+                old['include_all_length'] if 'include_all_length' in old else 0
+            )
+
+        return merged
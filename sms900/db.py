@@ -0,0 +1,246 @@
+""" SQLite access: tuning, a connection per thread and schema migrations """
+from contextlib import contextmanager
+import logging
+import sqlite3
+import threading
+import time
+
+SYNCHRONOUS = ['off', 'normal', 'full', 'extra']
+
+
+class SMS900DatabaseException(Exception):
+    pass
+
+
+def _add_timer_columns(conn):
+    # Databases from before reminders had owners and recurrences
+    columns = [row[1] for row in conn.execute("pragma table_info(timers)")]
+    for column in ['owner', 'recurrence']:
+        if column not in columns:
+            conn.execute("alter table timers add column %s text" % column)
+
+
+# (version, description, [SQL or function(connection), ...]). The first
+# ones adopt the tables of databases from before there were migrations,
+# hence the 'if not exists'. Don't change a migration that has been
+# released; add a new one.
+MIGRATIONS = [
+    (1, 'phone book', [
+        "create table if not exists phonebook ("
+        "  id integer primary key,"
+        "  nickname text UNIQUE,"
+        "  number text UNIQUE"
+        ")",
+        "create table if not exists phonebook_email ("
+        "  email text primary key collate nocase,"
+        "  nickname text"
+        ")",
+        "create table if not exists phonebook_group ("
+        "  group_name text collate nocase,"
+        "  nickname text,"
+        "  primary key (group_name, nickname)"
+        ")",
+    ]),
+    (2, 'timers', [
+        "create table if not exists timers ("
+        "  uuid text primary key,"
+        "  timestamp integer,"
+        "  msg text,"
+        "  owner text,"
+        "  recurrence text"
+        ")",
+        _add_timer_columns,
+        "create index if not exists timers_timestamp on timers(timestamp)",
+    ]),
+    (3, 'history', [
+        "create table if not exists history ("
+        "  id integer primary key,"
+        "  timestamp real,"
+        "  channel text,"
+        "  nickname text,"
+        "  msg text,"
+        "  type text,"
+        "  involves_me integer"
+        ")",
+        "create index if not exists history_channel_timestamp"
+        " on history(channel, timestamp)",
+        "create index if not exists history_channel_involves_me"
+        " on history(channel, involves_me, timestamp)",
+        "create index if not exists history_nickname"
+        " on history(nickname, timestamp)",
+    ]),
+    (4, 'archive', [
+        "create virtual table if not exists archive using fts5("
+        "  msg,"
+        "  nickname,"
+        "  recipient UNINDEXED,"
+        "  channel UNINDEXED,"
+        "  source UNINDEXED,"
+        "  timestamp UNINDEXED"
+        ")",
+    ]),
+    (5, 'sms outbox', [
+        "create table if not exists sms_outbox ("
+        "  id integer primary key,"
+        "  number text,"
+        "  msg text,"
+        "  attempts integer,"
+        "  created integer"
+        ")",
+    ]),
+    (6, 'event journal', [
+        "create table if not exists event_journal ("
+        "  id integer primary key,"
+        "  event_type text,"
+        "  data text,"
+        "  created real"
+        ")",
+    ]),
+    (7, 'mms index manifest', [
+        "create table mms_index_manifest ("
+        "  base_path text,"
+        "  dir_name text,"
+        "  mtime integer,"
+        "  mms text,"
+        "  primary key (base_path, dir_name)"
+        ")",
+    ]),
+]
+
+
+class Database():
+    """ Hands every thread its own autocommit connection, in WAL mode so
+    that readers don't wait for writers; writers wait up to busy_timeout
+    seconds for each other. cache_size is in KiB and mmap_size in bytes,
+    per connection.
+
+    ':memory:' databases can't be shared between connections, so they
+    get a single connection for all threads; that's for tests. """
+
+    def __init__(self, path, synchronous='normal', cache_size=8192,
+                 mmap_size=64 * 1024 * 1024, busy_timeout=5.0):
+        if synchronous not in SYNCHRONOUS:
+            raise SMS900DatabaseException(
+                "Invalid synchronous setting: %s (expected one of %s)" % (
+                    synchronous, ', '.join(SYNCHRONOUS)
+                )
+            )
+
+        self.path = path
+        self.synchronous = synchronous
+        self.cache_size = int(cache_size)
+        self.mmap_size = int(mmap_size)
+        self.busy_timeout = busy_timeout
+
+        self.local = threading.local()
+        self.shared = self._connect() if path == ':memory:' else None
+
+    @classmethod
+    def from_config(cls, path, config):
+        return cls(
+            path,
+            synchronous=config['db_synchronous']
+            if 'db_synchronous' in config else 'normal',
+            cache_size=config['db_cache_size']
+            if 'db_cache_size' in config else 8192,
+            mmap_size=config['db_mmap_size']
+            if 'db_mmap_size' in config else 64 * 1024 * 1024,
+            busy_timeout=config['db_busy_timeout']
+            if 'db_busy_timeout' in config else 5.0
+        )
+
+    def connection(self):
+        """ This thread's connection """
+        if self.shared:
+            return self.shared
+
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self._connect()
+            self.local.conn = conn
+
+        return conn
+
+    def close(self):
+        """ Closes this thread's connection, if it has one """
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self.local.conn = None
+
+    def execute(self, sql, args=()):
+        return self.connection().execute(sql, args)
+
+    def executemany(self, sql, args):
+        return self.connection().executemany(sql, args)
+
+    @contextmanager
+    def transaction(self):
+        """ Runs the block in a single transaction (one fsync rather than
+        one per statement), rolled back if it raises. Nested blocks are
+        part of the outermost one. """
+        conn = self.connection()
+        if conn.in_transaction:
+            yield conn
+            return
+
+        # Take the write lock up front; upgrading a read transaction
+        # fails rather than waiting when another thread is writing
+        conn.execute("begin immediate")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("rollback")
+            raise
+
+        conn.execute("commit")
+
+    def migrate(self, migrations=MIGRATIONS):
+        """ Applies the migrations that haven't been yet, each in its own
+        transaction. Returns the versions applied. """
+        self.execute(
+            "create table if not exists schema_migrations ("
+            "  version integer primary key,"
+            "  description text,"
+            "  applied real"
+            ")"
+        )
+
+        applied = []
+        for (version, description, steps) in sorted(migrations, key=lambda m: m[0]):
+            with self.transaction() as conn:
+                # Checked within the transaction, in case another process
+                # is migrating too
+                if conn.execute("select 1 from schema_migrations where version = ?",
+                                (version,)).fetchone():
+                    continue
+
+                logging.info("Migrating database to version %d (%s)", version, description)
+                for step in steps:
+                    if callable(step):
+                        step(conn)
+                    else:
+                        conn.execute(step)
+
+                conn.execute(
+                    "insert into schema_migrations(version, description, applied)"
+                    " values (?, ?, ?)",
+                    (version, description, time.time())
+                )
+
+            applied.append(version)
+
+        return applied
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, isolation_level=None,
+                               timeout=self.busy_timeout,
+                               check_same_thread=self.path != ':memory:')
+
+        conn.execute("pragma journal_mode=wal")
+        conn.execute("pragma synchronous=%s" % self.synchronous)
+        # Negative means KiB rather than pages
+        conn.execute("pragma cache_size=%d" % -self.cache_size)
+        conn.execute("pragma mmap_size=%d" % self.mmap_size)
+
+        return conn
@@ -0,0 +1,116 @@
+""" Persistent conversation history, used as context for the AI """
+from collections import deque
+from datetime import datetime
+import threading
+
+
+class History():
+    """ Stores every history entry in sqlite and keeps the most recent
+    entries per channel in a bounded in-memory cache.
+
+    Entries are dicts with timestamp (aware datetime), nickname, channel,
+    msg and type ('irc', 'sms', 'reminder'). Entries written by or
+    mentioning my_nickname are flagged when stored, so that picking the
+    context for a completion is an indexed query. """
+
+    def __init__(self, db, my_nickname, cache_size=100):
+        self.my_nickname = my_nickname
+        self.cache_size = cache_size
+
+        self.db = db
+        # Guards the caches below
+        self.lock = threading.Lock()
+
+        # channel -> deque of the latest entries since the last reset
+        self.cache = {}
+        # channel -> timestamp of the last reset
+        self.resets = {}
+
+    def append(self, entry):
+        involves_me = (self.my_nickname in entry['msg']
+                       or entry['nickname'] == self.my_nickname)
+
+        with self.lock:
+            self.db.execute(
+                "insert into history(timestamp, channel, nickname, msg, type, involves_me)"
+                " values (?, ?, ?, ?, ?, ?)",
+                (entry['timestamp'].timestamp(), entry['channel'], entry['nickname'],
+                 entry['msg'], entry['type'], 1 if involves_me else 0)
+            )
+
+            self._get_cache(entry['channel']).append(entry)
+
+    def reset(self, channel):
+        """ Forget the context for a channel; the entries stay stored """
+        now = datetime.now().astimezone()
+
+        with self.lock:
+            self.db.execute(
+                "insert into history(timestamp, channel, nickname, msg, type, involves_me)"
+                " values (?, ?, '', '', 'reset', 0)",
+                (now.timestamp(), channel)
+            )
+
+            self.resets[channel] = now.timestamp()
+            self.cache[channel] = deque(maxlen=self.cache_size)
+
+    def get_recent(self, channel, limit):
+        """ The latest `limit` entries, oldest first """
+        with self.lock:
+            cache = self._get_cache(channel)
+            if limit <= self.cache_size:
+                return list(cache)[-limit:]
+
+            return self._query(
+                "channel = ? and timestamp > ? and type != 'reset'",
+                (channel, self._get_reset(channel)),
+                limit
+            )
+
+    def get_involving_me(self, channel, limit):
+        """ The latest `limit` entries written by or mentioning me """
+        with self.lock:
+            return self._query(
+                "channel = ? and involves_me = 1 and timestamp > ?",
+                (channel, self._get_reset(channel)),
+                limit
+            )
+
+    def _get_cache(self, channel):
+        if channel not in self.cache:
+            self.cache[channel] = deque(
+                self._query(
+                    "channel = ? and timestamp > ? and type != 'reset'",
+                    (channel, self._get_reset(channel)),
+                    self.cache_size
+                ),
+                maxlen=self.cache_size
+            )
+
+        return self.cache[channel]
+
+    def _get_reset(self, channel):
+        if channel not in self.resets:
+            row = self.db.execute(
+                "select max(timestamp) from history where channel = ? and type = 'reset'",
+                (channel,)
+            ).fetchone()
+
+            self.resets[channel] = row[0] if row[0] is not None else 0
+
+        return self.resets[channel]
+
+    def _query(self, where, args, limit):
+        rows = self.db.execute(
+            "select timestamp, channel, nickname, msg, type from history"
+            " where %s order by timestamp desc limit ?" % where,
+            args + (limit,)
+        ).fetchall()
+
+        return [{
+            'timestamp': datetime.fromtimestamp(row[0]).astimezone(),
+            'channel': row[1],
+            'nickname': row[2],
+            'msg': row[3],
+            'type': row[4],
+        } for row in reversed(rows)]
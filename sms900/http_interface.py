@@ -1,22 +1,70 @@
-from requests_toolbelt import MultipartDecoder
+from concurrent.futures import Future, TimeoutError
+import hmac
 import http.server
 import json
 import logging
+from os import mkdir, path
+import queue
 import re
-import socketserver
-import tempfile
+import shutil
 from threading import Thread
-import urllib
+import urllib.parse
+import uuid
+
+from sms900.multipart import (get_boundary, parse_multipart, MMSPartStore,
+                              RotatingCapture, SMS900InvalidMultipart)
+from sms900.phonebook import SMS900InvalidAddressbookEntry
+from sms900.phonebook_io import SMS900InvalidImport
 
 class SMSHTTPCallbackHandler(http.server.BaseHTTPRequestHandler):
+    # Keep-alive; every response needs a Content-Length or chunked encoding
+    protocol_version = 'HTTP/1.1'
+    # Idle keep-alive connections give their worker back after this long
+    timeout = 15
+
+    MAX_BODY_SIZE = 1024 * 1024
+    MAX_IMPORT_SIZE = 10 * 1024 * 1024
+    MAX_MMS_SIZE = 50 * 1024 * 1024
+    MAX_QUEUED_EVENTS = 1000
+    RETRY_AFTER = 30
+    IMPORT_TIMEOUT = 60
+    EXPORT_CHUNK_SIZE = 16 * 1024
+
     @classmethod
     def set_sms900(cls, sms900):
         cls.sms900 = sms900
 
     def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+
+        m = re.match('^/api/search$', url.path)
+        if m:
+            self._handle_search(urllib.parse.parse_qs(url.query))
+            return
+
+        m = re.match('^/api/phonebook/export$', url.path)
+        if m:
+            self._handle_phonebook_export(urllib.parse.parse_qs(url.query))
+            return
+
+        m = re.match('^/metrics$', url.path)
+        if m:
+            self._handle_metrics(urllib.parse.parse_qs(url.query))
+            return
+
         self._error()
 
     def do_POST(self):
+        url = urllib.parse.urlsplit(self.path)
+
+        if not self._check_request_body(url.path):
+            return
+
+        m = re.match('^/api/phonebook/import$', url.path)
+        if m:
+            self._handle_phonebook_import(urllib.parse.parse_qs(url.query))
+            return
+
         m = re.match('^/api/sms/callback$', self.path)
         if m:
             self._handle_incoming_sms()
@@ -66,10 +114,9 @@ class SMSHTTPCallbackHandler(http.server.BaseHTTPRequestHandler):
 
     def _handle_mailgun_incoming(self):
         if 'form-data' in self.headers['Content-Type']:
-            data = {
-                'type': 'form-data',
-                'payload':  self._get_post_multipart()
-            }
+            data = self._get_post_multipart()
+            if not data:
+                return
         elif 'x-www-form-urlencoded' in self.headers['Content-Type']:
             data = {
                 'type': 'urlencoded',
@@ -85,53 +132,332 @@ class SMSHTTPCallbackHandler(http.server.BaseHTTPRequestHandler):
             self._generate_response(400, b'Unknown Content-Type')
             return
 
+        self.sms900.mms_received.inc()
+        self.sms900.mms_bytes.inc(value=int(self.headers['Content-Length']))
+
         self.sms900.queue_event('MAILGUN_INCOMING', {
             'data': data
         })
 
         self._generate_response(200, b'Ok')
 
+    def _handle_search(self, query):
+        if not self._check_api_token(query):
+            return
+
+        try:
+            q = query['q'][0]
+            page = int(query['page'][0]) if 'page' in query else 1
+            per_page = int(query['per_page'][0]) if 'per_page' in query else 20
+        except (KeyError, ValueError):
+            self._generate_response(400, b'Usage: ?q=<words>[&page=<n>][&per_page=<n>]',
+                                    'text/plain')
+            return
+
+        page = max(page, 1)
+        per_page = max(min(per_page, 100), 1)
+        (total, hits) = self.sms900.archive.search(q, page, per_page)
+
+        for hit in hits:
+            hit['timestamp'] = hit['timestamp'].isoformat()
+
+        self._generate_response(
+            200,
+            json.dumps({
+                'query': q,
+                'page': page,
+                'per_page': per_page,
+                'total': total,
+                'results': hits,
+            }).encode('utf-8'),
+            'application/json'
+        )
+
+    def _handle_phonebook_import(self, query):
+        if not self._check_api_token(query):
+            return
+
+        length = int(self.headers['Content-Length'])
+        data = self.rfile.read(length).decode('utf-8-sig', 'replace')
+
+        # The phone book belongs to the main loop; wait for it there
+        future = Future()
+        self.sms900.queue_event('IMPORT_PHONEBOOK', {
+            'data': data,
+            'format': query['format'][0] if 'format' in query else None,
+            'future': future,
+        })
+
+        try:
+            report = future.result(timeout=self.IMPORT_TIMEOUT)
+        except TimeoutError:
+            self._generate_response(503, b'Timed out', 'text/plain')
+            return
+        except (SMS900InvalidImport, SMS900InvalidAddressbookEntry) as err:
+            self._generate_response(400, str(err).encode('utf-8'), 'text/plain')
+            return
+        except Exception:
+            logging.exception("Failed to import the phone book")
+            self._generate_response(500, b'Import failed', 'text/plain')
+            return
+
+        self._generate_response(200, json.dumps(report).encode('utf-8'),
+                                'application/json')
+
+    def _handle_phonebook_export(self, query):
+        if not self._check_api_token(query):
+            return
+
+        format = query['format'][0] if 'format' in query else 'csv'
+        try:
+            chunks = self.sms900.export_phonebook(format)
+        except SMS900InvalidImport as err:
+            self._generate_response(400, str(err).encode('utf-8'), 'text/plain')
+            return
+
+        self.send_response(200)
+        self.send_header("Content-type",
+                         'text/vcard; charset=utf-8' if format == 'vcf' else 'text/csv; charset=utf-8')
+        self.send_header("Content-Disposition", 'attachment; filename="phonebook.%s"' % format)
+        self._write_chunked(chunks)
+
+    def _handle_metrics(self, query):
+        if not self._check_api_token(query):
+            return
+
+        self._generate_response(200, self.sms900.metrics.render().encode('utf-8'),
+                                'text/plain; version=0.0.4; charset=utf-8')
+
+    def _write_chunked(self, chunks):
+        """ Ends the headers and streams the chunks (strings), batched up to
+        EXPORT_CHUNK_SIZE bytes, with chunked encoding. HTTP/1.0 clients get
+        the body as is and the connection closed. """
+        chunked = self.request_version != 'HTTP/1.0'
+        if chunked:
+            self.send_header("Transfer-Encoding", "chunked")
+        else:
+            self.close_connection = True
+        self.end_headers()
+
+        def write(data):
+            if chunked:
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+            else:
+                self.wfile.write(data)
+
+        buf = bytearray()
+        for chunk in chunks:
+            buf += chunk.encode('utf-8')
+            if len(buf) >= self.EXPORT_CHUNK_SIZE:
+                write(bytes(buf))
+                buf.clear()
+
+        if buf:
+            write(bytes(buf))
+        if chunked:
+            self.wfile.write(b'0\r\n\r\n')
+
+    def _check_request_body(self, url_path):
+        """ Turns away POSTs that are too large, or that come in while the
+        main loop is too far behind to take more events. """
+        config = self.sms900.config
+
+        length = self.headers['Content-Length']
+        if self.headers['Transfer-Encoding'] or not length or not length.isdigit():
+            self._generate_response(411, b'Length Required', 'text/plain')
+            return False
+
+        if url_path == '/api/mailgun/incoming':
+            max_size = config['mms_max_size'] if 'mms_max_size' in config else self.MAX_MMS_SIZE
+        elif url_path == '/api/phonebook/import':
+            max_size = self.MAX_IMPORT_SIZE
+        else:
+            max_size = config['http_max_body_size'] \
+                if 'http_max_body_size' in config else self.MAX_BODY_SIZE
+
+        if int(length) > max_size:
+            logging.info("Rejecting %s byte request to %s (max %d)", length, url_path, max_size)
+            self._generate_response(413, b'Too large', 'text/plain')
+            return False
+
+        max_queued = config['http_max_queued_events'] \
+            if 'http_max_queued_events' in config else self.MAX_QUEUED_EVENTS
+        queued = self.sms900.events.qsize()
+        if queued >= max_queued:
+            logging.info("%d events queued, asking %s to retry later", queued, url_path)
+            self._generate_response(
+                503, b'Busy', 'text/plain',
+                {'Retry-After': str(config['http_retry_after']
+                                    if 'http_retry_after' in config else self.RETRY_AFTER)}
+            )
+            return False
+
+        return True
+
+    def _check_api_token(self, query):
+        """ The read/write APIs (unlike the webhooks) need a token, passed as
+        a bearer token or ?token=. They're disabled without http_api_token. """
+        config = self.sms900.config
+        if 'http_api_token' not in config or not config['http_api_token']:
+            self._error()
+            return False
+
+        token = None
+        authorization = self.headers['Authorization']
+        if authorization and authorization.startswith('Bearer '):
+            token = authorization[len('Bearer '):]
+        elif 'token' in query:
+            token = query['token'][0]
+
+        # compare_digest() only takes ASCII strings, so compare bytes
+        if not token or not hmac.compare_digest(token.encode('utf-8'),
+                                                config['http_api_token'].encode('utf-8')):
+            self._generate_response(403, b'Forbidden', 'text/plain')
+            return False
+
+        return True
+
     def _get_post_data(self):
         length = int(self.headers['Content-Length'])
         return urllib.parse.parse_qs(self.rfile.read(length).decode('utf-8'))
 
     def _get_post_multipart(self):
+        """ Streams the parts straight into a new MMS directory. Returns the
+        MAILGUN_INCOMING data, or None if an error response was sent. """
+        config = self.sms900.config
         length = int(self.headers['Content-Length'])
+
         logging.info("Receiving multipart message")
-        data = self.rfile.read(length)
 
-        with tempfile.NamedTemporaryFile(delete=False) as f:
-            logging.info("Saving debug data to %s" % f.name)
+        capture = None
+        if 'mailgun_debug_path' in config:
+            try:
+                capture = RotatingCapture(
+                    config['mailgun_debug_path'],
+                    config['mailgun_debug_keep'] if 'mailgun_debug_keep' in config else 5
+                ).open(self.requestline, self.headers)
+            except OSError:
+                logging.exception("Failed to save debug data, receiving without it")
+
+        def tee(chunk):
+            nonlocal capture
+            if not capture:
+                return
+
+            try:
+                capture.write(chunk)
+            except OSError:
+                logging.exception("Failed to save debug data, receiving without it")
+                (failed, capture) = (capture, None)
+                try:
+                    failed.close()
+                except OSError:
+                    pass
 
-            f.write(b"POST /api/mailgun/incoming HTTP/1.1\n")
-            for header in self.headers.keys():
-                f.write(("%s: %s\n" % (header, self.headers[header])).encode('utf-8', 'ignore'))
-            f.write(b"\n")
-            f.write(data)
+        rel_path = str(uuid.uuid4())
+        save_path = path.join(config['mms_save_path'], rel_path)
+        store = MMSPartStore(save_path)
 
-        return MultipartDecoder(data, self.headers['Content-Type'])
+        try:
+            mkdir(save_path)
+            parse_multipart(self.rfile, get_boundary(self.headers['Content-Type']),
+                            length, store.on_part,
+                            tee=tee)
+        except (SMS900InvalidMultipart, OSError) as err:
+            logging.exception("Failed to receive multipart message")
+            shutil.rmtree(save_path, ignore_errors=True)
+            self._generate_response(400, str(err).encode('utf-8'), 'text/plain')
+            return None
+        finally:
+            if capture:
+                capture.close()
+
+        return {
+            'type': 'stored',
+            'rel_path': rel_path,
+            'sender': store.sender,
+            'files': store.files,
+        }
 
     def _get_json_post_data(self):
         length = int(self.headers['Content-Length'])
         return json.loads(self.rfile.read(length).decode('utf-8'))
 
+    def log_request(self, code='-', size='-'):
+        self.sms900.http_requests.inc((self.command or '-', str(int(code))))
+        http.server.BaseHTTPRequestHandler.log_request(self, code, size)
+
     def _error(self):
         self._generate_response(404, b'Error')
 
-    def _generate_response(self, code, msg, type = 'text/xml'):
+    def _generate_response(self, code, msg, type = 'text/xml', headers=None):
+        if code >= 400:
+            # The request body may not have been read
+            self.close_connection = True
+
         self.send_response(code)
         self.send_header("Content-type", type)
+        self.send_header("Content-Length", str(len(msg)))
+        for (name, value) in (headers or {}).items():
+            self.send_header(name, value)
+        if self.close_connection:
+            self.send_header("Connection", "close")
         self.end_headers()
         self.wfile.write(msg)
 
-class ThreadedHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
-    """ Threaded server """
+class PooledHTTPServer(http.server.HTTPServer):
+    """ Serves connections from a fixed number of worker threads. When the
+    workers and the short backlog behind them are all taken, new
+    connections get a 503 right away instead of another thread each. """
+
+    def __init__(self, server_address, handler_class, workers=8, backlog=32,
+                 retry_after=30):
+        http.server.HTTPServer.__init__(self, server_address, handler_class)
+        self.retry_after = retry_after
+        self.connections = queue.Queue(maxsize=backlog)
+
+        for i in range(workers):
+            Thread(target=self._worker, name='http-%d' % i, daemon=True).start()
+
+    def process_request(self, request, client_address):
+        try:
+            self.connections.put_nowait((request, client_address))
+        except queue.Full:
+            logging.info("HTTP backlog full, turning away %s", client_address[0])
+            try:
+                request.sendall(
+                    b'HTTP/1.1 503 Service Unavailable\r\n'
+                    b'Retry-After: %d\r\n'
+                    b'Content-Length: 0\r\n'
+                    b'Connection: close\r\n\r\n' % self.retry_after
+                )
+            except OSError:
+                pass
+            self.shutdown_request(request)
+
+    def _worker(self):
+        while True:
+            (request, client_address) = self.connections.get()
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
 
 class HTTPThread(Thread):
     def __init__(self, sms900, server_address):
         Thread.__init__(self)
         SMSHTTPCallbackHandler.set_sms900(sms900)
-        self.httpd = ThreadedHTTPServer(server_address, SMSHTTPCallbackHandler)
+
+        config = sms900.config
+        self.httpd = PooledHTTPServer(
+            server_address,
+            SMSHTTPCallbackHandler,
+            workers=config['http_workers'] if 'http_workers' in config else 8,
+            backlog=config['http_backlog'] if 'http_backlog' in config else 32,
+            retry_after=config['http_retry_after'] if 'http_retry_after' in config else 30
+        )
 
     def run(self):
         self.httpd.serve_forever()
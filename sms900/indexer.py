@@ -1,17 +1,44 @@
 """ Create indexes for the on-disk media files """
 import datetime
 import html
+import json
 import logging
+import math
+import os
 from os import listdir, path
+import re
+import threading
 
 from jinja2 import Environment, FileSystemLoader
 
+# The manifest used to be kept in these files, in the publicly served
+# base_path; they're removed when found
+OLD_MANIFEST_FILENAMES = [
+    ".index-manifest.json",
+    ".index-manifest.sqlite",
+    ".index-manifest.sqlite-journal",
+]
+
 class Indexer():
-    def __init__(self):
+    def __init__(self, db, page_size = None, template_path = "html/"):
+        self.db = db
         self.env = env = Environment(
-            loader=FileSystemLoader(searchpath="html/" )
+            loader=FileSystemLoader(searchpath=template_path)
         )
 
+        # If set, the global index is split into pages of this many MMS,
+        # numbered from the oldest one, so that only the newest page(s)
+        # change when a new MMS arrives.
+        self.page_size = page_size
+
+        # base_path -> { dir name -> { 'mtime': ..., 'mms': ... } }, a
+        # cache of the mms_index_manifest table, which has one row per
+        # directory
+        self.manifests = {}
+
+        # The global index may be updated from several ingestion workers
+        self.lock = threading.Lock()
+
     def generate_local_index(self, base_path):
         mms = self._get_local_files(base_path)
 
@@ -28,41 +55,213 @@ class Indexer():
         )
 
     def generate_global_index(self, base_path, filename = "mms.html"):
-        all_mms = []
+        """ Refresh the manifest for every directory below base_path and
+        render the global index from it. Directories whose mtime hasn't
+        changed since they were last summarized are not re-read. """
+        with self.lock:
+            self._generate_global_index(base_path, filename)
+
+    def add_to_global_index(self, base_path, dir_name, filename = "mms.html"):
+        """ Summarize a single (new or changed) directory and re-render
+        the global index from the cached summaries of all the others. """
+        with self.lock:
+            self._add_to_global_index(base_path, dir_name, filename)
+
+    def reindex_all(self, base_path):
+        for f in listdir(base_path):
+            full_path = path.join(base_path, f)
+            if path.isdir(full_path):
+                self.generate_local_index(full_path)
+
+        self.generate_global_index(base_path)
+
+    def _generate_global_index(self, base_path, filename):
+        manifest = self._get_manifest(base_path)
+        seen = set()
+        changed = []
 
         for f in listdir(base_path):
             local_path = path.join(base_path, f)
             if not path.isdir(local_path):
                 continue
 
-            mms = self._get_local_files(
-                local_path,
-                prepend_path = f
-            )
-
-            if not len(mms['all_files']):
+            seen.add(f)
+            mtime = os.stat(local_path).st_mtime_ns
+            if f in manifest and manifest[f]['mtime'] == mtime:
                 continue
 
-            all_mms.append(mms)
+            self._update_manifest_entry(manifest, base_path, f, mtime)
+            changed.append(f)
+
+        removed = [f for f in manifest if f not in seen]
+        for f in removed:
+            del manifest[f]
+
+        self._save_manifest(base_path, changed, removed)
+        self._render_global_index(base_path, filename)
+        self._remove_stale_pages(base_path, filename)
+
+    def _add_to_global_index(self, base_path, dir_name, filename):
+        manifest = self._get_manifest(base_path)
+        if not manifest:
+            # New; it has to learn about every other directory
+            self._generate_global_index(base_path, filename)
+            return
+
+        old_page_count = self._get_page_count(self._get_sorted_mms(manifest))
+
+        mtime = os.stat(path.join(base_path, dir_name)).st_mtime_ns
+        self._update_manifest_entry(manifest, base_path, dir_name, mtime)
 
-        all_mms = sorted(all_mms, key = lambda mms: mms['time'], reverse = True)
+        self._save_manifest(base_path, [dir_name], [])
+        self._render_global_index(
+            base_path,
+            filename,
+            changed = dir_name,
+            old_page_count = old_page_count
+        )
 
+    def _render_global_index(self, base_path, filename, changed = None,
+                             old_page_count = None):
+        all_mms = self._get_sorted_mms(self._get_manifest(base_path))
         template = self.env.get_template("global-index.html")
-        index_path = path.join(base_path, filename)
+
+        if not self.page_size:
+            self._write_file(
+                template.render(
+                    all_mms = list(reversed(all_mms))
+                ),
+                path.join(base_path, filename)
+            )
+            return
+
+        page_count = self._get_page_count(all_mms)
+        pages = []
+        for number in range(1, page_count + 1):
+            page_mms = all_mms[(number - 1) * self.page_size:number * self.page_size]
+            pages.append({
+                'number': number,
+                'href': self._get_page_filename(filename, number),
+                'first': page_mms[0]['time'],
+                'last': page_mms[-1]['time'],
+                'mms': list(reversed(page_mms))
+            })
+
+        # Pages before the changed entry (and before the previous last
+        # page, whose "newer" link may have changed) are left untouched.
+        first_dirty = 1
+        if changed is not None and old_page_count:
+            positions = [i for (i, mms) in enumerate(all_mms)
+                         if mms['relpath'] == changed]
+            first_dirty = old_page_count
+            if positions:
+                first_dirty = min(first_dirty, positions[0] // self.page_size + 1)
+
+        for page in pages[first_dirty - 1:]:
+            number = page['number']
+            self._write_file(
+                template.render(
+                    all_mms = page['mms'],
+                    page = page,
+                    older_href = pages[number - 2]['href'] if number > 1 else None,
+                    newer_href = pages[number]['href'] if number < page_count else None
+                ),
+                path.join(base_path, page['href'])
+            )
+
+        # The landing page shows the newest page and links to the others
+        newest = pages[-1] if pages else None
         self._write_file(
             template.render(
-                all_mms = all_mms
+                all_mms = newest['mms'] if newest else [],
+                page = newest,
+                pages = list(reversed(pages)),
+                older_href = pages[-2]['href'] if page_count > 1 else None
             ),
-            index_path
+            path.join(base_path, filename)
+        )
+
+    def _remove_stale_pages(self, base_path, filename):
+        (stem, ext) = path.splitext(filename)
+        page_count = self._get_page_count(
+            self._get_sorted_mms(self._get_manifest(base_path))
         )
 
-    def reindex_all(self, base_path):
         for f in listdir(base_path):
-            full_path = path.join(base_path, f)
-            if path.isdir(full_path):
-                self.generate_local_index(full_path)
+            m = re.match('^%s-([0-9]+)%s$' % (re.escape(stem), re.escape(ext)), f)
+            if m and (not self.page_size or int(m.group(1)) > page_count):
+                os.remove(path.join(base_path, f))
 
-        self.generate_global_index(base_path)
+    def _get_sorted_mms(self, manifest):
+        all_mms = [entry['mms'] for entry in manifest.values()
+                   if entry['mms'] is not None]
+        return sorted(all_mms, key = lambda mms: (mms['time'], mms['relpath']))
+
+    def _get_page_count(self, all_mms):
+        if not self.page_size:
+            return 0
+
+        return math.ceil(len(all_mms) / self.page_size)
+
+    def _get_page_filename(self, filename, number):
+        (stem, ext) = path.splitext(filename)
+        return "%s-%d%s" % (stem, number, ext)
+
+    def _update_manifest_entry(self, manifest, base_path, dir_name, mtime):
+        mms = self._get_local_files(
+            path.join(base_path, dir_name),
+            prepend_path = dir_name
+        )
+
+        manifest[dir_name] = {
+            'mtime': mtime,
+            'mms': mms if len(mms['all_files']) else None
+        }
+
+    def _get_manifest(self, base_path):
+        if base_path in self.manifests:
+            return self.manifests[base_path]
+
+        for filename in OLD_MANIFEST_FILENAMES:
+            old_path = path.join(base_path, filename)
+            if path.exists(old_path):
+                os.remove(old_path)
+
+        manifest = {}
+        for (dir_name, mtime, mms) in self.db.execute(
+                "select dir_name, mtime, mms from mms_index_manifest"
+                " where base_path = ?", (base_path,)):
+            try:
+                mms = json.loads(mms) if mms else None
+            except ValueError:
+                # Left out, so that the next full scan re-reads it
+                logging.exception("Bad manifest entry for %s, ignoring" % dir_name)
+                continue
+
+            manifest[dir_name] = {
+                'mtime': mtime,
+                'mms': mms
+            }
+
+        self.manifests[base_path] = manifest
+        return manifest
+
+    def _save_manifest(self, base_path, changed, removed):
+        """ Writes the rows of the changed and removed directories only """
+        manifest = self.manifests[base_path]
+
+        with self.db.transaction() as conn:
+            conn.executemany(
+                "insert or replace into mms_index_manifest(base_path, dir_name, mtime, mms)"
+                " values (?, ?, ?, ?)",
+                [(base_path, f, manifest[f]['mtime'],
+                  json.dumps(manifest[f]['mms']) if manifest[f]['mms'] else None)
+                 for f in changed]
+            )
+            conn.executemany(
+                "delete from mms_index_manifest where base_path = ? and dir_name = ?",
+                [(base_path, f) for f in removed]
+            )
 
     def _get_local_files(self, local_path, prepend_path = None):
         images = []
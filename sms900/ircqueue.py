@@ -0,0 +1,92 @@
+""" Flood protected outbound IRC message queue """
+from collections import deque
+import logging
+import threading
+
+PRIORITY_HIGH = 0    # Relayed SMS/MMS
+PRIORITY_NORMAL = 1  # Command replies, AI responses, ...
+PRIORITY_BULK = 2    # Long listings
+
+class OutboundQueue():
+    """ Splits messages into lines and hands them out in priority order, at
+    the pace allowed by a lines/s and a bytes/s TokenBucket. The queue is
+    meant to be drained from a single thread (the IRC thread), but put()
+    may be called from anywhere. """
+
+    def __init__(self, line_bucket, byte_bucket, max_lines=1000):
+        self.line_bucket = line_bucket
+        self.byte_bucket = byte_bucket
+        self.max_lines = max_lines
+
+        self.lanes = [deque() for _ in range(PRIORITY_BULK + 1)]
+        self.lock = threading.Lock()
+
+        self.stats = {
+            'queued': 0,
+            'sent': 0,
+            'dropped': 0,
+        }
+
+    def put(self, target, msg, priority=PRIORITY_NORMAL):
+        lines = [line for line in msg.split('\n') if line]
+
+        with self.lock:
+            for line in lines:
+                if self._len() >= self.max_lines:
+                    self.stats['dropped'] += 1
+                    logging.info("Outbound queue full, dropping line to %s: %s", target, line)
+                    continue
+
+                self.lanes[priority].append((target, line))
+                self.stats['queued'] += 1
+
+    def pop_ready(self):
+        """ Returns the next (target, line) if the rate limits allow sending
+        it right now, otherwise None. """
+        with self.lock:
+            lane = self._first_lane()
+            if lane is None:
+                return None
+
+            (target, line) = lane[0]
+            size = self._size(target, line)
+
+            if self.line_bucket.delay() > 0 or self.byte_bucket.delay(size) > 0:
+                return None
+
+            self.line_bucket.try_acquire()
+            self.byte_bucket.try_acquire(size)
+
+            lane.popleft()
+            self.stats['sent'] += 1
+
+            return (target, line)
+
+    def delay(self):
+        """ Seconds until pop_ready() may return something, or None if the
+        queue is empty. """
+        with self.lock:
+            lane = self._first_lane()
+            if lane is None:
+                return None
+
+            (target, line) = lane[0]
+            return max(self.line_bucket.delay(),
+                       self.byte_bucket.delay(self._size(target, line)))
+
+    def __len__(self):
+        with self.lock:
+            return self._len()
+
+    def _len(self):
+        return sum(len(lane) for lane in self.lanes)
+
+    def _first_lane(self):
+        for lane in self.lanes:
+            if lane:
+                return lane
+
+        return None
+
+    def _size(self, target, line):
+        return len(("PRIVMSG %s :%s\r\n" % (target, line)).encode('utf-8'))
@@ -1,5 +1,7 @@
 from collections import deque
 import logging
+import selectors
+import socket
 from threading import Thread, Semaphore
 import time
 
@@ -9,6 +11,9 @@ from oyoyo import helpers
 
 import re
 
+from sms900.ircqueue import OutboundQueue, PRIORITY_NORMAL
+from sms900.ratelimit import TokenBucket
+
 class IRCThreadCallbackHandler(DefaultCommandHandler):
     @classmethod
     def set_sms900(cls, sms900):
@@ -22,6 +27,10 @@ class IRCThreadCallbackHandler(DefaultCommandHandler):
     def set_channel(cls, channel):
         cls.channel = channel
 
+    @classmethod
+    def set_irc_thread(cls, irc_thread):
+        cls.irc_thread = irc_thread
+
     def __init__(self, client):
         super(IRCThreadCallbackHandler, self).__init__(client)
         self.cli = client
@@ -34,6 +43,10 @@ class IRCThreadCallbackHandler(DefaultCommandHandler):
         logging.info("PONG/%s/%s/%s" % (prefix, server, something))
         self.pong_queue.append(server)
 
+    def send_privmsg(self, target, msg, priority=PRIORITY_NORMAL):
+        # Through the flood protected queue, like everything else
+        self.irc_thread.send_privmsg(target, msg, priority)
+
     def nicknameinuse(self, server, b, nickname, msg):
         logging.info("Nickname already in use: %s/%s/%s/%s" % (server, b, nickname, msg))
         # FIXME: This algorithm is stupid
@@ -59,17 +72,22 @@ class IRCThreadCallbackHandler(DefaultCommandHandler):
             'S':     self._parse_cmd_send_sms_to_skatteola,
             'a':     self._parse_cmd_pb_add,
             'd':     self._parse_cmd_pb_del,
+            'find':  self._parse_cmd_find,
+            'g':     self._parse_cmd_pb_group,
             'h':     self._parse_cmd_help,
             'l':     self._parse_cmd_lookup_carrier,
             'r':     self._parse_cmd_reindex,
             'op':    self._parse_cmd_openai_prompt,
             'or':    self._parse_cmd_openai_reset_history,
             'oc':    self._parse_cmd_openai_comment_on_context,
+            'ocache': self._parse_cmd_openai_cache,
             'om':    self._parse_cmd_openai_model,
+            'ta':    self._parse_cmd_timers_add,
             'tc':    self._parse_cmd_timers_clear,
             'tl':    self._parse_cmd_timers_list,
+            'tz':    self._parse_cmd_timers_snooze,
             }
-        m = re.match('^!(s|S|a|d|h|l|r|op|or|oc|om|tc|tl)( .*|$)', msg, re.UNICODE)
+        m = re.match('^!(s|S|a|d|find|g|h|l|r|op|or|oc|ocache|om|ta|tc|tl|tz)( .*|$)', msg, re.UNICODE)
         if m:
             args = m.group(2)
             cmd_dispatch[m.group(1).strip()](hostmask, chan, args)
@@ -82,7 +100,7 @@ class IRCThreadCallbackHandler(DefaultCommandHandler):
 
         m = re.match(r'^\s*(\S+)\s+(.+)', cmd, re.UNICODE)
         if not m:
-            helpers.msg(self.cli, chan, 'Usage: !s(end) <contact|number> <msg..>')
+            self.send_privmsg(chan, 'Usage: !s(end) <contact|number> <msg..>')
             return
 
         destination = m.group(1)
@@ -99,7 +117,7 @@ class IRCThreadCallbackHandler(DefaultCommandHandler):
 
         m = re.match(r'^\s*(\S+)\s+(\S+)\s*$', cmd, re.UNICODE)
         if not m:
-            helpers.msg(self.cli, chan, 'Usage: !a(dd) contact <number|email>')
+            self.send_privmsg(chan, 'Usage: !a(dd) contact <number|email>')
             return
 
         nickname = m.group(1)
@@ -124,7 +142,7 @@ class IRCThreadCallbackHandler(DefaultCommandHandler):
 
         m = re.match(r'^\s*(\S+)\s*$', cmd, re.UNICODE)
         if not m:
-            helpers.msg(self.cli, chan, 'Usage: !d(elete) contact [email]')
+            self.send_privmsg(chan, 'Usage: !d(elete) contact [email]')
             return
 
         nickname = None
@@ -141,12 +159,45 @@ class IRCThreadCallbackHandler(DefaultCommandHandler):
             'email' : email
         })
 
+    def _parse_cmd_pb_group(self, hostmask, chan, cmd):
+        logging.info('g! %s %s %s' % (hostmask, chan, cmd))
+
+        m = re.match(r'^\s*(list)?\s*$', cmd, re.UNICODE)
+        if m:
+            self.sms900.queue_event('LIST_PB_GROUPS', {})
+            return
+
+        m = re.match(r'^\s*send\s+(\S+)\s+(.+)', cmd, re.UNICODE)
+        if m:
+            self.sms900.queue_event('SEND_GROUP_SMS', {
+                'hostmask' : hostmask,
+                'group' : m.group(1),
+                'msg' : m.group(2)
+            })
+            return
+
+        m = re.match(r'^\s*(add|del)\s+(\S+)((\s+\S+)*)\s*$', cmd, re.UNICODE)
+        if m and (m.group(1) == 'del' or m.group(3).strip()):
+            self.sms900.queue_event(
+                'ADD_PB_GROUP_MEMBERS' if m.group(1) == 'add' else 'DEL_PB_GROUP_MEMBERS',
+                {
+                    'hostmask' : hostmask,
+                    'group' : m.group(2),
+                    'nicknames' : m.group(3).split()
+                }
+            )
+            return
+
+        self.send_privmsg(chan,
+                          'Usage: !g(roup) [list] | add <group> <contact..> | '
+                          'del <group> [contact..] | send <group> <msg..>')
+
     def _parse_cmd_lookup_carrier(self, hostmask, chan, cmd):
         logging.info('s! %s %s %s' % (hostmask, chan, cmd))
 
         m = re.match(r'^\s*(\S+)$', cmd, re.UNICODE)
         if not m:
-            helpers.msg(self.cli, chan, 'Usage: !l(ookup) <number>')
+            self.send_privmsg(chan, 'Usage: !l(ookup) <number>')
             return
 
         number = m.group(1)
@@ -156,12 +207,26 @@ class IRCThreadCallbackHandler(DefaultCommandHandler):
             'number' : number
         })
 
+    def _parse_cmd_find(self, hostmask, chan, cmd):
+        logging.info('!find %s, %s, %s' % (hostmask, chan, cmd))
+
+        m = re.match(r'^\s*(-(\d+)\s+)?(\S.*)$', cmd, re.UNICODE)
+        if not m:
+            self.send_privmsg(chan, 'Usage: !find [-<page>] <words..>')
+            return
+
+        page = int(m.group(2)) if m.group(2) else 1
+        self.sms900.queue_event('ARCHIVE_SEARCH', {
+            'query' : m.group(3).strip(),
+            'page' : max(page, 1)
+        })
+
     def _parse_cmd_reindex(self, hostmask, chan, cmd):
         logging.info('!r %s, %s, %s' % (hostmask, chan, cmd))
 
         m = re.match(r'^\s*$', cmd, re.UNICODE)
         if not m:
-            helpers.msg(self.cli, chan, 'Usage: !r(eindex all)')
+            self.send_privmsg(chan, 'Usage: !r(eindex all)')
             return
 
         self.sms900.queue_event('REINDEX_ALL', {})
@@ -171,82 +236,157 @@ class IRCThreadCallbackHandler(DefaultCommandHandler):
 
         new_prompt = cmd.strip();
         self.sms900.openai_set_prompt(new_prompt)
-        helpers.msg(self.cli, chan, 'Kashikomarimashita' if new_prompt else 'Prompt reset')
+        self.send_privmsg(chan, 'Kashikomarimashita' if new_prompt else 'Prompt reset')
 
     def _parse_cmd_openai_reset_history(self, hostmask, chan, cmd):
         logging.info('!or %s, %s, %s' % (hostmask, chan, cmd))
 
         m = re.match(r'^\s*$', cmd, re.UNICODE)
         if not m:
-            helpers.msg(self.cli, chan, 'Usage: !or(reset history)')
+            self.send_privmsg(chan, 'Usage: !or(reset history)')
             return
 
         self.sms900.openai_reset_history()
-        helpers.msg(self.cli, chan, 'History reset')
+        self.send_privmsg(chan, 'History reset')
 
     def _parse_cmd_openai_comment_on_context(self, hostmask, chan, cmd):
         logging.info('!oc %s, %s, %s' % (hostmask, chan, cmd))
 
         m = re.match(r'^\s*\d+\s*$', cmd, re.UNICODE)
         if not m:
-            helpers.msg(self.cli, chan, 'Usage: !oc(comment) <number-of-lines>')
+            self.send_privmsg(chan, 'Usage: !oc(comment) <number-of-lines>')
             return
 
         length = int(cmd.strip())
 
         self.sms900.queue_event('TRIGGER_COMPLETION', {'include_all_length': length})
 
+    def _parse_cmd_openai_cache(self, hostmask, chan, cmd):
+        logging.info('!ocache %s, %s, %s' % (hostmask, chan, cmd))
+
+        m = re.match(r'^\s*(flush)?\s*$', cmd, re.UNICODE)
+        if not m:
+            self.send_privmsg(chan, 'Usage: !ocache [flush]')
+            return
+
+        stats = self.sms900.openai_cache_stats()
+        if stats is None:
+            self.send_privmsg(chan, 'Completion cache is disabled')
+            return
+
+        self.send_privmsg(chan, 'Completion cache: %d entries, %d hits, %d misses' % (
+            stats['entries'], stats['hits'], stats['misses']
+        ))
+
+        if m.group(1):
+            count = self.sms900.openai_cache_flush()
+            self.send_privmsg(chan, f'Flushed {count} cached responses')
+
     def _parse_cmd_openai_model(self, hostmask, chan, cmd):
         logging.info('!om %s, %s, %s' % (hostmask, chan, cmd))
 
         new_model = cmd.strip();
         self.sms900.openai_set_model(new_model)
-        helpers.msg(self.cli, chan, 'Done')
+        self.send_privmsg(chan, 'Done')
+
+    def _parse_cmd_timers_add(self, hostmask, chan, cmd):
+        logging.info('!ta %s, %s, %s' % (hostmask, chan, cmd))
+
+        m = re.match(r'^\s*([^|]+?)\s*\|\s*(.+)$', cmd, re.UNICODE)
+        if not m:
+            self.send_privmsg(chan,
+                              'Usage: !ta <time|every weekday 9:00|every 2h|cron> | <msg>')
+            return
+
+        self.sms900.queue_event('ADD_TIMER', {
+            'hostmask' : hostmask,
+            'time' : m.group(1),
+            'msg' : m.group(2)
+        })
+
+    def _parse_cmd_timers_snooze(self, hostmask, chan, cmd):
+        logging.info('!tz %s, %s, %s' % (hostmask, chan, cmd))
+
+        m = re.match(r'^\s*(last|[-a-fA-F0-9]{36})\s+(\S.*?)\s*$', cmd, re.UNICODE)
+        if not m:
+            self.send_privmsg(chan, 'Usage: !tz <last|uuid> <duration, e.g. 10m>')
+            return
+
+        self.sms900.queue_event('SNOOZE_TIMER', {
+            'hostmask' : hostmask,
+            'uuid' : m.group(1),
+            'duration' : m.group(2)
+        })
 
     def _parse_cmd_timers_list(self, hostmask, chan, cmd):
         logging.info('!tl %s, %s, %s' % (hostmask, chan, cmd))
 
-        m = re.match(r'^\s*$', cmd, re.UNICODE)
+        m = re.match(r'^\s*(mine)?\s*$', cmd, re.UNICODE)
         if not m:
-            helpers.msg(self.cli, chan, 'Usage: !tl(ist)')
+            self.send_privmsg(chan, 'Usage: !tl(ist) [mine]')
             return
 
-        self.sms900.timers_list()
+        self.sms900.queue_event('LIST_TIMERS', {
+            'hostmask' : hostmask,
+            'mine' : bool(m.group(1))
+        })
 
     def _parse_cmd_timers_clear(self, hostmask, chan, cmd):
         logging.info('!tc %s, %s, %s' % (hostmask, chan, cmd))
 
         m = re.match(r'^\s*(all|[-a-fA-F0-9]{36})\s*$', cmd, re.UNICODE)
         if not m:
-            helpers.msg(self.cli, chan, 'Usage: !tc(lear) <all|uuid>')
+            self.send_privmsg(chan, 'Usage: !tc(lear) <all|uuid>')
             return
 
-        count = self.sms900.timers_clear(m[1])
-        helpers.msg(self.cli, chan, f'Cleared {count} active timers')
+        self.sms900.queue_event('CLEAR_TIMERS', {
+            'uuid' : m.group(1)
+        })
 
     def _parse_cmd_help(self, hostmask, chan, cmd):
-        helpers.msg(
-            self.cli,
+        self.send_privmsg(
             chan,
-            'Commands: s(end message), a(add contact), d(elete contact), l(ookup), r(eindex all), h(elp)'
+            'Commands: s(end message), a(add contact), d(elete contact), g(roups), find, l(ookup), r(eindex all), ta/tl/tz/tc (timers), h(elp)'
         )
 
 class IRCThread(Thread):
     PING_INTERVAL = 60
     PING_TIMEOUT = 180
 
-    def __init__(self, sms900, host, port, nick, channel):
+    def __init__(self, sms900, host, port, nick, channel, flood_config={}):
         Thread.__init__(self)
         self.irc_host = host
         self.irc_port = port
         self.irc_nick = nick
 
         self.pong_queue = deque()
-        self.cmd_queue = deque()
+        # Seconds, as of the latest pong
+        self.lag = None
+
+        # Outgoing messages survive reconnects; the defaults stay well
+        # below the usual ircd excess flood limits.
+        self.outbound = OutboundQueue(
+            TokenBucket(
+                flood_config['lines_per_second'] if 'lines_per_second' in flood_config else 1,
+                flood_config['line_burst'] if 'line_burst' in flood_config else 5
+            ),
+            TokenBucket(
+                flood_config['bytes_per_second'] if 'bytes_per_second' in flood_config else 512,
+                flood_config['byte_burst'] if 'byte_burst' in flood_config else 2048
+            ),
+            max_lines=flood_config['max_queued_lines']
+            if 'max_queued_lines' in flood_config else 1000
+        )
+
+        # send_privmsg() writes a byte here to wake up the IRC loop
+        (self.wakeup_r, self.wakeup_w) = socket.socketpair()
+        self.wakeup_r.setblocking(False)
+        self.wakeup_w.setblocking(False)
 
         IRCThreadCallbackHandler.set_sms900(sms900)
         IRCThreadCallbackHandler.set_pong_queue(self.pong_queue)
         IRCThreadCallbackHandler.set_channel(channel)
+        IRCThreadCallbackHandler.set_irc_thread(self)
 
     def run(self):
         while True:
@@ -268,38 +408,89 @@ class IRCThread(Thread):
         self.ping_sent_at = False
         self.pong_queue.clear()
 
+        # The first step connects and registers; after that the socket is
+        # non-blocking and the generator only needs to run when it's readable.
         conn = cli.connect()
-        while True:
-            next(conn)
-            while len(self.cmd_queue) > 0:
-                cmd = self.cmd_queue.popleft()
-                target = cmd[1]
-                msg = cmd[2]
-                logging.info('Handling event (%s) -> (%s, %s)' % (cmd, target, msg))
-                helpers.msg(cli, target, msg)
-
-            self._check_connection(cli)
-
-            time.sleep(0.2)
+        next(conn)
+
+        with selectors.DefaultSelector() as selector:
+            selector.register(cli.socket, selectors.EVENT_READ, 'irc')
+            selector.register(self.wakeup_r, selectors.EVENT_READ, 'wakeup')
+
+            while True:
+                while True:
+                    line = self.outbound.pop_ready()
+                    if not line:
+                        break
+
+                    (target, msg) = line
+                    logging.info('Sending -> (%s, %s)' % (target, msg))
+                    helpers.msg(cli, target, msg)
+
+                timeout = self._check_connection(cli)
+
+                flood_delay = self.outbound.delay()
+                if flood_delay is not None:
+                    timeout = min(timeout, flood_delay)
+
+                for (key, _events) in selector.select(timeout):
+                    if key.data == 'wakeup':
+                        self._drain_wakeup()
+                    else:
+                        self._check_eof(cli.socket)
+                        next(conn)
+
+    def _drain_wakeup(self):
+        try:
+            while self.wakeup_r.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def _check_eof(self, sock):
+        # oyoyo doesn't notice a closed connection; it'd just keep reading
+        # nothing from an always-readable socket.
+        try:
+            if not sock.recv(1, socket.MSG_PEEK):
+                raise Exception("Connection closed by server")
+        except BlockingIOError:
+            pass
 
     def _check_connection(self, cli):
+        """ Sends pings and checks for timeouts. Returns the number of
+        seconds until it needs to be called again. """
         if not self.ping_sent_at:
-            if time.time() - self.ping_last_reply > self.PING_INTERVAL:
+            since_reply = time.time() - self.ping_last_reply
+            if since_reply > self.PING_INTERVAL:
                 self.ping_sent_at = time.time()
                 cli.send("PING %s" % int(self.ping_sent_at))
+                return self.PING_TIMEOUT
+
+            return self.PING_INTERVAL - since_reply
         else:
             lag = time.time() - self.ping_sent_at
 
             # We'll just assume that any pong received is good enough
             if len(self.pong_queue) > 0:
                 logging.info("Current lag: %s" % lag)
+                self.lag = lag
 
                 self.ping_sent_at = None
                 self.ping_last_reply = time.time()
                 self.pong_queue.clear()
+
+                return self.PING_INTERVAL
             else:
                 if lag > self.PING_TIMEOUT:
                     raise Exception("Lag is %s, exceeded timeout %s" % (lag, self.PING_TIMEOUT))
 
-    def send_privmsg(self, target, msg):
-        self.cmd_queue.append(['PRIVMSG', target, msg])
+                return self.PING_TIMEOUT - lag
+
+    def send_privmsg(self, target, msg, priority=PRIORITY_NORMAL):
+        self.outbound.put(target, msg, priority)
+
+        try:
+            self.wakeup_w.send(b'\0')
+        except BlockingIOError:
+            # The loop already has plenty of wakeups pending
+            pass
@@ -0,0 +1,140 @@
+""" Write-ahead journal for events that can't be asked for again """
+import itertools
+import json
+import logging
+from threading import Condition, Thread
+import time
+
+
+class EventJournal(Thread):
+    """ Keeps events in sqlite from when they're queued until they have
+    been handled, so that they can be replayed after a crash.
+
+    append() returns once the event is committed, but all events appended
+    while a commit is in progress go into the next one together (group
+    commit), so a burst of events costs a few fsyncs rather than one
+    each. Acknowledgements are batched the same way, without waiting.
+    Delivery is at least once: an event handled just before a crash may
+    be replayed. """
+
+    # Seconds append() waits for a commit before giving up on it
+    APPEND_TIMEOUT = 10
+
+    def __init__(self, db, append_timeout=APPEND_TIMEOUT):
+        Thread.__init__(self, name='journal', daemon=True)
+
+        self.db = db
+        self.append_timeout = append_timeout
+        row = self.db.execute("select max(id) from event_journal").fetchone()
+        self.ids = itertools.count((row[0] or 0) + 1)
+
+        self.cond = Condition()
+        self.appends = []
+        self.acks = []
+        # Batches up to this one have been written (or failed)
+        self.batch = 0
+        self.written = -1
+        self.failed = set()
+        self.stopping = False
+
+    def append(self, event):
+        """ Returns the journal id once the event is on disk, or None if it
+        couldn't be written in time (it may still be, and then be
+        replayed after a restart) """
+        data = dict(event)
+        event_type = data.pop('event_type')
+
+        with self.cond:
+            if self.stopping:
+                return None
+
+            journal_id = next(self.ids)
+            self.appends.append((journal_id, event_type, json.dumps(data), time.time()))
+            batch = self.batch
+            self.cond.notify_all()
+
+            if not self.cond.wait_for(lambda: self.written >= batch,
+                                      self.append_timeout):
+                logging.error("Journal write of event %d timed out", journal_id)
+                return None
+
+            if batch in self.failed:
+                return None
+
+        return journal_id
+
+    def ack(self, journal_id):
+        with self.cond:
+            self.acks.append((journal_id,))
+            self.cond.notify_all()
+
+    def stop(self):
+        """ Writes what has been appended and acknowledged so far, and
+        waits for the writer thread to finish """
+        with self.cond:
+            self.stopping = True
+            self.cond.notify_all()
+
+        if self.is_alive():
+            self.join()
+
+    def pending(self):
+        """ The events not yet acknowledged, oldest first; call before
+        start() """
+        events = []
+        for (journal_id, event_type, data) in self.db.execute(
+                "select id, event_type, data from event_journal order by id"):
+            event = {'event_type': event_type}
+            event.update(json.loads(data))
+            event['journal_id'] = journal_id
+            events.append(event)
+
+        return events
+
+    def run(self):
+        # Only for this thread's connection; everything else can make do
+        # with the configured setting
+        try:
+            self.db.execute("pragma synchronous=full")
+        except Exception:
+            logging.exception("Failed to make the journal fully synchronous")
+
+        while True:
+            with self.cond:
+                while not self.appends and not self.acks and not self.stopping:
+                    self.cond.wait()
+
+                if not self.appends and not self.acks:
+                    break
+
+                (appends, self.appends) = (self.appends, [])
+                (acks, self.acks) = (self.acks, [])
+                batch = self.batch
+                self.batch += 1
+
+            # Appends coming in while this is written make up the next
+            # batch. Whatever happens, the appenders must be woken up.
+            ok = False
+            try:
+                self._write(appends, acks)
+                ok = True
+            except Exception:
+                logging.exception("Failed to write %d events to the journal", len(appends))
+            finally:
+                with self.cond:
+                    if not ok:
+                        self.failed.add(batch)
+                        # Only the latest few are ever looked at again
+                        self.failed.discard(batch - 100)
+                    self.written = batch
+                    self.cond.notify_all()
+
+        self.db.close()
+
+    def _write(self, appends, acks):
+        with self.db.transaction() as conn:
+            conn.executemany(
+                "insert into event_journal(id, event_type, data, created) values (?, ?, ?, ?)",
+                appends
+            )
+            conn.executemany("delete from event_journal where id = ?", acks)
@@ -0,0 +1,182 @@
+""" Simple thread-safe metrics, keyed by label values, and a registry
+rendering them in the Prometheus text format """
+from bisect import bisect_left
+import threading
+
+# Seconds; from a quick event handler to a slow OpenAI call
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Registry():
+    def __init__(self):
+        self.metrics = []
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+
+        return metric
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics)
+
+        lines = []
+        for metric in metrics:
+            lines.append('# HELP %s %s' % (metric.name, _escape(metric.help, False)))
+            lines.append('# TYPE %s %s' % (metric.name, metric.type))
+            lines.extend(metric.render())
+
+        return '\n'.join(lines) + '\n'
+
+
+class Counter():
+    """ Counts up; with func, the values are instead read from func(),
+    which returns {label values: value}, just a value, or None """
+
+    type = 'counter'
+
+    def __init__(self, name, help, labelnames=(), func=None):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.func = func
+
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, labels=(), value=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + value
+
+    def get(self, labels=()):
+        with self.lock:
+            return self.values.get(labels, 0)
+
+    def items(self):
+        """ Returns [(label values, value), ...] """
+        if self.func:
+            values = self.func()
+            if values is None:
+                # Nothing to report yet
+                values = {}
+            elif not isinstance(values, dict):
+                values = {(): values}
+            return sorted(values.items())
+
+        with self.lock:
+            if not self.labelnames and not self.values:
+                # Start out at zero, rather than missing
+                return [((), 0)]
+            return sorted(self.values.items())
+
+    def render(self):
+        return [
+            '%s%s %s' % (self.name, _labels(self.labelnames, labels), _value(value))
+            for (labels, value) in self.items()
+        ]
+
+
+class Gauge(Counter):
+    """ Like a Counter, but may also be set() to anything """
+
+    type = 'gauge'
+
+    def set(self, value, labels=()):
+        with self.lock:
+            self.values[labels] = value
+
+
+class Histogram():
+    """ Counts observations into cumulative buckets, like Prometheus does """
+
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = tuple(sorted(buckets))
+
+        # labels -> [count per bucket (the last one is +Inf), sum]
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, labels=()):
+        i = bisect_left(self.buckets, value)
+
+        with self.lock:
+            if labels not in self.values:
+                self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+
+            (counts, _sum) = self.values[labels]
+            counts[i] += 1
+            self.values[labels][1] += value
+
+    def get(self, labels=()):
+        """ Returns ([(upper bound, cumulative count), ...], sum, count) """
+        with self.lock:
+            if labels not in self.values:
+                return ([], 0.0, 0)
+
+            (counts, total) = self.values[labels]
+            counts = list(counts)
+
+        cumulative = []
+        count = 0
+        for (bound, n) in zip(self.buckets + (float('inf'),), counts):
+            count += n
+            cumulative.append((bound, count))
+
+        return (cumulative, total, count)
+
+    def labels(self):
+        with self.lock:
+            return sorted(self.values)
+
+    def render(self):
+        lines = []
+        for labels in self.labels():
+            (buckets, total, count) = self.get(labels)
+
+            for (bound, cumulative) in buckets:
+                lines.append('%s_bucket%s %d' % (
+                    self.name,
+                    _labels(self.labelnames + ('le',), labels + (_value(bound),)),
+                    cumulative
+                ))
+
+            lines.append('%s_sum%s %s' % (self.name, _labels(self.labelnames, labels),
+                                          _value(total)))
+            lines.append('%s_count%s %d' % (self.name, _labels(self.labelnames, labels),
+                                            count))
+
+        return lines
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, _escape(str(value), True))
+        for (name, value) in zip(names, values)
+    )
+
+
+def _value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+
+    return str(value)
+
+
+def _escape(text, quotes):
+    text = text.replace('\\', '\\\\').replace('\n', '\\n')
+    if quotes:
+        text = text.replace('"', '\\"')
+
+    return text
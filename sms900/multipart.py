@@ -0,0 +1,234 @@
+""" Streaming multipart/form-data parsing, for MMS from Mailgun """
+from datetime import datetime
+import io
+import logging
+import os
+from os import path
+import re
+
+CHUNK_SIZE = 64 * 1024
+MAX_HEADER_SIZE = 16 * 1024
+
+RE_BOUNDARY = re.compile(r'boundary="?([^";]+)"?', re.IGNORECASE)
+RE_NAME = re.compile(r'\bname="([^"]*)"', re.IGNORECASE)
+RE_FILENAME = re.compile(r'filename="([^"]*)"', re.IGNORECASE)
+
+
+class SMS900InvalidMultipart(Exception):
+    pass
+
+
+def get_boundary(content_type):
+    m = RE_BOUNDARY.search(content_type or '')
+    if not m:
+        raise SMS900InvalidMultipart("No boundary in Content-Type: %s" % content_type)
+
+    return m.group(1).encode('latin-1')
+
+
+def parse_multipart(stream, boundary, length, on_part, tee=None, chunk_size=CHUNK_SIZE):
+    """ Reads `length` bytes of multipart data from `stream` a chunk at a
+    time. For every part, on_part(headers) is called with a dict of
+    (lowercased) header names to values, and returns a file-like object
+    that the part's body is written to (and then closed), or None to skip
+    the part. Every chunk read is also passed to tee(), if given. Only a
+    chunk and a partial delimiter are ever kept in memory. """
+    delimiter = b'\r\n--' + boundary
+    # The first delimiter doesn't have to be preceded by a CRLF
+    buf = bytearray(b'\r\n')
+    state = 'preamble'
+    sink = None
+    remaining = length
+
+    try:
+        while True:
+            if remaining > 0:
+                chunk = stream.read(min(chunk_size, remaining))
+                if not chunk:
+                    raise SMS900InvalidMultipart("Body ended %d bytes early" % remaining)
+
+                remaining -= len(chunk)
+                if tee:
+                    tee(chunk)
+
+                if state == 'end':
+                    # Skip the epilogue
+                    continue
+                buf += chunk
+            elif state == 'end':
+                return
+            else:
+                raise SMS900InvalidMultipart("Body ended in the middle of a part")
+
+            progress = True
+            while progress:
+                (state, sink, progress) = _process(buf, delimiter, state, sink, on_part)
+    finally:
+        if sink:
+            sink.close()
+
+
+def _process(buf, delimiter, state, sink, on_part):
+    """ Consumes what it can from the start of buf; returns the new
+    (state, sink, whether anything was consumed) """
+    if state == 'preamble' or state == 'body':
+        i = buf.find(delimiter)
+        if i < 0:
+            # Keep what could be the start of a delimiter
+            keep = len(delimiter) - 1
+            if len(buf) > keep:
+                if sink:
+                    sink.write(bytes(buf[:len(buf) - keep]))
+                del buf[:len(buf) - keep]
+            return (state, sink, False)
+
+        if sink:
+            sink.write(bytes(buf[:i]))
+            sink.close()
+        del buf[:i + len(delimiter)]
+        return ('delimiter', None, True)
+
+    if state == 'delimiter':
+        if len(buf) < 2:
+            return (state, sink, False)
+        if buf[:2] == b'--':
+            return ('end', None, False)
+        if buf[:2] != b'\r\n':
+            raise SMS900InvalidMultipart("Garbage after boundary")
+
+        del buf[:2]
+        return ('headers', None, True)
+
+    if state == 'headers':
+        if buf.startswith(b'\r\n'):
+            # A part without any headers
+            del buf[:2]
+            return ('body', on_part({}), True)
+
+        i = buf.find(b'\r\n\r\n')
+        if i < 0:
+            if len(buf) > MAX_HEADER_SIZE:
+                raise SMS900InvalidMultipart("Part headers too large")
+            return (state, sink, False)
+
+        headers = {}
+        for line in bytes(buf[:i]).decode('utf-8', 'replace').split('\r\n'):
+            if ':' in line:
+                (name, value) = line.split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+
+        del buf[:i + 4]
+        return ('body', on_part(headers), True)
+
+    return (state, sink, False)
+
+
+class MMSPartStore():
+    """ on_part() for parse_multipart(): saves the texts and attachments of
+    a Mailgun MMS in save_path the way the indexer expects them, and keeps
+    the sender. """
+
+    TEXT_FIELDS = ['body-plain', 'subject']
+
+    def __init__(self, save_path):
+        self.save_path = save_path
+        self.sender = None
+        self.files = []
+        self.count = 0
+
+    def on_part(self, headers):
+        disposition = headers.get('content-disposition', '')
+
+        m = RE_NAME.search(disposition)
+        name = m.group(1) if m else None
+
+        if name == 'from':
+            return _TextPart(self._set_sender)
+
+        if name in self.TEXT_FIELDS:
+            return _TextPart(lambda text: self._save_text(name, text))
+
+        m = RE_FILENAME.search(disposition)
+        if m:
+            # Never trust the path part of a filename
+            basename = path.basename(m.group(1).replace('\\', '/')) or 'unnamed'
+            return self._open(self._next_filename(basename))
+
+        if 'content-type' in headers:
+            # Probably something we need to handle better, but
+            # let's just dump it in a file for now.
+            return self._open(self._next_filename('unknown'))
+
+        logging.info("Ignoring: %s", disposition)
+        return None
+
+    def _next_filename(self, name):
+        filename = path.join(self.save_path, '%d-%s' % (self.count, name))
+        self.count += 1
+        return filename
+
+    def _open(self, filename):
+        self.files.append(filename)
+        return open(filename, 'wb')
+
+    def _set_sender(self, text):
+        self.sender = text
+
+    def _save_text(self, name, text):
+        if not text.strip():
+            return
+
+        filename = self._next_filename('%s.txt' % name)
+        with open(filename, 'w') as f:
+            f.write(text)
+
+        self.files.append(filename)
+
+
+class _TextPart(io.BytesIO):
+    """ A small text field, handed to on_text() as a string when closed """
+    def __init__(self, on_text):
+        io.BytesIO.__init__(self)
+        self.on_text = on_text
+
+    def close(self):
+        if not self.closed:
+            self.on_text(self.getvalue().decode('utf-8', 'ignore'))
+        io.BytesIO.close(self)
+
+
+class RotatingCapture():
+    """ Saves raw requests for debugging in directory, keeping only the
+    `keep` latest ones """
+
+    def __init__(self, directory, keep=5):
+        self.directory = directory
+        self.keep = keep
+
+    def open(self, request_line, headers):
+        if not path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        self._rotate()
+
+        filename = path.join(self.directory, 'request-%s.txt' % (
+            datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+        ))
+        logging.info("Saving debug data to %s", filename)
+
+        f = open(filename, 'wb')
+        f.write(("%s\n" % request_line).encode('utf-8', 'ignore'))
+        for (name, value) in headers.items():
+            f.write(("%s: %s\n" % (name, value)).encode('utf-8', 'ignore'))
+        f.write(b"\n")
+
+        return f
+
+    def _rotate(self):
+        captures = sorted(
+            name for name in os.listdir(self.directory)
+            if name.startswith('request-')
+        )
+
+        for name in captures[:max(len(captures) - self.keep + 1, 0)]:
+            os.remove(path.join(self.directory, name))
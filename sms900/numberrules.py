@@ -0,0 +1,114 @@
+""" Phone number canonicalization to E.164 """
+from functools import lru_cache
+import logging
+import re
+
+
+class SMS900InvalidNumberFormatException(Exception):
+    """ Simple exception to use for invalid number inputs"""
+    pass
+
+
+class NumberRule():
+    """ How numbers are written nationally in one region: the country code,
+    the trunk prefix dialled before national numbers (if any) and a pattern
+    for the national significant number (the mobile ranges, as this is
+    about SMS). """
+
+    def __init__(self, country_code, trunk_prefix, national_pattern,
+                 international_prefix='00'):
+        self.country_code = country_code
+        self.trunk_prefix = trunk_prefix
+        self.international_prefix = international_prefix
+
+        self.re_national = re.compile(r'^%s(%s)$' % (
+            re.escape(trunk_prefix), national_pattern
+        ))
+        # e.g. +46 (0)70..., where the trunk prefix shouldn't be
+        self.re_misdialled = re.compile(r'^\+%s%s(%s)$' % (
+            country_code, re.escape(trunk_prefix), national_pattern
+        )) if trunk_prefix else None
+
+
+RULES = {
+    'SE': NumberRule('46', '0', r'7\d{8}'),
+    'NO': NumberRule('47', '', r'[49]\d{7}'),
+    'DK': NumberRule('45', '', r'[2-9]\d{7}'),
+    'FI': NumberRule('358', '0', r'4\d{6,9}|50\d{4,8}'),
+    'DE': NumberRule('49', '0', r'1[5-7]\d{8,9}'),
+    'NL': NumberRule('31', '0', r'6\d{8}'),
+    'FR': NumberRule('33', '0', r'[67]\d{8}'),
+    'GB': NumberRule('44', '0', r'7\d{9}'),
+    'US': NumberRule('1', '', r'[2-9]\d{2}[2-9]\d{6}', international_prefix='011'),
+}
+
+RE_PUNCTUATION = re.compile(r'[\s().\-/]')
+RE_E164 = re.compile(r'^\+[1-9]\d{6,14}$')
+
+
+class NumberCanonicalizer():
+    """ Turns '+46 70-000 00 01', '0046700000001' or, with the default
+    region SE, '0700000001' into '+46700000001'.
+
+    International numbers are accepted for any country as long as they're
+    valid E.164; national numbers only in the default region. Results are
+    cached, as the same few numbers are seen over and over again. """
+
+    def __init__(self, default_region='SE', rules=None, cache_size=1024):
+        self.rules = dict(RULES)
+        if rules:
+            self.rules.update(rules)
+
+        if default_region not in self.rules:
+            raise SMS900InvalidNumberFormatException(
+                "No number rules for region %s" % default_region
+            )
+
+        self.default_rule = self.rules[default_region]
+        self.canonicalize = lru_cache(maxsize=cache_size)(self._canonicalize)
+
+    @classmethod
+    def from_config(cls, config):
+        """ Takes number_default_region and number_regions, e.g.
+        {"XX": {"country_code": "999", "trunk_prefix": "0",
+                "national_pattern": "9\\\\d{7}"}} """
+        rules = {}
+        regions = config['number_regions'] if 'number_regions' in config else {}
+        for (region, rule) in regions.items():
+            rules[region] = NumberRule(
+                rule['country_code'],
+                rule['trunk_prefix'] if 'trunk_prefix' in rule else '',
+                rule['national_pattern'],
+                rule['international_prefix'] if 'international_prefix' in rule else '00'
+            )
+
+        return cls(
+            config['number_default_region'] if 'number_default_region' in config else 'SE',
+            rules
+        )
+
+    def _canonicalize(self, number):
+        stripped = RE_PUNCTUATION.sub('', number)
+
+        rule = self.default_rule
+        if rule.international_prefix and stripped.startswith(rule.international_prefix):
+            stripped = '+' + stripped[len(rule.international_prefix):]
+
+        if stripped.startswith('+'):
+            for other in self.rules.values():
+                m = other.re_misdialled.match(stripped) if other.re_misdialled else None
+                if m:
+                    stripped = '+%s%s' % (other.country_code, m.group(1))
+                    break
+
+            if RE_E164.match(stripped):
+                logging.debug('number %s canonicalized as %s', number, stripped)
+                return stripped
+        else:
+            m = rule.re_national.match(stripped)
+            if m:
+                canonicalized = '+%s%s' % (rule.country_code, m.group(1))
+                logging.debug('number %s canonicalized as %s', number, canonicalized)
+                return canonicalized
+
+        raise SMS900InvalidNumberFormatException("%s is not a valid number" % number)
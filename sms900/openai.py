@@ -1,7 +1,69 @@
+from collections import OrderedDict
 from datetime import datetime
+import functools
+import hashlib
 import logging
 import openai
 import re
+import threading
+import time
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+def estimate_tokens(text):
+    """ Rough token count for when no real tokenizer is available """
+    return len(text) // 4 + 1
+
+class ResponseCache():
+    """ Thread-safe LRU cache with a time to live for each entry """
+    def __init__(self, size, ttl, clock=time.monotonic):
+        self.size = size
+        self.ttl = ttl
+        self.clock = clock
+
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                (expires, value) = self.entries[key]
+                if expires > self.clock():
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+
+                del self.entries[key]
+
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (self.clock() + self.ttl, value)
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def flush(self):
+        with self.lock:
+            count = len(self.entries)
+            self.entries.clear()
+            return count
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+            }
 
 class OpenAI():
     def __init__(self, config):
@@ -16,6 +78,28 @@ class OpenAI():
         self.override_prompt = None
         self.override_chat_model = None
 
+        # The prompt (instructions + history) is kept within this many tokens
+        self.token_budget = config['openai_prompt_token_budget'] if 'openai_prompt_token_budget' in config else 3000
+        self.count_tokens = self._get_default_tokenizer()
+        self.last_prompt_stats = None
+
+        # Optionally answer (nearly) identical prompts from a cache
+        cache_size = config['openai_cache_size'] if 'openai_cache_size' in config else 0
+        self.cache = ResponseCache(
+            cache_size,
+            config['openai_cache_ttl'] if 'openai_cache_ttl' in config else 600
+        ) if cache_size > 0 else None
+        self.cache_context = config['openai_cache_context'] if 'openai_cache_context' in config else 3
+
+        self._format_line = functools.lru_cache(maxsize=2048)(self._format_line)
+        self._get_instructions = functools.lru_cache(maxsize=16)(self._get_instructions)
+
+    def set_tokenizer(self, count_tokens):
+        """ count_tokens(text) -> number of tokens """
+        self.count_tokens = count_tokens
+        self._format_line.cache_clear()
+        self._get_instructions.cache_clear()
+
     def set_prompt(self, prompt):
         self.override_prompt = prompt
 
@@ -23,6 +107,13 @@ class OpenAI():
         self.override_chat_model = model
 
     def generate_response(self, channel, my_nickname, history):
+        cache_key = self.get_cache_key(channel, history)
+        if cache_key:
+            response = self.cache.get(cache_key)
+            if response:
+                logging.info("Completion cache hit for %s", channel)
+                return response
+
         prompt = self.generate_prompt(channel, my_nickname, history)
 
         try:
@@ -31,14 +122,168 @@ class OpenAI():
             else:
                 completion = self.complete_prompt(prompt)
 
-            return self.strip_imaginary_response(
+            response = self.strip_imaginary_response(
                 self.splitlong(completion)
             )
         except Exception as err:
             logging.info("Failed to create completion: %s", err)
             return None
 
+        if cache_key and response:
+            self.cache.put(cache_key, response)
+
+        return response
+
+    def get_cache_key(self, channel, history):
+        """ Hash of the model, the prompt override and the last few
+        history events, ignoring timestamps, case and whitespace. """
+        if not self.cache:
+            return None
+
+        events = [h for h in history if h['channel'] == channel]
+        events = events[-self.cache_context:] if self.cache_context > 0 else []
+
+        key = [
+            self.override_chat_model if self.override_chat_model else self.config_chat_model,
+            self.override_prompt if self.override_prompt else "",
+        ]
+        for h in events:
+            key.append("%s/%s/%s" % (
+                h['type'],
+                h['nickname'],
+                " ".join(h['msg'].lower().split())
+            ))
+
+        return hashlib.sha256("\0".join(str(k) for k in key).encode('utf-8')).hexdigest()
+
+    def generate_response_stream(self, channel, my_nickname, history, on_line):
+        """ Like generate_response, but calls on_line(line) for every line
+        of the response as soon as it's complete. Returns the whole
+        response (or what was received before an error). """
+        cache_key = self.get_cache_key(channel, history)
+        if cache_key:
+            response = self.cache.get(cache_key)
+            if response:
+                logging.info("Completion cache hit for %s", channel)
+                for line in response.split("\n"):
+                    on_line(line)
+                return response
+
+        prompt = self.generate_prompt(channel, my_nickname, history)
+        lines = []
+
+        def emit(line):
+            lines.append(line)
+            on_line(line)
+
+        try:
+            if self.config_use_chat:
+                pieces = self.stream_prompt_chat(prompt)
+            else:
+                pieces = self.stream_prompt(prompt)
+
+            self.stream_lines(pieces, emit)
+        except Exception as err:
+            logging.info("Failed to stream completion: %s", err)
+            # Don't cache partial responses
+            cache_key = None
+
+        response = "\n".join(lines) if lines else None
+        if cache_key and response:
+            self.cache.put(cache_key, response)
+
+        return response
+
+    def stream_lines(self, pieces, on_line):
+        """ Splits a stream of text pieces into lines no longer than
+        max_line_length bytes, and stops at an imaginary response from
+        someone else (see strip_imaginary_response). """
+        buffer = ""
+        emitted = False
+        line_start = True
+
+        for piece in pieces:
+            if not piece:
+                continue
+
+            buffer += piece
+
+            while True:
+                if "\n" in buffer:
+                    (line, buffer) = buffer.split("\n", 1)
+                    complete = True
+                elif len(buffer.encode('UTF-8', 'ignore')) > self.max_line_length:
+                    parts = self.splitlong(buffer).split("\n")
+                    if len(parts) < 2:
+                        break
+                    (line, buffer) = (parts[0], "\n".join(parts[1:]))
+                    complete = False
+                else:
+                    break
+
+                if line_start:
+                    if emitted and re.match(r'<[-_a-zA-Z0-9]+>', line):
+                        return
+                    # Like the .strip() of the non-streaming completion
+                    if not emitted and not line.strip():
+                        continue
+
+                on_line(line)
+                emitted = True
+                line_start = complete
+
+        if buffer.strip() and not (line_start and emitted
+                                   and re.match(r'<[-_a-zA-Z0-9]+>', buffer)):
+            on_line(buffer.rstrip())
+
     def generate_prompt(self, channel, my_nickname, history):
+        (instructions, instructions_tokens) = self._get_instructions(
+            channel,
+            my_nickname,
+            self.override_prompt if self.override_prompt else self.config_prompt
+        )
+
+        (last_line, last_line_tokens) = self._format_line(
+            "irc",
+            datetime.now().astimezone().replace(microsecond=0),
+            my_nickname,
+            "",
+            last=True
+        )
+
+        # Take as many of the latest events as fit in the budget
+        remaining = self.token_budget - instructions_tokens - last_line_tokens
+        candidates = [h for h in history if h['channel'] == channel]
+        lines = []
+
+        for h in reversed(candidates):
+            (line, tokens) = self._format_line(
+                h['type'], h['timestamp'], h['nickname'], h['msg']
+            )
+            if tokens > remaining:
+                break
+
+            lines.append(line)
+            remaining -= tokens
+
+        lines.reverse()
+
+        self.last_prompt_stats = {
+            'tokens': self.token_budget - remaining,
+            'events': len(lines),
+            'candidates': len(candidates),
+            'budget': self.token_budget,
+        }
+        logging.info("Prompt for %s: %d tokens, %d/%d history events (budget %d)",
+                     channel,
+                     self.last_prompt_stats['tokens'],
+                     len(lines),
+                     len(candidates),
+                     self.token_budget)
+
+        return instructions + "\n\n" + "".join(lines) + last_line
+
+    def _get_instructions(self, channel, my_nickname, custom_prompt):
         chat_instructions = (
             "Your repsonses usually fit on a line, but you can use multiple lines when for example generating code. "
             + "You never include \"<{nick}>\" in your completion. "
@@ -54,25 +299,35 @@ class OpenAI():
             + "Commands cannot be nested; for example you cannot include an SMS command inside a REMINDER command. "
             + "You only send/set or even talk about SMS/reminders when someone explicitly asks you to. "
             + (chat_instructions if self.config_use_chat else "")
-            + (self.override_prompt if self.override_prompt else self.config_prompt)
+            + custom_prompt
         ).format(channel=channel, nick=my_nickname).strip()
 
-        prompt += "\n\n"
+        return (prompt, self.count_tokens(prompt + "\n\n"))
 
-        for h in history:
-            if h['channel'] != channel:
-                continue
+    def _format_line(self, type, timestamp, nickname, msg, last=False):
+        line = self.format_event({
+            'type': type,
+            'timestamp': timestamp,
+            'nickname': nickname,
+            'msg': msg,
+        })
 
-            prompt += self.format_event(h) + "\n"
+        # Every line but the last, unfinished one ends with a newline
+        if not last:
+            line += "\n"
 
-        prompt += self.format_event({
-            "type": "irc",
-            "timestamp": datetime.now().astimezone(),
-            "nickname": my_nickname,
-            "msg": "",
-        })
+        return (line, self.count_tokens(line))
+
+    def _get_default_tokenizer(self):
+        if not tiktoken:
+            return estimate_tokens
+
+        try:
+            encoding = tiktoken.encoding_for_model(self.config_chat_model)
+        except KeyError:
+            encoding = tiktoken.get_encoding("cl100k_base")
 
-        return prompt
+        return lambda text: len(encoding.encode(text))
 
     def format_event(self, e):
         time = e['timestamp'].strftime("%Y-%m-%d %H:%M:%S %Z")
@@ -108,6 +363,29 @@ class OpenAI():
 
         return completion.choices[0].message.content.strip()
 
+    def stream_prompt(self, prompt):
+        for chunk in openai.Completion.create(
+            engine=self.config_engine,
+            prompt=prompt,
+            stop=['<'],
+            temperature=0.7,
+            max_tokens=256,
+            stream=True,
+        ):
+            yield chunk.choices[0].text
+
+    def stream_prompt_chat(self, prompt):
+        model = self.override_chat_model if self.override_chat_model else self.config_chat_model
+        for chunk in openai.ChatCompletion.create(
+            model=model,
+            messages=[{
+                "role": "user",
+                "content": prompt
+            }],
+            stream=True,
+        ):
+            yield chunk.choices[0].delta.get('content')
+
     def strip_imaginary_response(self, text):
         m = re.match(r'(.+)\n<[-_a-zA-Z0-9]+>', text, re.M|re.S)
         if m:
@@ -5,116 +5,281 @@ import sqlite3
 class SMS900InvalidAddressbookEntry(Exception):
     pass
 
+RE_NICKNAME = re.compile(r'^([a-zA-Z][a-zA-Z0-9{}[\]\\`^-]{0,15})$')
+RE_EMAIL = re.compile('.+@.+')
+
 class PhoneBook:
-    def __init__(self, dbconn):
-        self.dbconn = dbconn
+    """ The numbers and emails are also kept in memory, so that lookups
+    never touch the database. Every change goes through this class, which
+    writes it to the database first and then to the cache. """
+
+    def __init__(self, db):
+        self.db = db
+
+        self.numbers = {}    # nickname -> number
+        self.nicknames = {}  # number -> nickname
+        self.emails = {}     # lowercased email -> nickname
+        self._load()
+
+    def _load(self):
+        for (nickname, number) in self.db.execute('select nickname, number from phonebook'):
+            self.numbers[nickname] = number
+            self.nicknames[number] = nickname
+
+        for (email, nickname) in self.db.execute('select email, nickname from phonebook_email'):
+            self.emails[email.lower()] = nickname
 
     def add_number(self, nickname, number):
         nickname = self._get_valid_nickname(nickname)
 
         # Assume number has been canonicalized
         try:
-            c = self.dbconn.cursor()
-            c.execute('insert into phonebook(nickname, number) values (?,?)', (nickname, number))
+            self.db.execute('insert into phonebook(nickname, number) values (?,?)', (nickname, number))
         except sqlite3.IntegrityError as e:
             raise SMS900InvalidAddressbookEntry("%s or %s already added (probably: %s)" % (nickname, number, e))
         except Exception as e:
             raise SMS900InvalidAddressbookEntry(e)
 
+        self.numbers[nickname] = number
+        self.nicknames[number] = nickname
+
     def add_email(self, nickname, email):
         nickname = self._get_valid_nickname(nickname)
         email = self._get_valid_email(email)
 
         try:
-            c = self.dbconn.cursor()
-            c.execute('insert into phonebook_email(nickname, email) values (?, ?)', (nickname, email))
+            self.db.execute('insert into phonebook_email(nickname, email) values (?, ?)', (nickname, email))
         except sqlite3.IntegrityError as e:
             raise SMS900InvalidAddressbookEntry("Email already added (probably: %s)" % (e))
         except Exception as e:
             raise SMS900InvalidAddressbookEntry(e)
 
+        self.emails[email.lower()] = nickname
+
     def get_number(self, nickname):
+        number = self.numbers.get(nickname.lower())
+        if number:
+            return number
+
         nickname = self._get_valid_nickname(nickname)
+        raise SMS900InvalidAddressbookEntry("nickname %s is not in my phone book" % nickname)
 
-        try:
-            c = self.dbconn.cursor()
-            number = None
-            for row in c.execute('select number from phonebook where nickname = ?', (nickname, )):
-                number = row[0]
+    def get_nickname(self, number):
+        nickname = self.nicknames.get(number)
+        if nickname:
+            return nickname
 
-            if number:
-                return number
+        raise SMS900InvalidAddressbookEntry("number %s is not in my phone book" % number)
+
+    def get_nickname_from_email(self, email):
+        nickname = self.emails.get(email.lower())
+        if nickname:
+            return nickname
+
+        raise SMS900InvalidAddressbookEntry("The email %s is not in my phone book" % email)
 
-            raise SMS900InvalidAddressbookEntry("nickname %s is not in my phone book" % nickname)
+    def del_entry(self, nickname):
+        nickname = self._get_valid_nickname(nickname)
 
+        # Assume that the entry exists if this function is called
+        try:
+            self.db.execute("delete from phonebook where nickname = ?", (nickname, ))
         except Exception as e:
             raise SMS900InvalidAddressbookEntry(e)
 
-    def get_nickname(self, number):
+        number = self.numbers.pop(nickname, None)
+        if number:
+            self.nicknames.pop(number, None)
+
+    def del_email(self, email):
+        email = self._get_valid_email(email)
+
         try:
-            c = self.dbconn.cursor()
-            nickname = None
-            for row in c.execute('select nickname from phonebook where number = ?', (number, )):
-                nickname = row[0]
+            self.db.execute("delete from phonebook_email where email = ?", (email, ))
+        except Exception as e:
+            raise SMS900InvalidAddressbookEntry(e)
+
+        self.emails.pop(email.lower(), None)
+
+    def import_entries(self, contacts):
+        """ Adds [{'nickname', 'number', 'emails'}, ...] (numbers already
+        canonicalized) in a single transaction. Contacts that clash with
+        existing entries, or with each other, are skipped and reported.
+
+        Returns {'added': n, 'unchanged': n, 'conflicts': [{'nickname', 'reason'}, ...]}
+        """
+        numbers = {}    # number -> nickname
+        numbered = set()
+        emails = {}
+        report = {'added': 0, 'unchanged': 0, 'conflicts': []}
 
-            if nickname:
-                return nickname
+        def conflict(nickname, reason):
+            report['conflicts'].append({'nickname': nickname, 'reason': reason})
 
-            raise SMS900InvalidAddressbookEntry("number %s is not in my phone book" % number)
+        for contact in contacts:
+            try:
+                nickname = self._get_valid_nickname(contact['nickname'])
+            except SMS900InvalidAddressbookEntry as e:
+                conflict(contact['nickname'], str(e))
+                continue
 
+            number = contact['number']
+            if not number and not contact['emails']:
+                conflict(nickname, "No number or email")
+                continue
+
+            added = False
+            conflicts = len(report['conflicts'])
+            if number:
+                owner = self.nicknames.get(number) or numbers.get(number)
+                current = self.numbers.get(nickname)
+
+                if current == number:
+                    pass
+                elif current or nickname in numbered:
+                    conflict(nickname, "%s already has a number" % nickname)
+                    continue
+                elif owner:
+                    conflict(nickname, "%s already belongs to %s" % (number, owner))
+                    continue
+                else:
+                    numbers[number] = nickname
+                    numbered.add(nickname)
+                    added = True
+
+            for email in contact['emails']:
+                try:
+                    email = self._get_valid_email(email)
+                except SMS900InvalidAddressbookEntry as e:
+                    conflict(nickname, str(e))
+                    continue
+
+                owner = self.emails.get(email.lower()) or emails.get(email.lower())
+                if owner == nickname:
+                    continue
+                if owner:
+                    conflict(nickname, "%s already belongs to %s" % (email, owner))
+                    continue
+
+                emails[email.lower()] = nickname
+                added = True
+
+            if added:
+                report['added'] += 1
+            elif conflicts == len(report['conflicts']):
+                report['unchanged'] += 1
+
+        try:
+            with self.db.transaction() as conn:
+                conn.executemany('insert into phonebook(nickname, number) values (?, ?)',
+                                 [(nickname, number) for (number, nickname) in numbers.items()])
+                conn.executemany('insert into phonebook_email(nickname, email) values (?, ?)',
+                                 [(nickname, email) for (email, nickname) in emails.items()])
         except Exception as e:
             raise SMS900InvalidAddressbookEntry(e)
 
-    def get_nickname_from_email(self, email):
-        try:
-            c = self.dbconn.cursor()
-            c.execute('select nickname from phonebook_email where email = ?', (email, ))
-            result = c.fetchone()
+        for (number, nickname) in numbers.items():
+            self.numbers[nickname] = number
+            self.nicknames[number] = nickname
+        self.emails.update(emails)
+
+        return report
+
+    def get_entries(self):
+        """ Returns [(nickname, number or None, [email, ...]), ...] sorted by
+        nickname """
+        numbers = dict(self.numbers)
+        emails = {}
+        for (email, nickname) in list(self.emails.items()):
+            emails.setdefault(nickname, []).append(email)
+
+        return [
+            (nickname, numbers.get(nickname), sorted(emails.get(nickname, [])))
+            for nickname in sorted(set(numbers) | set(emails))
+        ]
 
-            if result:
-                return result[0]
+    def add_to_group(self, group, nicknames):
+        group = self._get_valid_nickname(group)
+        nicknames = [self._get_valid_nickname(n) for n in nicknames]
 
-            raise SMS900InvalidAddressbookEntry("The email %s is not in my phone book" % email)
+        for nickname in nicknames:
+            # Only contacts with a number can receive group messages
+            self.get_number(nickname)
 
+        try:
+            self.db.executemany(
+                'insert or ignore into phonebook_group(group_name, nickname) values (?, ?)',
+                [(group, nickname) for nickname in nicknames]
+            )
         except Exception as e:
             raise SMS900InvalidAddressbookEntry(e)
 
-    def del_entry(self, nickname):
-        nickname = self._get_valid_nickname(nickname)
+    def del_from_group(self, group, nicknames=None):
+        """ Removes the given members, or the whole group. Returns the number
+        of removed members. """
+        group = self._get_valid_nickname(group)
 
-        # Assume that the entry exists if this function is called
         try:
-            c = self.dbconn.cursor()
-            c.execute("delete from phonebook where nickname = ?", (nickname, ))
+            if nicknames:
+                c = self.db.executemany(
+                    'delete from phonebook_group where group_name = ? and nickname = ?',
+                    [(group, self._get_valid_nickname(n)) for n in nicknames]
+                )
+            else:
+                c = self.db.execute('delete from phonebook_group where group_name = ?', (group, ))
+
+            return c.rowcount
+        except SMS900InvalidAddressbookEntry:
+            raise
         except Exception as e:
             raise SMS900InvalidAddressbookEntry(e)
 
-    def del_email(self, email):
-        email = self._get_valid_email(email)
+    def get_groups(self):
+        """ Returns {group: [nickname, ...]} """
+        try:
+            groups = {}
+            for row in self.db.execute('select group_name, nickname from phonebook_group order by group_name, nickname'):
+                groups.setdefault(row[0], []).append(row[1])
+
+            return groups
+        except Exception as e:
+            raise SMS900InvalidAddressbookEntry(e)
+
+    def get_group_numbers(self, group):
+        """ Returns [(nickname, number), ...] for every member of the group;
+        number is None for members that have since been removed from the
+        phone book. """
+        group = self._get_valid_nickname(group)
 
         try:
-            c = self.dbconn.cursor()
-            c.execute("delete from phonebook_email where email = ?", (email, ))
+            members = self.db.execute(
+                'select g.nickname, p.number from phonebook_group g'
+                ' left join phonebook p on p.nickname = g.nickname'
+                ' where g.group_name = ? order by g.nickname',
+                (group, )
+            ).fetchall()
         except Exception as e:
             raise SMS900InvalidAddressbookEntry(e)
 
+        if not members:
+            raise SMS900InvalidAddressbookEntry("group %s is not in my phone book" % group)
+
+        return members
 
     def _get_valid_nickname(self, nickname):
-        re_nickname = r'^([a-zA-Z][a-zA-Z0-9{}[\]\\`^-]{0,15})$'
-        m = re.match(re_nickname, nickname)
+        m = RE_NICKNAME.match(nickname)
         if not m:
             raise SMS900InvalidAddressbookEntry(
-                f"Invalid nickname: {nickname} (Should match {re_nickname})"
+                f"Invalid nickname: {nickname} (Should match {RE_NICKNAME.pattern})"
             )
 
         return m.group(1).lower()
 
     def _get_valid_email(self, email):
-        re_email = '.+@.+'
-        m = re.match(re_email, email)
+        m = RE_EMAIL.match(email)
         if not m:
             raise SMS900InvalidAddressbookEntry(
-                "Invalid email: %s (Should match %s)" % (email, re_email)
+                "Invalid email: %s (Should match %s)" % (email, RE_EMAIL.pattern)
             )
 
         return email
@@ -0,0 +1,195 @@
+""" vCard and CSV import/export for the phone book """
+import csv
+import io
+import re
+
+FORMATS = ['csv', 'vcf']
+
+RE_NICKNAME_CHARS = re.compile(r'[^a-zA-Z0-9{}[\]\\`^-]')
+RE_NUMBER_PUNCTUATION = re.compile(r'[\s().-]')
+
+
+class SMS900InvalidImport(Exception):
+    pass
+
+
+def guess_format(data):
+    if data.lstrip().upper().startswith('BEGIN:VCARD'):
+        return 'vcf'
+
+    return 'csv'
+
+
+def parse_contacts(data, format=None):
+    """ Returns [{'nickname': ..., 'number': ... or None, 'emails': [...]}, ...]
+
+    Numbers are only stripped of punctuation; canonicalizing them is up to
+    the caller. """
+    if not format:
+        format = guess_format(data)
+
+    if format == 'vcf':
+        return parse_vcards(data)
+    if format == 'csv':
+        return parse_csv(data)
+
+    raise SMS900InvalidImport("Unknown format: %s (expected one of %s)" % (
+        format, ', '.join(FORMATS)
+    ))
+
+
+def parse_csv(data):
+    """ Needs a header row with a nickname column and a number and/or email
+    column. Several emails may be separated by ';'. """
+    reader = csv.DictReader(io.StringIO(data))
+    if not reader.fieldnames:
+        return []
+
+    columns = {name.strip().lower(): name for name in reader.fieldnames}
+    if 'nickname' not in columns or ('number' not in columns and 'email' not in columns):
+        raise SMS900InvalidImport("CSV needs a header with nickname and number/email columns")
+
+    contacts = []
+    for row in reader:
+        number = row.get(columns.get('number')) or ''
+        emails = row.get(columns.get('email')) or ''
+
+        contacts.append({
+            'nickname': (row[columns['nickname']] or '').strip(),
+            'number': _clean_number(number),
+            'emails': [e.strip() for e in emails.split(';') if e.strip()],
+        })
+
+    return contacts
+
+
+def parse_vcards(data):
+    contacts = []
+    card = None
+
+    for (name, params, value) in _read_vcard_properties(data):
+        if name == 'BEGIN' and value.upper() == 'VCARD':
+            card = {'nickname': None, 'fn': None, 'numbers': [], 'emails': [],
+                    'preferred': False}
+        elif name == 'END' and card is not None:
+            contacts.append(_get_vcard_contact(card))
+            card = None
+        elif card is None:
+            continue
+        elif name == 'NICKNAME':
+            card['nickname'] = value.split(',')[0]
+        elif name == 'FN':
+            card['fn'] = value
+        elif name == 'TEL':
+            number = re.sub(r'^tel:', '', value, flags=re.IGNORECASE)
+            # The preferred (or else a cell) number goes first
+            if 'PREF' in params or 'PREF=1' in params:
+                card['numbers'].insert(0, number)
+                card['preferred'] = True
+            elif 'CELL' in params and not card['preferred']:
+                card['numbers'].insert(0, number)
+            else:
+                card['numbers'].append(number)
+        elif name == 'EMAIL':
+            card['emails'].append(value)
+
+    return contacts
+
+
+def _get_vcard_contact(card):
+    nickname = card['nickname'] or card['fn'] or ''
+    if not card['nickname']:
+        # Turn a full name into something usable as a nickname
+        nickname = RE_NICKNAME_CHARS.sub('', nickname.split(' ')[0])[:16]
+
+    return {
+        'nickname': nickname.strip(),
+        'number': _clean_number(card['numbers'][0]) if card['numbers'] else None,
+        'emails': card['emails'],
+    }
+
+
+def _read_vcard_properties(data):
+    """ Yields (NAME, {PARAM, ...}, value) for every (unfolded) line """
+    lines = []
+    for line in data.splitlines():
+        if line[:1] in (' ', '\t') and lines:
+            lines[-1] += line[1:]
+        elif line.strip():
+            lines.append(line)
+
+    for line in lines:
+        if ':' not in line:
+            continue
+
+        (key, value) = line.split(':', 1)
+        parts = key.split(';')
+        # Drop any group prefix (item1.TEL)
+        name = parts[0].split('.')[-1].upper()
+
+        params = set()
+        for param in parts[1:]:
+            param = param.upper()
+            if param.startswith('TYPE='):
+                params.update(param[len('TYPE='):].split(','))
+            else:
+                params.add(param)
+
+        value = value.replace('\\n', '\n').replace('\\N', '\n')
+        value = re.sub(r'\\([,;\\])', r'\1', value)
+
+        yield (name, params, value.strip())
+
+
+def _clean_number(number):
+    number = RE_NUMBER_PUNCTUATION.sub('', number or '')
+    return number or None
+
+
+def export_csv(entries):
+    """ Yields the CSV export of [(nickname, number, [email, ...]), ...]
+    one line at a time """
+    buf = io.StringIO()
+    writer = csv.writer(buf, lineterminator='\r\n')
+
+    writer.writerow(['nickname', 'number', 'email'])
+    for (nickname, number, emails) in entries:
+        writer.writerow([nickname, number or '', ';'.join(emails)])
+
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+
+    yield buf.getvalue()
+
+
+def export_vcards(entries):
+    for (nickname, number, emails) in entries:
+        lines = [
+            'BEGIN:VCARD',
+            'VERSION:3.0',
+            'FN:%s' % _escape_vcard(nickname),
+            'NICKNAME:%s' % _escape_vcard(nickname),
+        ]
+        if number:
+            lines.append('TEL;TYPE=CELL:%s' % number)
+        for email in emails:
+            lines.append('EMAIL:%s' % _escape_vcard(email))
+        lines.append('END:VCARD')
+
+        yield '\r\n'.join(lines) + '\r\n'
+
+
+def export_contacts(entries, format):
+    if format == 'vcf':
+        return export_vcards(entries)
+    if format == 'csv':
+        return export_csv(entries)
+
+    raise SMS900InvalidImport("Unknown format: %s (expected one of %s)" % (
+        format, ', '.join(FORMATS)
+    ))
+
+
+def _escape_vcard(value):
+    return re.sub(r'([,;\\])', r'\\\1', value)
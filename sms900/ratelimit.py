@@ -0,0 +1,47 @@
+""" Rate limiting helpers """
+import threading
+import time
+
+
+class TokenBucket():
+    """ Thread-safe token bucket: `rate` tokens per second are added, up to
+    `burst` tokens. Taking more tokens than the burst size is allowed once
+    the bucket is full; the bucket then goes into debt. """
+
+    def __init__(self, rate, burst=None, clock=time.monotonic):
+        self.rate = float(rate)
+        self.burst = float(burst) if burst else max(self.rate, 1.0)
+        self.clock = clock
+
+        self.tokens = self.burst
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def try_acquire(self, tokens=1):
+        with self.lock:
+            self._refill()
+
+            if self.tokens < min(tokens, self.burst):
+                return False
+
+            self.tokens -= tokens
+            return True
+
+    def delay(self, tokens=1):
+        """ Seconds until try_acquire(tokens) would succeed """
+        with self.lock:
+            self._refill()
+
+            missing = min(tokens, self.burst) - self.tokens
+            return max(missing / self.rate, 0.0)
+
+    def acquire(self, tokens=1):
+        """ Block until the tokens could be taken """
+        while not self.try_acquire(tokens):
+            time.sleep(self.delay(tokens))
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
@@ -0,0 +1,217 @@
+""" Recurring schedules for reminders """
+from datetime import datetime, timedelta
+import re
+
+class SMS900InvalidRecurrence(Exception):
+    pass
+
+WEEKDAYS = {
+    'mon': 0, 'monday': 0,
+    'tue': 1, 'tuesday': 1,
+    'wed': 2, 'wednesday': 2,
+    'thu': 3, 'thursday': 3,
+    'fri': 4, 'friday': 4,
+    'sat': 5, 'saturday': 5,
+    'sun': 6, 'sunday': 6,
+}
+
+UNITS = {
+    'm': 60, 'min': 60, 'mins': 60, 'minute': 60, 'minutes': 60,
+    'h': 3600, 'hour': 3600, 'hours': 3600,
+    'd': 86400, 'day': 86400, 'days': 86400,
+    'w': 604800, 'week': 604800, 'weeks': 604800,
+}
+
+RE_DURATION = re.compile(r'^(\d+)?\s*([a-z]+)$')
+RE_TIME = re.compile(r'^(\d{1,2})(?::(\d{2}))?\s*(am|pm)?$')
+RE_CRON_FIELD = re.compile(r'^[\d*,/-]+$')
+
+# How far ahead to look for the next match of a schedule
+MAX_DAYS = 366 * 5
+
+
+def parse_duration(text):
+    """ '10m', '2 hours', 'day', ... -> seconds """
+    m = RE_DURATION.match(text.strip().lower())
+    if not m or m.group(2) not in UNITS:
+        raise SMS900InvalidRecurrence("Invalid duration: %s" % text)
+
+    count = int(m.group(1)) if m.group(1) else 1
+    if count < 1:
+        raise SMS900InvalidRecurrence("Invalid duration: %s" % text)
+
+    return count * UNITS[m.group(2)]
+
+
+def parse_recurrence(spec):
+    """ Parses one of
+
+    every [N] <minutes|hours|days|weeks>   (also e.g. 'every 30m')
+    every <day|weekday|weekend|monday[,friday..]> [at] HH[:MM][am|pm]
+    <minute> <hour> <day of month> <month> <day of week>   (cron syntax)
+    """
+    text = " ".join(spec.strip().lower().split())
+
+    fields = text.split(" ")
+    if len(fields) == 5 and all(RE_CRON_FIELD.match(f) for f in fields):
+        return CronRecurrence(text, fields)
+
+    m = re.match(r'^every (.+)$', text)
+    if not m:
+        raise SMS900InvalidRecurrence(
+            "Invalid recurrence: %s (try e.g. 'every weekday 9:00' or 'every 2h')" % spec
+        )
+
+    rest = m.group(1)
+    try:
+        return IntervalRecurrence(text, parse_duration(rest))
+    except SMS900InvalidRecurrence:
+        pass
+
+    m = re.match(r'^(\S+)(?: at)? (.+)$', rest)
+    if not m:
+        raise SMS900InvalidRecurrence("Invalid recurrence: %s (missing time of day)" % spec)
+
+    return DailyRecurrence(text, _parse_days(m.group(1)), _parse_time(m.group(2)))
+
+
+def _parse_days(text):
+    if text == 'day':
+        return set(range(7))
+    if text == 'weekday':
+        return set(range(5))
+    if text == 'weekend':
+        return {5, 6}
+
+    days = set()
+    for day in text.split(','):
+        if day not in WEEKDAYS:
+            raise SMS900InvalidRecurrence("Invalid day: %s" % day)
+        days.add(WEEKDAYS[day])
+
+    return days
+
+
+def _parse_time(text):
+    m = RE_TIME.match(text)
+    if not m:
+        raise SMS900InvalidRecurrence("Invalid time of day: %s" % text)
+
+    hour = int(m.group(1))
+    minute = int(m.group(2)) if m.group(2) else 0
+
+    if m.group(3):
+        if not 1 <= hour <= 12:
+            raise SMS900InvalidRecurrence("Invalid time of day: %s" % text)
+        hour = hour % 12 + (12 if m.group(3) == 'pm' else 0)
+
+    if hour > 23 or minute > 59:
+        raise SMS900InvalidRecurrence("Invalid time of day: %s" % text)
+
+    return (hour, minute)
+
+
+class IntervalRecurrence():
+    def __init__(self, spec, seconds):
+        self.spec = spec
+        self.seconds = seconds
+
+    def next_after(self, previous, now=None):
+        """ The next due time (unix timestamp) after `previous`, skipping
+        any occurrences that are already in the past """
+        at = previous + self.seconds
+        if now is not None and at <= now:
+            at += ((now - at) // self.seconds + 1) * self.seconds
+
+        return at
+
+
+class DailyRecurrence():
+    """ At a given local time of day, on some days of the week """
+    def __init__(self, spec, days, time):
+        self.spec = spec
+        self.days = days
+        self.time = time
+
+    def next_after(self, previous, now=None):
+        after = max(previous, now) if now is not None else previous
+
+        # Naive local time, so that DST changes keep the time of day
+        day = datetime.fromtimestamp(after).replace(
+            hour=self.time[0], minute=self.time[1], second=0, microsecond=0
+        )
+
+        for _ in range(8):
+            if day.weekday() in self.days and day.timestamp() > after:
+                return day.timestamp()
+            day += timedelta(days=1)
+
+        raise SMS900InvalidRecurrence("No next time for %s" % self.spec)
+
+
+class CronRecurrence():
+    def __init__(self, spec, fields):
+        self.spec = spec
+        self.minutes = self._parse_field(fields[0], 0, 59)
+        self.hours = self._parse_field(fields[1], 0, 23)
+        self.days = self._parse_field(fields[2], 1, 31)
+        self.months = self._parse_field(fields[3], 1, 12)
+        # Both 0 and 7 are sunday; python counts from monday = 0
+        self.weekdays = {(d - 1) % 7 for d in self._parse_field(fields[4], 0, 7)}
+
+        self.any_day = fields[2] == '*'
+        self.any_weekday = fields[4] == '*'
+
+    def next_after(self, previous, now=None):
+        after = max(previous, now) if now is not None else previous
+        start = datetime.fromtimestamp(after)
+        day = start.replace(hour=0, minute=0, second=0, microsecond=0)
+
+        for _ in range(MAX_DAYS):
+            if self._matches_day(day):
+                for hour in sorted(self.hours):
+                    for minute in sorted(self.minutes):
+                        at = day.replace(hour=hour, minute=minute)
+                        if at.timestamp() > after:
+                            return at.timestamp()
+
+            day += timedelta(days=1)
+
+        raise SMS900InvalidRecurrence("No next time for %s" % self.spec)
+
+    def _matches_day(self, day):
+        if day.month not in self.months:
+            return False
+
+        day_match = day.day in self.days
+        weekday_match = day.weekday() in self.weekdays
+
+        # Like cron: if both are restricted, either one may match
+        if self.any_day:
+            return weekday_match
+        if self.any_weekday:
+            return day_match
+
+        return day_match or weekday_match
+
+    def _parse_field(self, field, low, high):
+        values = set()
+
+        for part in field.split(','):
+            m = re.match(r'^(\*|(\d+)(?:-(\d+))?)(?:/(\d+))?$', part)
+            if not m:
+                raise SMS900InvalidRecurrence("Invalid cron field: %s" % field)
+
+            if m.group(1) == '*':
+                (first, last) = (low, high)
+            else:
+                first = int(m.group(2))
+                last = int(m.group(3)) if m.group(3) else (high if m.group(4) else first)
+
+            step = int(m.group(4)) if m.group(4) else 1
+            if first < low or last > high or first > last or step < 1:
+                raise SMS900InvalidRecurrence("Invalid cron field: %s" % field)
+
+            values.update(range(first, last + 1, step))
+
+        return values
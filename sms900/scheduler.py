@@ -0,0 +1,88 @@
+""" A single thread running all timers """
+import heapq
+import itertools
+import logging
+from threading import Condition, Thread
+import time
+
+
+class TimerScheduler(Thread):
+    """ Calls callback(uuid, payload) when a timer is due.
+
+    Timers are kept in a min-heap ordered by due time, so scheduling is
+    O(log n). Cancelled timers are only dropped from the index and are
+    skipped (and eventually compacted away) in the heap, which makes
+    cancelling O(1). Times are unix timestamps.
+    """
+
+    # Re-check the wall clock at least this often, in case it jumps
+    MAX_WAIT = 60
+
+    def __init__(self, callback, clock=time.time):
+        Thread.__init__(self, name='timers', daemon=True)
+        self.callback = callback
+        self.clock = clock
+
+        self.heap = []
+        self.timers = {}
+        self.seq = itertools.count()
+        self.cond = Condition()
+
+    def schedule(self, uuid, at, payload):
+        """ Add a timer, or move an existing one with the same uuid """
+        with self.cond:
+            seq = next(self.seq)
+            self.timers[uuid] = (at, seq, payload)
+            heapq.heappush(self.heap, (at, seq, uuid))
+            self.cond.notify()
+
+    def cancel(self, uuid):
+        with self.cond:
+            if uuid not in self.timers:
+                return False
+
+            del self.timers[uuid]
+
+            if len(self.heap) > 2 * len(self.timers) + 64:
+                self._compact()
+
+            return True
+
+    def run(self):
+        while True:
+            for (uuid, payload) in self._wait_for_due():
+                try:
+                    self.callback(uuid, payload)
+                except Exception:
+                    logging.exception("Timer %s failed", uuid)
+
+    def _wait_for_due(self):
+        with self.cond:
+            while True:
+                due = []
+                now = self.clock()
+
+                while self.heap and (self.heap[0][0] <= now or self._is_stale(self.heap[0])):
+                    (at, seq, uuid) = heapq.heappop(self.heap)
+                    if self._is_stale((at, seq, uuid)):
+                        continue
+
+                    (_at, _seq, payload) = self.timers.pop(uuid)
+                    due.append((uuid, payload))
+
+                if due:
+                    return due
+
+                wait = self.MAX_WAIT
+                if self.heap:
+                    wait = min(wait, self.heap[0][0] - now)
+
+                self.cond.wait(wait)
+
+    def _is_stale(self, entry):
+        (_at, seq, uuid) = entry
+        return uuid not in self.timers or self.timers[uuid][1] != seq
+
+    def _compact(self):
+        self.heap = [entry for entry in self.heap if not self._is_stale(entry)]
+        heapq.heapify(self.heap)
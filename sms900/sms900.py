@@ -1,67 +1,218 @@
 """ The main bot module for sms900 """
-from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import json
 import logging
 import queue
 import re
-import threading
+import time
 import traceback
 import uuid
 from os import mkdir, path
 
 import dateparser
-import sqlite3
-import twilio
-from twilio.rest import Client
 from twilio.base.exceptions import TwilioRestException
 
+from sms900.db import Database
 from sms900.phonebook import PhoneBook, SMS900InvalidAddressbookEntry
+from sms900.numberrules import NumberCanonicalizer, SMS900InvalidNumberFormatException
+from sms900.phonebook_io import parse_contacts, export_contacts
 from sms900.ircthread import IRCThread
+from sms900.ircqueue import PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_BULK
 from sms900.http_interface import HTTPThread
 from sms900.indexer import Indexer
 from sms900.openai import OpenAI
-
-
-class SMS900InvalidNumberFormatException(Exception):
-    """ Simple exception to use for invalid number inputs"""
-    pass
+from sms900.completions import CompletionExecutor
+from sms900.twilio_client import create_twilio_client
+from sms900.sms_dispatcher import SMSDispatcher
+from sms900.ratelimit import TokenBucket
+from sms900.history import History
+from sms900.archive import MessageArchive
+from sms900.scheduler import TimerScheduler
+from sms900.timers import Timers, SMS900InvalidTimerException
+from sms900 import recurrence as recurrence_rules
+from sms900.journal import EventJournal
+from sms900.metrics import Counter, Gauge, Histogram, Registry
+from sms900.recurrence import parse_recurrence, parse_duration, SMS900InvalidRecurrence
+
+DATABASE_PATH = 'sms900.db'
 
 
 class SMS900():
     """ The main class to use """
+
+    # Events from the outside world that can't be asked for again; these
+    # are journaled until handled and replayed after a crash
+    DURABLE_EVENTS = ['SMS_RECEIVED', 'GITHUB_WEBHOOK', 'MAILGUN_INCOMING']
+
     def __init__(self, configuration_path):
         """ The init method for the main class.
         Should probably add an example or two here.
         """
         self.configuration_path = configuration_path
         self.events = queue.Queue()
+        self.journal = None
         self.config = None
-        self.dbconn = None
+        self.db = None
         self.irc_thread = None
         self.pb = None
+        self.numbers = None
+        self.twilio = None
+        self.sms_dispatcher = None
         self.openai = None
-        self.openai_history = deque(maxlen=100)
-        self.timers = {}
+        self.completions = None
+        self.openai_history = None
+        self.archive = None
+        self.timers = None
+        self.last_reminder = None
+        self.mms_executor = None
+
+        # Served on /metrics; updated from every thread, so keep it cheap
+        self.metrics = Registry()
+        self.metrics.register(Gauge('sms900_event_queue_depth',
+                                    'Events waiting for the main loop',
+                                    func=self.events.qsize))
+        self.event_wait = self.metrics.register(
+            Histogram('sms900_event_queue_wait_seconds',
+                      'Time events spend queued for the main loop',
+                      ('event_type',)))
+        self.event_duration = self.metrics.register(
+            Histogram('sms900_event_handler_seconds',
+                      'Time spent handling events on the main loop',
+                      ('event_type',)))
+        self.event_errors = self.metrics.register(
+            Counter('sms900_event_errors_total',
+                    'Events that failed, in their handler or in the background',
+                    ('event_type',)))
+        self.metrics.register(Gauge('sms900_irc_lag_seconds',
+                                    'Round trip time of the latest IRC ping',
+                                    func=lambda: self.irc_thread.lag if self.irc_thread else None))
+        self.metrics.register(Gauge('sms900_irc_outbound_queued_lines',
+                                    'Lines waiting for the IRC flood limits',
+                                    func=lambda: len(self.irc_thread.outbound) if self.irc_thread else None))
+        self.metrics.register(Counter('sms900_irc_outbound_lines_total',
+                                      'Lines put on the outbound IRC queue, sent or dropped',
+                                      ('status',),
+                                      func=self._get_irc_outbound_stats))
+        self.sms_send_latency = self.metrics.register(
+            Histogram('sms900_sms_send_seconds',
+                      'Twilio API calls sending an sms, by HTTP status (or ok, network)',
+                      ('status',)))
+        self.metrics.register(Gauge('sms900_sms_pending',
+                                    'Sms not yet sent or failed',
+                                    func=lambda: self.sms_dispatcher.pending_count()
+                                    if self.sms_dispatcher else None))
+        self.openai_latency = self.metrics.register(
+            Histogram('sms900_openai_request_seconds',
+                      'Time spent generating a response with OpenAI',
+                      ('mode',)))
+        self.mms_received = self.metrics.register(
+            Counter('sms900_mms_received_total', 'MMS received from Mailgun'))
+        self.mms_bytes = self.metrics.register(
+            Counter('sms900_mms_bytes_total', 'Bytes of MMS received from Mailgun'))
+        self.http_requests = self.metrics.register(
+            Counter('sms900_http_requests_total', 'HTTP responses, by method and status',
+                    ('method', 'code')))
+
+        self.handlers = {
+            'SEND_SMS': self._on_send_sms,
+            'ADD_PB_ENTRY': self._on_add_pb_entry,
+            'DEL_PB_ENTRY': self._on_del_pb_entry,
+            'SEND_GROUP_SMS': self._on_send_group_sms,
+            'ADD_PB_GROUP_MEMBERS': self._on_add_pb_group_members,
+            'DEL_PB_GROUP_MEMBERS': self._on_del_pb_group_members,
+            'LIST_PB_GROUPS': self._on_list_pb_groups,
+            'IMPORT_PHONEBOOK': self._on_import_phonebook,
+            'LOOKUP_CARRIER': self._on_lookup_carrier,
+            'REINDEX_ALL': self._on_reindex_all,
+            'ARCHIVE_SEARCH': self._on_archive_search,
+            'SMS_RECEIVED': self._on_sms_received,
+            'GITHUB_WEBHOOK': self._on_github_webhook,
+            'MAILGUN_INCOMING': self._on_mailgun_incoming,
+            'MMS_INGESTED': self._on_mms_ingested,
+            'TRIGGER_COMPLETION': self._on_trigger_completion,
+            'START_COMPLETION': self._on_start_completion,
+            'COMPLETION_FINISHED': self._on_completion_finished,
+            'COMPLETION_LINE': self._on_completion_line,
+            'ADD_TIMER': self._on_add_timer,
+            'SNOOZE_TIMER': self._on_snooze_timer,
+            'LIST_TIMERS': self._on_list_timers,
+            'CLEAR_TIMERS': self._on_clear_timers,
+            'TIMERS_REFILL': self._on_timers_refill,
+            'REMINDER_TRIGGERED': self._on_reminder_triggered,
+        }
 
     def run(self):
         """ Starts the main loop"""
-        self._load_configuration()
-        self._init_database()
-        self.pb = PhoneBook(self.dbconn)
-        self.indexer = Indexer()
+        self.open_database()
+
+        # Before anything else can queue events, so that replayed events
+        # are handled first
+        self.journal = EventJournal(self.db)
+        replayed = self.journal.pending()
+        for event in replayed:
+            event['queued_at'] = time.monotonic()
+            self.events.put(event)
+        self.journal.start()
+        logging.info("Replaying %d journaled events", len(replayed))
+
+        self.openai_history = History(
+            self.db,
+            self.config['nickname'],
+            cache_size=self.config['openai_history_cache_size']
+            if 'openai_history_cache_size' in self.config else 100
+        )
+        self.archive = MessageArchive(self.db)
+        self.twilio = create_twilio_client(self.config)
+        self.indexer = Indexer(
+            self.db,
+            page_size=self.config['mms_index_page_size']
+            if 'mms_index_page_size' in self.config else None
+        )
 
         logging.info("Starting IRCThread thread")
         self.irc_thread = IRCThread(self,
                                     self.config['server'],
                                     self.config['server_port'],
                                     self.config['nickname'],
-                                    self.config['channel'])
+                                    self.config['channel'],
+                                    self.config['irc_flood']
+                                    if 'irc_flood' in self.config else {})
         self.irc_thread.start()
 
+        logging.info("Starting sms dispatcher")
+        self.sms_dispatcher = SMSDispatcher(
+            self.twilio,
+            self.config['twilio_number'],
+            self.db,
+            lambda msg: self._send_privmsg(self.config['channel'], msg),
+            TokenBucket(
+                self.config['twilio_rate'] if 'twilio_rate' in self.config else 1.0,
+                self.config['twilio_burst'] if 'twilio_burst' in self.config else 1
+            ),
+            workers=self.config['twilio_workers']
+            if 'twilio_workers' in self.config else 4,
+            latency=self.sms_send_latency
+        )
+        self.sms_dispatcher.start()
+
+        # MMS parsing and indexing happens here, off the main loop
+        self.mms_executor = ThreadPoolExecutor(
+            max_workers=self.config['mms_ingest_workers']
+            if 'mms_ingest_workers' in self.config else 2,
+            thread_name_prefix='mms-ingest'
+        )
+
         try:
             if 'openai_api_key' in self.config:
                 self.openai = OpenAI(self.config)
+                self.completions = CompletionExecutor(
+                    self.queue_event,
+                    max_in_flight=self.config['openai_max_in_flight']
+                    if 'openai_max_in_flight' in self.config else 2,
+                    coalesce_delay=self.config['openai_coalesce_delay']
+                    if 'openai_coalesce_delay' in self.config else 1.0
+                )
         except Exception as err:
             logging.info("Failed to initialize openai: %s", err)
 
@@ -69,66 +220,79 @@ class SMS900():
         http_thread = HTTPThread(self, ('0.0.0.0', self.config['http_server_port']))
         http_thread.start()
 
-        self._load_timers()
+        scheduler = TimerScheduler(self._on_timer)
+        scheduler.start()
+        self.timers = Timers(
+            self.db,
+            scheduler,
+            recurrence_rules,
+            window=self.config['timers_window']
+            if 'timers_window' in self.config else 3600
+        )
+        self.timers.load()
 
         logging.info("Starting main loop")
         self._main_loop()
 
-    def _load_configuration(self):
-        with open(self.configuration_path, 'r') as file:
-            self.config = json.load(file)
-
-        # FIXME: Check that we got everything we'll be needing
+    def open_database(self):
+        """ Loads the configuration and opens the database and phone book,
+        which is all that the command line tools in bot.py need """
+        self._load_configuration()
+        self.numbers = NumberCanonicalizer.from_config(self.config)
+        self._init_database()
+        self.pb = PhoneBook(self.db)
+
+    def import_phonebook(self, data, format=None):
+        """ Imports a vCard or CSV file; returns the report from
+        PhoneBook.import_entries(). Must run on the main loop, which owns
+        the phone book. """
+        contacts = []
+        conflicts = []
+        for contact in parse_contacts(data, format):
+            if contact['number']:
+                try:
+                    contact['number'] = self._get_canonicalized_number(contact['number'])
+                except SMS900InvalidNumberFormatException as err:
+                    conflicts.append({'nickname': contact['nickname'], 'reason': str(err)})
+                    continue
 
-    def _init_database(self):
-        self.dbconn = sqlite3.connect('sms900.db', isolation_level=None)
-        conn = self.dbconn.cursor()
+            contacts.append(contact)
 
-        try:
-            conn.execute(
-                "create table if not exists phonebook ("
-                "  id integer primary key,"
-                "  nickname text UNIQUE,"
-                "  number text UNIQUE"
-                ")"
-            )
+        report = self.pb.import_entries(contacts)
+        report['conflicts'] = conflicts + report['conflicts']
 
-            conn.execute(
-                "create table if not exists phonebook_email ("
-                "  email text primary key collate nocase,"
-                "  nickname text"
-                ")"
-            )
+        logging.info("Imported %d contacts (%d unchanged, %d conflicts)",
+                     report['added'], report['unchanged'], len(report['conflicts']))
 
-            conn.execute(
-                "create table if not exists timers ("
-                "  uuid text primary key,"
-                "  timestamp integer,"
-                "  msg text"
-                ")"
-            )
-        except sqlite3.Error as err:
-            logging.info("Failed to create table(s): %s", err)
+        return report
 
-    def _load_timers(self):
-        now = datetime.now().timestamp()
+    def export_phonebook(self, format='csv'):
+        """ Returns a generator of vCard or CSV chunks """
+        return export_contacts(self.pb.get_entries(), format)
 
-        self.dbconn.execute("delete from timers where timestamp <= ?", (now - 60,))
+    def _load_configuration(self):
+        with open(self.configuration_path, 'r') as file:
+            self.config = json.load(file)
 
-        for row in self.dbconn.execute("select uuid, timestamp, msg from timers"):
-            uuid = row[0]
-            at_time = datetime.fromtimestamp(row[1]).astimezone()
-            msg = row[2]
+        # FIXME: Check that we got everything we'll be needing
 
-            if self._schedule_timer(at_time, msg, override_uuid=uuid):
-                logging.info(f"Loaded timer {uuid}/{at_time}: {msg}")
-            else:
-                logging.info(f"Failed to load timer {uuid}/{at_time}: {msg}")
+    def _init_database(self):
+        self.db = Database.from_config(DATABASE_PATH, self.config)
+        applied = self.db.migrate()
+        if applied:
+            logging.info("Applied database migrations %s", applied)
 
     def queue_event(self, event_type, data):
         """ queues event, stupid doc string i know """
         event = {'event_type': event_type}
         event.update(data)
+
+        if event_type in self.DURABLE_EVENTS and self.journal:
+            journal_id = self.journal.append(event)
+            if journal_id:
+                event['journal_id'] = journal_id
+
+        event['queued_at'] = time.monotonic()
         self.events.put(event)
 
     def on_privmsg_received(self, hostmask, channel, msg):
@@ -142,6 +306,7 @@ class SMS900():
                 'msg': msg,
                 'type': 'irc',
             })
+            self.archive.add('irc', nickname, msg, channel=channel)
 
             if self.config['nickname'] in msg:
                 self.queue_event('TRIGGER_COMPLETION', {})
@@ -152,182 +317,378 @@ class SMS900():
     def openai_set_model(self, model):
         self.openai.set_model(model)
 
-    def openai_reset_history(self):
-        self.openai_history.clear()
-
-    def timers_list(self):
-        for (uuid, timer) in self.timers.items():
-            print(f"{uuid}: Timer args is {timer.args}")
-
-            # Private variables? What's that?
-            if 'msg' not in timer.args[1]:
-                continue
+    def openai_cache_stats(self):
+        if not self.openai or not self.openai.cache:
+            return None
 
-            self._send_privmsg(
-                self.config['channel'],
-                f"<{uuid}> {timer.args[1]['msg']}"
-            )
+        return self.openai.cache.stats()
 
-    def timers_clear(self, _uuid):
-        count = 0
-        for uuid in list(self.timers.keys()):
-            if _uuid == 'all' or _uuid == uuid:
-                timer = self.timers[uuid]
-                del self.timers[uuid]
-                count += 1
-                timer.cancel()
-                self.queue_event('DB_DELETE_TIMER', {"uuid": uuid})
-            else:
-                logging.info(f"Ignoring {_uuid} != {uuid}")
+    def openai_cache_flush(self):
+        return self.openai.cache.flush()
 
-        return count
+    def openai_reset_history(self):
+        self.openai_history.reset(self.config['channel'])
 
     def _main_loop(self):
         while True:
             event = self.events.get()
             self._handle_event(event)
 
+            if 'journal_id' in event:
+                self.journal.ack(event['journal_id'])
+
+    def register_handler(self, event_type, handler):
+        """ handler(event) is called on the main loop for every event of
+        event_type """
+        self.handlers[event_type] = handler
+
     def _handle_event(self, event):
-        try:
-            logging.info('EVENT: %s', event)
-
-            if event['event_type'] == 'SEND_SMS':
-                sender_hm = event['hostmask']
-                number = self._get_num_from_nick_or_num(event['number'])
-                nickname = self._get_nickname_from_hostmask(sender_hm)
-                # FIXME: Check the sender
-                msg = "<%s> %s" % (nickname, event['msg'])
-
-                self._send_sms(number, msg)
-            elif event['event_type'] == 'ADD_PB_ENTRY':
-                nickname = event['nickname']
-                if event['number']:
-                    number = self._get_canonicalized_number(event['number'])
-
-                    self.pb.add_number(nickname, number)
-                    self._send_privmsg(self.config['channel'],
-                                       'Added %s with number %s' % (nickname, number))
-
-                elif event['email']:
-                    email = event['email']
-                    self.pb.add_email(nickname, email)
-                    self._send_privmsg(self.config['channel'],
-                                       'Added email %s for %s' % (email, nickname))
-
-            elif event['event_type'] == 'DEL_PB_ENTRY':
-                if event['nickname']:
-                    nickname = event['nickname']
-                    oldnumber = self.pb.get_number(nickname)
-
-                    self.pb.del_entry(nickname)
-                    self._send_privmsg(self.config['channel'],
-                                       'Removed contact %s (number: %s)' % (nickname, oldnumber))
-
-                elif event['email']:
-                    email = event['email']
-                    nickname = self.pb.get_nickname_from_email(email)
-
-                    self.pb.del_email(email)
-                    self._send_privmsg(self.config['channel'],
-                                       'Removed %s for contact %s' % (email, nickname))
-
-            elif event['event_type'] == 'LOOKUP_CARRIER':
-                number = event['number']
-                number = self._get_canonicalized_number(number)
-                self._lookup_carrier(number)
-            elif event['event_type'] == 'REINDEX_ALL':
-                self._reindex_all()
-            elif event['event_type'] == 'SMS_RECEIVED':
-                number = event['number']
-                sms_msg = event['msg']
-                try:
-                    sender = self.pb.get_nickname(number)
-                except SMS900InvalidAddressbookEntry:
-                    sender = number
-
-                msg = '<%s> %s' % (sender, sms_msg)
-                self._send_privmsg(self.config['channel'], msg)
-
-                self.openai_history.append({
-                    'timestamp': datetime.now().astimezone(),
-                    'nickname': sender,
-                    'channel': self.config['channel'],
-                    'msg': sms_msg,
-                    'type': 'sms',
-                })
-
-                if self.config['nickname'] in sms_msg:
-                    self.queue_event('TRIGGER_COMPLETION', {})
-
-            elif event['event_type'] == 'GITHUB_WEBHOOK':
-                self._handle_github_event(event['data'])
-            elif event['event_type'] == 'MAILGUN_INCOMING':
-                self._handle_incoming_mms(event['data'])
-            elif event['event_type'] == 'TRIGGER_COMPLETION':
-                if self.openai:
-                    context = self._openai_get_relevant_context(event)
-
-                    response = self.openai.generate_response(
-                        self.config['channel'],
-                        self.config['nickname'],
-                        context
-                    )
-                    if response:
-                        self.openai_history.append({
-                            'timestamp': datetime.now().astimezone(),
-                            'nickname': self.config['nickname'],
-                            'channel': self.config['channel'],
-                            'msg': response,
-                            'type': 'irc',
-                        })
-
-                        self._openai_parse_response_commands(response)
-
-                        self._send_privmsg(self.config['channel'], response)
-                else:
-                    logging.info("openai not configured")
-            elif event['event_type'] == 'REMINDER_TRIGGERED':
-                if self.openai:
-                    del self.timers[event['uuid']]
-                    self.queue_event('DB_DELETE_TIMER', {'uuid': event['uuid']})
-
-                    self.openai_history.append({
-                        'timestamp': datetime.now().astimezone(),
-                        'nickname': self.config['nickname'],
-                        'channel': self.config['channel'],
-                        'msg': event['msg'],
-                        'type': 'reminder',
-                    })
-
-                    self.queue_event('TRIGGER_COMPLETION', {})
-                else:
-                    logging.info("openai not configured")
-
-            elif event['event_type'] == 'DB_DELETE_TIMER':
-                self.dbconn.execute("DELETE FROM timers WHERE uuid = ?", (event['uuid'],))
+        event_type = event['event_type']
+        started = time.monotonic()
 
+        # The whole event may hold anything from MMS texts to imports
+        logging.info('EVENT: %s', event_type)
+        logging.debug('EVENT: %s', event)
+
+        if 'queued_at' in event:
+            self.event_wait.observe(started - event['queued_at'], (event_type,))
+
+        if event_type not in self.handlers:
+            logging.warning("No handler for %s", event_type)
+            return
+
+        try:
+            self.handlers[event_type](event)
         except (SMS900InvalidNumberFormatException,
-                SMS900InvalidAddressbookEntry) as err:
+                SMS900InvalidAddressbookEntry,
+                SMS900InvalidTimerException,
+                SMS900InvalidRecurrence) as err:
+            self.event_errors.inc((event_type,))
             self._send_privmsg(self.config['channel'], "Error: %s" % err)
         except Exception as err:
+            self.event_errors.inc((event_type,))
             self._send_privmsg(self.config['channel'], "Unknown error: %s" %
                                err)
             traceback.print_exc()
+        finally:
+            self.event_duration.observe(time.monotonic() - started, (event_type,))
+
+    def _on_send_sms(self, event):
+        sender_hm = event['hostmask']
+        number = self._get_num_from_nick_or_num(event['number'])
+        nickname = self._get_nickname_from_hostmask(sender_hm)
+        # FIXME: Check the sender
+        msg = "<%s> %s" % (nickname, event['msg'])
+
+        self.sms_dispatcher.send(number, msg)
+        self.archive.add('sms-out', nickname, event['msg'],
+                         recipient=event['number'])
+
+    def _on_add_pb_entry(self, event):
+        nickname = event['nickname']
+        if event['number']:
+            number = self._get_canonicalized_number(event['number'])
+
+            self.pb.add_number(nickname, number)
+            self._send_privmsg(self.config['channel'],
+                               'Added %s with number %s' % (nickname, number))
+
+        elif event['email']:
+            email = event['email']
+            self.pb.add_email(nickname, email)
+            self._send_privmsg(self.config['channel'],
+                               'Added email %s for %s' % (email, nickname))
+
+    def _on_del_pb_entry(self, event):
+        if event['nickname']:
+            nickname = event['nickname']
+            oldnumber = self.pb.get_number(nickname)
+
+            self.pb.del_entry(nickname)
+            self._send_privmsg(self.config['channel'],
+                               'Removed contact %s (number: %s)' % (nickname, oldnumber))
+
+        elif event['email']:
+            email = event['email']
+            nickname = self.pb.get_nickname_from_email(email)
+
+            self.pb.del_email(email)
+            self._send_privmsg(self.config['channel'],
+                               'Removed %s for contact %s' % (email, nickname))
+
+    def _on_send_group_sms(self, event):
+        nickname = self._get_nickname_from_hostmask(event['hostmask'])
+        members = self.pb.get_group_numbers(event['group'])
+        msg = "<%s> %s" % (nickname, event['msg'])
+
+        recipients = [(nick, number) for (nick, number) in members if number]
+        missing = [nick for (nick, number) in members if not number]
+        if missing:
+            self._send_privmsg(self.config['channel'],
+                               'No number for %s, skipping' % ', '.join(missing))
+
+        if recipients:
+            self.sms_dispatcher.send_batch(event['group'], recipients, msg)
+            self.archive.add('sms-out', nickname, event['msg'],
+                             recipient=event['group'])
+
+    def _on_add_pb_group_members(self, event):
+        group = event['group']
+        self.pb.add_to_group(group, event['nicknames'])
+        self._send_privmsg(self.config['channel'],
+                           'Added %s to group %s' % (', '.join(event['nicknames']), group))
+
+    def _on_del_pb_group_members(self, event):
+        group = event['group']
+        count = self.pb.del_from_group(group, event['nicknames'])
+        self._send_privmsg(self.config['channel'],
+                           'Removed %d member(s) from group %s' % (count, group))
+
+    def _on_list_pb_groups(self, event):
+        groups = self.pb.get_groups()
+        if not groups:
+            self._send_privmsg(self.config['channel'], 'No groups')
+
+        for (group, nicknames) in groups.items():
+            self._send_privmsg(self.config['channel'],
+                               '%s: %s' % (group, ', '.join(nicknames)),
+                               PRIORITY_BULK)
+
+    def _on_import_phonebook(self, event):
+        # The HTTP thread waits for the future
+        try:
+            report = self.import_phonebook(event['data'], event['format'])
+            event['future'].set_result(report)
+        except Exception as err:
+            self.event_errors.inc(('IMPORT_PHONEBOOK',))
+            event['future'].set_exception(err)
+            return
+
+        self._send_privmsg(self.config['channel'],
+                           'Imported %d contacts (%d unchanged, %d conflicts)' % (
+                               report['added'], report['unchanged'],
+                               len(report['conflicts'])))
+
+    def _on_lookup_carrier(self, event):
+        number = event['number']
+        number = self._get_canonicalized_number(number)
+        self._lookup_carrier(number)
+
+    def _on_reindex_all(self, event):
+        self.mms_executor.submit(self._reindex_all)
+
+    def _on_archive_search(self, event):
+        page = event['page']
+        per_page = 5
+        (total, hits) = self.archive.search(event['query'], page, per_page)
+        if not hits:
+            self._send_privmsg(self.config['channel'], 'No matches')
+            return
+
+        pages = (total + per_page - 1) // per_page
+        self._send_privmsg(self.config['channel'],
+                           '%d matches (page %d/%d):' % (total, page, pages),
+                           PRIORITY_BULK)
+
+        for hit in hits:
+            self._send_privmsg(
+                self.config['channel'],
+                '[%s] [%s] <%s> %s' % (
+                    hit['timestamp'].strftime('%Y-%m-%d %H:%M'),
+                    hit['source'],
+                    hit['nickname'],
+                    ' '.join(hit['snippet'].splitlines())
+                ),
+                PRIORITY_BULK
+            )
+
+    def _on_sms_received(self, event):
+        number = event['number']
+        sms_msg = event['msg']
+        try:
+            sender = self.pb.get_nickname(number)
+        except SMS900InvalidAddressbookEntry:
+            sender = number
+
+        msg = '<%s> %s' % (sender, sms_msg)
+        self._send_privmsg(self.config['channel'], msg, PRIORITY_HIGH)
+        self.archive.add('sms', sender, sms_msg, channel=self.config['channel'])
+
+        self.openai_history.append({
+            'timestamp': datetime.now().astimezone(),
+            'nickname': sender,
+            'channel': self.config['channel'],
+            'msg': sms_msg,
+            'type': 'sms',
+        })
+
+        if self.config['nickname'] in sms_msg:
+            self.queue_event('TRIGGER_COMPLETION', {})
+
+    def _on_github_webhook(self, event):
+        self._handle_github_event(event['data'])
+
+    def _on_mailgun_incoming(self, event):
+        # Acknowledged once ingested (see MMS_INGESTED)
+        self.mms_executor.submit(self._ingest_mms, event['data'],
+                                 event.pop('journal_id', None))
+
+    def _on_mms_ingested(self, event):
+        self._handle_ingested_mms(event)
+
+    def _on_trigger_completion(self, event):
+        if self.openai:
+            self.completions.trigger(self.config['channel'], event)
+        else:
+            logging.info("openai not configured")
+
+    def _on_start_completion(self, event):
+        self.completions.start(event['key'], self._openai_prepare_completion)
+
+    def _on_completion_finished(self, event):
+        self.completions.finished(event['key'])
+        if event['failed']:
+            self.event_errors.inc(('COMPLETION_FINISHED',))
+
+        (response, streamed) = event['result'] if event['result'] else (None, False)
+        if response:
+            self.openai_history.append({
+                'timestamp': datetime.now().astimezone(),
+                'nickname': self.config['nickname'],
+                'channel': self.config['channel'],
+                'msg': response,
+                'type': 'irc',
+            })
+            self.archive.add('irc', self.config['nickname'], response,
+                             channel=self.config['channel'])
+
+            # Streamed responses were posted and parsed line by line
+            if not streamed:
+                self._openai_parse_response_commands(response, 'COMPLETION_FINISHED')
+
+                self._send_privmsg(self.config['channel'], response)
+
+    def _on_completion_line(self, event):
+        self._openai_parse_response_commands(event['line'], 'COMPLETION_LINE')
+
+    def _on_add_timer(self, event):
+        (at, recurrence) = self._parse_timer_time(event['time'])
+        owner = self._get_nickname_from_hostmask(event['hostmask'])
+
+        _uuid = self.timers.add(at, event['msg'], owner, recurrence)
+        self._send_privmsg(self.config['channel'], "Timer %s scheduled for %s%s" % (
+            _uuid,
+            datetime.fromtimestamp(at).isoformat(' ', 'minutes'),
+            " (%s)" % recurrence if recurrence else ""
+        ))
+
+    def _on_snooze_timer(self, event):
+        at = datetime.now().timestamp() + parse_duration(event['duration'])
+        if event['uuid'] == 'last':
+            # Triggered timers are gone, or moved on if recurring
+            if not self.last_reminder:
+                raise SMS900InvalidTimerException("No reminder has triggered yet")
+
+            _uuid = self.timers.add(at, self.last_reminder['msg'],
+                                    self.last_reminder['owner'])
+        else:
+            _uuid = self.timers.snooze(event['uuid'], at)
+
+        self._send_privmsg(self.config['channel'], "Timer %s snoozed until %s" % (
+            _uuid, datetime.fromtimestamp(at).isoformat(' ', 'minutes')
+        ))
+
+    def _on_list_timers(self, event):
+        owner = None
+        if event['mine']:
+            owner = self._get_nickname_from_hostmask(event['hostmask'])
+
+        self._list_timers(owner)
+
+    def _on_clear_timers(self, event):
+        count = self.timers.clear(event['uuid'])
+        self._send_privmsg(self.config['channel'], f'Cleared {count} active timers')
+
+    def _on_timers_refill(self, event):
+        self.timers.refill()
+
+    def _on_reminder_triggered(self, event):
+        if not self.timers.done(event['uuid'], event['timestamp'], event['recurrence']):
+            logging.info("Timer %s was cleared or moved after it triggered", event['uuid'])
+            return
+
+        self.last_reminder = event
+
+        if event['owner']:
+            self._send_privmsg(self.config['channel'],
+                               "%s: %s" % (event['owner'], event['msg']),
+                               PRIORITY_HIGH)
+        elif self.openai:
+            self.openai_history.append({
+                'timestamp': datetime.now().astimezone(),
+                'nickname': self.config['nickname'],
+                'channel': self.config['channel'],
+                'msg': event['msg'],
+                'type': 'reminder',
+            })
+
+            self.queue_event('TRIGGER_COMPLETION', {})
+        else:
+            self._send_privmsg(self.config['channel'], event['msg'], PRIORITY_HIGH)
 
     def _openai_get_relevant_context(self, data):
-        default_limit = 20
-        context = list(self.openai_history)
+        # OpenAI.generate_prompt() trims this further to its token budget
+        default_limit = 50
+        # The most lines !oc <n> may ask for
+        max_include_all_length = 20
+        channel = self.config['channel']
 
         if 'include_all_length' in data:
-            limit = max(min(data['include_all_length'], default_limit), 1)
-        else:
-            limit = default_limit
-            context = [x for x in context
-                       if self.config['nickname'] in x['msg'] or x['nickname'] == self.config['nickname']]
+            limit = max(min(data['include_all_length'], max_include_all_length), 1)
+            return self.openai_history.get_recent(channel, limit)
+
+        return self.openai_history.get_involving_me(channel, default_limit)
+
+    def _openai_prepare_completion(self, data):
+        """ Picks the context on the main loop; the returned job is run
+        by the CompletionExecutor. """
+        context = self._openai_get_relevant_context(data)
+        channel = self.config['channel']
+        nickname = self.config['nickname']
+
+        if 'openai_stream' in self.config and self.config['openai_stream']:
+            def on_line(line):
+                self._send_privmsg(channel, line)
+                self.queue_event('COMPLETION_LINE', {'line': line})
+
+            return self._timed_openai_job('stream', lambda: (
+                self.openai.generate_response_stream(channel, nickname, context, on_line),
+                True
+            ))
+
+        return self._timed_openai_job('complete', lambda: (
+            self.openai.generate_response(channel, nickname, context),
+            False
+        ))
+
+    def _timed_openai_job(self, mode, job):
+        def run():
+            started = time.monotonic()
+            try:
+                return job()
+            finally:
+                self.openai_latency.observe(time.monotonic() - started, (mode,))
+
+        return run
+
+    def _get_irc_outbound_stats(self):
+        if not self.irc_thread:
+            return None
 
-        return context[-limit:]
+        return {(status,): count
+                for (status, count) in self.irc_thread.outbound.stats.items()}
 
-    def _openai_parse_response_commands(self, response):
+    def _openai_parse_response_commands(self, response, event_type):
         m = re.findall(r'\|SMS/([^|/]+)/([^|]+)\|', response)
         for sms in m:
             self.queue_event('SEND_SMS', {
@@ -339,78 +700,77 @@ class SMS900():
         m = re.findall(r'\|REMIND/([^|/]+)/([^|]+)\|', response)
         for reminder in m:
             try:
-                dt = dateparser.parse(reminder[0], settings={
-                    'PREFER_DATES_FROM': 'future',
-                }).astimezone()
-                msg = reminder[1]
-
-                _uuid = self._schedule_timer(dt, msg)
-                if _uuid:
-                    self.dbconn.execute("INSERT INTO timers(uuid, timestamp, msg) values (?, ?, ?)", (
-                        _uuid,
-                        dt.timestamp(),
-                        msg
-                    ))
-
-                    self._send_privmsg(self.config['channel'],
-                                       f"Timer scheduled for {dt.isoformat(' ')}")
+                (at, recurrence) = self._parse_timer_time(reminder[0])
+                self.timers.add(at, reminder[1], recurrence=recurrence)
+
+                dt = datetime.fromtimestamp(at).astimezone()
+                self._send_privmsg(self.config['channel'],
+                                   f"Timer scheduled for {dt.isoformat(' ')}")
             except Exception as e:
+                self.event_errors.inc((event_type,))
                 self._send_privmsg(self.config['channel'],
                                    "Failed to set reminder: %s" % e)
 
 
-    def _schedule_timer(self, at_time, msg, override_uuid=None):
-        in_seconds = (at_time - datetime.now().astimezone()).total_seconds()
-        if in_seconds <= 10:
+    def _parse_timer_time(self, text):
+        """ Returns (first due timestamp, recurrence spec or None) """
+        try:
+            recurrence = parse_recurrence(text)
+            return (recurrence.next_after(datetime.now().timestamp()), recurrence.spec)
+        except SMS900InvalidRecurrence:
+            if text.strip().lower().startswith('every '):
+                raise
+
+        dt = dateparser.parse(text, settings={
+            'PREFER_DATES_FROM': 'future',
+        })
+        if not dt:
+            raise SMS900InvalidTimerException("Invalid time: %s" % text)
+
+        return (dt.astimezone().timestamp(), None)
+
+    def _list_timers(self, owner=None, limit=20):
+        (total, rows) = self.timers.list(owner, limit)
+        if not total:
+            self._send_privmsg(self.config['channel'], 'No timers')
+            return
+
+        for (_uuid, timestamp, msg, _owner, recurrence) in rows:
             self._send_privmsg(
                 self.config['channel'],
-                f"Timer would trigger in {in_seconds}s; rejecting"
+                "<%s> %s%s%s %s" % (
+                    _uuid,
+                    datetime.fromtimestamp(timestamp).isoformat(' ', 'minutes'),
+                    " [%s]" % recurrence if recurrence else "",
+                    " (%s)" % _owner if _owner else "",
+                    msg
+                ),
+                PRIORITY_BULK
             )
 
-            return None
-
-        _uuid = override_uuid if override_uuid else str(uuid.uuid4())
-
-        timer = threading.Timer(in_seconds, self.queue_event, [
-            'REMINDER_TRIGGERED', {
-                'uuid': _uuid,
-                'msg': msg,
-            }
-        ])
-
-        self.timers[_uuid] = timer
-        timer.start()
-
-        logging.info(f"Timer {_uuid} scheduled in {in_seconds} seconds")
-
-        return _uuid
-
-    def _send_sms(self, number, message):
-        logging.info('Sending sms ( %s -> %s )', message, number)
-
-        try:
-            client = Client(self.config['twilio_account_sid'],
-                            self.config['twilio_auth_token'])
-
-            message_data = client.messages.create(to=number,
-                                                  from_=self.config['twilio_number'],
-                                                  body=message,)
-
+        if total > limit:
             self._send_privmsg(self.config['channel'],
-                               "Sent %s sms to number %s"
-                               % (message_data.num_segments, number))
-        except TwilioRestException as err:
-            self._send_privmsg(self.config['channel'],
-                               "Failed to send sms: %s" % err)
+                               '... and %d more' % (total - limit),
+                               PRIORITY_BULK)
+
+    def _on_timer(self, _uuid, payload):
+        if 'refill' in payload:
+            self.queue_event('TIMERS_REFILL', {})
+            return
+
+        self.queue_event('REMINDER_TRIGGERED', {
+            'uuid': _uuid,
+            'timestamp': payload['timestamp'],
+            'msg': payload['msg'],
+            'owner': payload['owner'],
+            'recurrence': payload['recurrence'],
+        })
 
     def _lookup_carrier(self, number):
         logging.info('Looking up number %s', number)
 
         try:
-            client = Client(self.config['twilio_account_sid'],
-                            self.config['twilio_auth_token'])
-
-            number_data = client.lookups.v1.phone_numbers(number).fetch(type=['carrier'])
+            number_data = self.twilio.lookups.v1.phone_numbers(number).fetch(type=['carrier'])
 
             self._send_privmsg(self.config['channel'],
                                '%s is %s, carrier: %s'
@@ -418,28 +778,15 @@ class SMS900():
                                   number_data.carrier['type'],
                                   number_data.carrier['name']))
         except TwilioRestException as err:
+            self.event_errors.inc(('LOOKUP_CARRIER',))
             self._send_privmsg(self.config['channel'],
                                "Failed to lookup number: %s" % err)
 
-    def _send_privmsg(self, target, msg):
-        self.irc_thread.send_privmsg(target, msg)
+    def _send_privmsg(self, target, msg, priority=PRIORITY_NORMAL):
+        self.irc_thread.send_privmsg(target, msg, priority)
 
     def _get_canonicalized_number(self, number):
-        match = re.match(r'^\+[0-9]+$', number)
-        if match:
-            logging.info('number %s already canonicalized, returning as is',
-                         number)
-            return number
-
-        match = re.match(r'^0(7[0-9]{8})$', number)
-        if match:
-            new_number = '+46%s' % match.group(1)
-            logging.info('number %s was canonicalized and returned as %s',
-                         number,
-                         new_number)
-            return new_number
-
-        raise SMS900InvalidNumberFormatException("%s is not a valid number" % number)
+        return self.numbers.canonicalize(number)
 
     def _get_num_from_nick_or_num(self, number_or_name):
         try:
@@ -478,44 +825,91 @@ class SMS900():
                 )
 
         except KeyError as err:
+            self.event_errors.inc(('GITHUB_WEBHOOK',))
             logging.exception("Failed to parse data from github webhook, reason: %s", err)
 
-    def _handle_incoming_mms(self, data):
-        rel_path = str(uuid.uuid4())
-        save_path = path.join(
-            self.config['mms_save_path'],
-            rel_path
-        )
+    def _ingest_mms(self, data, journal_id=None):
+        """ Runs in the mms_executor; saves and indexes an incoming MMS
+        and hands the result back to the main loop as MMS_INGESTED, which
+        also acknowledges the journaled MAILGUN_INCOMING. """
+        try:
+            if data['type'] == 'stored':
+                # Already written to disk by the HTTP handler
+                rel_path = data['rel_path']
+                save_path = path.join(self.config['mms_save_path'], rel_path)
+                [sender, files] = [data['sender'], data['files']]
+            else:
+                rel_path = str(uuid.uuid4())
+                save_path = path.join(
+                    self.config['mms_save_path'],
+                    rel_path
+                )
+
+                mkdir(save_path)
 
-        mkdir(save_path)
+                [sender, files] = self._parse_mms_data(data, save_path)
 
-        [sender, files] = self._parse_mms_data(data, save_path)
+            base_url = "%s/%s" % (
+                self.config['external_mms_url'],
+                rel_path
+            )
 
-        sender = self._map_mms_sender_to_nickname(sender)
+            mms_summary, summary_contains_all = self._get_mms_summary(base_url, files)
 
-        base_url = "%s/%s" % (
-            self.config['external_mms_url'],
-            rel_path
-        )
+            self.indexer.generate_local_index(save_path)
+            self.indexer.add_to_global_index(self.config['mms_save_path'], rel_path)
+
+            ingested = {
+                'sender': sender,
+                'base_url': base_url,
+                'file_count': len(files),
+                'summary': mms_summary,
+                'summary_contains_all': summary_contains_all,
+                'texts': self._get_mms_texts(files),
+            }
+            if journal_id:
+                ingested['journal_id'] = journal_id
+
+            self.queue_event('MMS_INGESTED', ingested)
+        except Exception as err:
+            # On the executor, after its MAILGUN_INCOMING was handled
+            self.event_errors.inc(('MAILGUN_INCOMING',))
+            logging.exception("Failed to ingest MMS")
+            if journal_id:
+                self.journal.ack(journal_id)
+            self._send_privmsg(self.config['channel'],
+                               "Failed to receive MMS: %s" % err)
+
+    def _handle_ingested_mms(self, event):
+        sender = self._map_mms_sender_to_nickname(event['sender'])
 
-        mms_summary, summary_contains_all = self._get_mms_summary(base_url, files)
-        if mms_summary:
+        for text in event['texts']:
+            self.archive.add('mms', sender, text, channel=self.config['channel'])
+
+        if event['summary']:
             self._send_privmsg(
                 self.config['channel'],
-                "[MMS] <%s> %s" % (sender, mms_summary)
+                "[MMS] <%s> %s" % (sender, event['summary']),
+                PRIORITY_HIGH
             )
 
-        if not summary_contains_all:
+        if not event['summary_contains_all']:
             self._send_privmsg(
                 self.config['channel'],
-                "[MMS] <%s> Received %d file(s): %s" % (sender, len(files), base_url)
+                "[MMS] <%s> Received %d file(s): %s" % (
+                    sender, event['file_count'], event['base_url']
+                ),
+                PRIORITY_HIGH
             )
 
-        self.indexer.generate_local_index(save_path)
-        self.indexer.generate_global_index(self.config['mms_save_path'])
-
     def _reindex_all(self):
-        self.indexer.reindex_all(self.config['mms_save_path'])
+        try:
+            self.indexer.reindex_all(self.config['mms_save_path'])
+        except Exception as err:
+            self.event_errors.inc(('REINDEX_ALL',))
+            logging.exception("Failed to reindex")
+            self._send_privmsg(self.config['channel'],
+                               "Failed to reindex: %s" % err)
 
     def _map_mms_sender_to_nickname(self, sender):
         m = re.match('^([^<]*<)?([^<]+@[^>]+)>?', sender)
@@ -544,70 +938,11 @@ class SMS900():
     def _parse_mms_data(self, data, save_path):
         payload = data['payload']
 
-        if data['type'] == 'form-data':
-            return self._parse_form_mms_data(payload, save_path)
-        elif data['type'] == 'urlencoded':
+        if data['type'] == 'urlencoded':
             return self._parse_urlencoded_mms_data(payload, save_path)
         else:
             return [None, []]
 
-    def _parse_form_mms_data(self, payload, save_path):
-        files = []
-        sender = None
-        i = 0
-
-        for part in payload.parts:
-            disposition = part.headers[b'Content-Disposition'].decode('utf-8', 'ignore')
-
-            m = re.search('name="([^"]+)"', disposition, re.IGNORECASE)
-            if m:
-                disposition_name = m.group(1)
-
-                if disposition_name == 'from':
-                    sender = part.content.decode('utf-8', 'ignore')
-                    continue
-
-                elif disposition_name in ['body-plain', 'subject']:
-                    contents = part.content.decode('utf-8', 'ignore')
-                    if not len(contents.strip()):
-                        continue
-
-                    filename = path.join(save_path, '%d-%s.txt' % (i, disposition_name))
-                    i += 1
-
-                    with open(filename, 'w') as f:
-                        f.write(contents)
-
-                    files.append(filename)
-                    continue
-
-            m = re.search('filename="([^"]+)"', disposition, re.IGNORECASE)
-            if m:
-                filename = path.join(save_path, '%d-%s' % (i, m.group(1)))
-                i += 1
-
-                with open(filename, 'wb') as f:
-                    f.write(part.content)
-
-                files.append(filename)
-                continue
-
-            if b'Content-Type' in part.headers:
-                # Probably something we need to handle better, but
-                # let's just dump it in a file for now.
-                filename = path.join(save_path, '%d-unknown' % i)
-                i += 1
-
-                with open(filename, 'wb') as f:
-                    f.write(part.content)
-
-                files.append(filename)
-                continue
-
-            logging.info("Ignoring: %s" % disposition)
-
-        return [sender, files]
-
     def _parse_urlencoded_mms_data(self, payload, save_path):
         files = []
         sender = None
@@ -634,6 +969,15 @@ class SMS900():
 
         return [sender, files]
 
+    def _get_mms_texts(self, files):
+        texts = []
+        for full_path in files:
+            if full_path.lower().endswith('.txt'):
+                with open(full_path, 'r', encoding='utf-8', errors='ignore') as file:
+                    texts.append(file.read())
+
+        return texts
+
     def _get_mms_summary(self, base_url, files):
         try:
             text = None
@@ -0,0 +1,218 @@
+""" Outbound SMS delivery with rate limiting, retries and a persisted queue """
+import heapq
+import logging
+import threading
+import time
+
+from requests.exceptions import RequestException
+from twilio.base.exceptions import TwilioRestException
+
+
+class SMSBatch():
+    """ Collects the results of a group send and reports them once every
+    message has either been sent or has failed. """
+
+    def __init__(self, name, size, notify):
+        self.name = name
+        self.size = size
+        self.notify = notify
+
+        self.sent = []
+        self.segments = 0
+        self.failed = []
+        self.lock = threading.Lock()
+
+    def record(self, label, segments=None, error=None):
+        with self.lock:
+            if error is None:
+                self.sent.append(label)
+                self.segments += int(segments or 0)
+            else:
+                self.failed.append((label, error))
+
+            if len(self.sent) + len(self.failed) < self.size:
+                return
+
+        self.notify(self.summary())
+
+    def summary(self):
+        summary = "Sent sms to %s: %d/%d delivered (%d segments)" % (
+            self.name, len(self.sent), self.size, self.segments
+        )
+
+        if self.failed:
+            summary += ", failed: %s" % ", ".join(
+                "%s (%s)" % (label, error) for (label, error) in self.failed
+            )
+
+        return summary
+
+
+class SMSDispatcher():
+    """ Sends SMS from a pool of worker threads.
+
+    Every message is stored in the sms_outbox table until it has either
+    been sent or has permanently failed, so pending messages survive a
+    restart. Sends are throttled by `bucket`, a TokenBucket (Twilio queues,
+    and eventually rejects, messages above the per-number throughput), and
+    429/5xx responses or connection errors are retried with exponential
+    backoff. Results are reported through notify(msg), per message or,
+    for send_batch(), once per batch. If given, `latency` (a Histogram)
+    gets the duration of every Twilio call, labeled by its outcome.
+    """
+
+    def __init__(self, twilio, from_number, db, notify, bucket,
+                 workers=4, max_attempts=5, backoff=2.0, latency=None):
+        self.twilio = twilio
+        self.from_number = from_number
+        self.notify = notify
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.latency = latency
+
+        self.bucket = bucket
+
+        self.db = db
+
+        # Heap of (due time, id), and id -> message
+        self.queue = []
+        self.messages = {}
+        self.cond = threading.Condition()
+
+    def start(self):
+        rows = self.db.execute(
+            "select id, number, msg, attempts from sms_outbox order by id"
+        ).fetchall()
+
+        for (_id, number, msg, attempts) in rows:
+            logging.info("Resuming pending sms %d to %s", _id, number)
+            self._enqueue(_id, {
+                'number': number,
+                'msg': msg,
+                'attempts': attempts,
+                'batch': None,
+                'label': number,
+            })
+
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker,
+                                      name='sms-dispatcher-%d' % i,
+                                      daemon=True)
+            thread.start()
+
+    def send(self, number, msg, batch=None, label=None):
+        _id = self.db.execute(
+            "insert into sms_outbox(number, msg, attempts, created) values (?, ?, 0, ?)",
+            (number, msg, int(time.time()))
+        ).lastrowid
+
+        self._enqueue(_id, {
+            'number': number,
+            'msg': msg,
+            'attempts': 0,
+            'batch': batch,
+            'label': label if label else number,
+        })
+
+        return _id
+
+    def send_batch(self, name, recipients, msg):
+        """ Sends msg to every (label, number) in recipients concurrently """
+        batch = SMSBatch(name, len(recipients), self.notify)
+
+        for (label, number) in recipients:
+            self.send(number, msg, batch=batch, label=label)
+
+        return batch
+
+    def pending_count(self):
+        with self.cond:
+            return len(self.messages)
+
+    def _enqueue(self, _id, message, delay=0):
+        with self.cond:
+            self.messages[_id] = message
+            heapq.heappush(self.queue, (time.monotonic() + delay, _id))
+            self.cond.notify()
+
+    def _next(self):
+        with self.cond:
+            while True:
+                if self.queue:
+                    wait = self.queue[0][0] - time.monotonic()
+                    if wait <= 0:
+                        (_, _id) = heapq.heappop(self.queue)
+                        return (_id, self.messages[_id])
+                else:
+                    wait = None
+
+                self.cond.wait(wait)
+
+    def _worker(self):
+        while True:
+            (_id, message) = self._next()
+            self.bucket.acquire()
+
+            try:
+                self._deliver(_id, message)
+            except Exception as err:
+                logging.exception("Unexpected error sending sms %d", _id)
+                self._finish(_id)
+                self._report(message, error=err)
+
+    def _deliver(self, _id, message):
+        number = message['number']
+        logging.info('Sending sms ( %s -> %s )', message['msg'], number)
+
+        started = time.monotonic()
+        try:
+            message_data = self.twilio.messages.create(to=number,
+                                                       from_=self.from_number,
+                                                       body=message['msg'],)
+
+            self._observe(started, 'ok')
+            self._finish(_id)
+            self._report(message, segments=message_data.num_segments)
+            return
+        except TwilioRestException as err:
+            self._observe(started, str(err.status))
+            retryable = err.status == 429 or err.status >= 500
+            error = err
+        except RequestException as err:
+            self._observe(started, 'network')
+            retryable = True
+            error = err
+
+        message['attempts'] += 1
+        if not retryable or message['attempts'] >= self.max_attempts:
+            self._finish(_id)
+            self._report(message, error=error)
+            return
+
+        delay = self.backoff * (2 ** (message['attempts'] - 1))
+        logging.info("Sending sms %d failed (attempt %d), retrying in %ss: %s",
+                     _id, message['attempts'], delay, error)
+
+        self.db.execute("update sms_outbox set attempts = ? where id = ?",
+                        (message['attempts'], _id))
+
+        self._enqueue(_id, message, delay)
+
+    def _observe(self, started, status):
+        if self.latency:
+            self.latency.observe(time.monotonic() - started, (status,))
+
+    def _report(self, message, segments=None, error=None):
+        if message['batch']:
+            message['batch'].record(message['label'], segments, error)
+        elif error is None:
+            self.notify("Sent %s sms to number %s" % (segments, message['number']))
+        else:
+            self.notify("Failed to send sms: %s" % error)
+
+    def _finish(self, _id):
+        self.db.execute("delete from sms_outbox where id = ?", (_id,))
+
+        with self.cond:
+            self.messages.pop(_id, None)
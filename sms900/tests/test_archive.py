@@ -0,0 +1,53 @@
+import unittest
+from datetime import datetime, timedelta
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.getcwd() + '/..')
+
+import archive
+import db
+
+class TestMessageArchive(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        database = db.Database(os.path.join(self.tmpdir.name, 'test.db'))
+        database.migrate()
+        self.instance = archive.MessageArchive(database)
+
+        self.instance.add('sms', 'kalle', 'Var är nyckeln till förrådet?', channel='#c')
+        self.instance.add('irc', 'olle', 'nyckeln ligger under mattan', channel='#c')
+        self.instance.add('sms-out', 'olle', 'köp mjölk', recipient='kalle')
+        self.instance.add('mms', 'kalle', 'nyckel nyckeln nyckeln "citat"', channel='#c')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_search(self):
+        (total, hits) = self.instance.search('nyckeln')
+        self.assertEqual(3, total)
+        # The one mentioning it the most ranks first
+        self.assertEqual('mms', hits[0]['source'])
+        self.assertIn('[nyckeln]', hits[0]['snippet'])
+
+        (total, hits) = self.instance.search('nyckeln mattan')
+        self.assertEqual(1, total)
+        self.assertEqual('olle', hits[0]['nickname'])
+        self.assertTrue(datetime.now().astimezone() - hits[0]['timestamp'] < timedelta(minutes=1))
+
+    def test_pagination(self):
+        (total, hits) = self.instance.search('nyckeln', page=2, per_page=2)
+        self.assertEqual(3, total)
+        self.assertEqual(1, len(hits))
+
+    def test_query_syntax(self):
+        self.assertEqual(3, self.instance.search('nyck*')[0])
+        self.assertEqual(1, self.instance.search('"citat')[0])
+        # Operators are just words
+        self.assertEqual(0, self.instance.search('mjölk OR')[0])
+        self.assertEqual(2, self.instance.search('kalle')[0])
+        self.assertEqual((0, []), self.instance.search('   '))
+
+if __name__ == '__main__':
+    unittest.main()
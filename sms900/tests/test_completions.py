@@ -0,0 +1,83 @@
+import unittest
+import os
+import queue
+import sys
+
+sys.path.insert(0, os.getcwd() + '/..')
+
+import completions
+
+class TestCompletionExecutor(unittest.TestCase):
+    def setUp(self):
+        self.events = queue.Queue()
+        self.instance = completions.CompletionExecutor(
+            lambda event_type, data: self.events.put((event_type, data)),
+            max_in_flight=1,
+            coalesce_delay=0
+        )
+
+    def tearDown(self):
+        self.instance.executor.shutdown()
+
+    def test_coalesce_pending(self):
+        self.assertTrue(self.instance.trigger('#a', {}))
+        self.assertFalse(self.instance.trigger('#a', {'include_all_length': 5}))
+        self.assertFalse(self.instance.trigger('#a', {'include_all_length': 3}))
+
+        self.assertEqual(('START_COMPLETION', {'key': '#a'}), self.events.get_nowait())
+        self.assertTrue(self.events.empty())
+
+        prepared = []
+        self.instance.start('#a', lambda data: prepared.append(data) or (lambda: 'ok'))
+        self.assertEqual([{'include_all_length': 5}], prepared)
+
+        self.assertEqual(
+            ('COMPLETION_FINISHED', {'key': '#a', 'result': 'ok', 'failed': False}),
+            self.events.get(timeout=5)
+        )
+
+    def test_trigger_while_running(self):
+        self.instance.trigger('#a', {})
+        self.events.get_nowait()
+        self.instance.start('#a', lambda data: lambda: 'first')
+
+        # Both of these should end up as one follow-up request
+        self.assertTrue(self.instance.trigger('#a', {}))
+        self.assertFalse(self.instance.trigger('#a', {}))
+
+        self.assertEqual('COMPLETION_FINISHED', self.events.get(timeout=5)[0])
+        self.assertTrue(self.events.empty())
+
+        self.instance.finished('#a')
+        self.assertEqual(('START_COMPLETION', {'key': '#a'}), self.events.get_nowait())
+
+    def test_max_in_flight(self):
+        self.instance.trigger('#a', {})
+        self.instance.trigger('#b', {})
+        self.events.get_nowait()
+        self.events.get_nowait()
+
+        self.instance.start('#a', lambda data: lambda: 'a')
+        self.instance.start('#b', lambda data: lambda: 'b')
+        self.assertEqual({'#a'}, self.instance.running)
+        self.assertIn('#b', self.instance.pending)
+
+        self.events.get(timeout=5)
+        self.instance.finished('#a')
+        self.assertEqual(('START_COMPLETION', {'key': '#b'}), self.events.get_nowait())
+
+    def test_failing_job(self):
+        def job():
+            raise Exception("nope")
+
+        self.instance.trigger('#a', {})
+        self.events.get_nowait()
+        self.instance.start('#a', lambda data: job)
+
+        self.assertEqual(
+            ('COMPLETION_FINISHED', {'key': '#a', 'result': None, 'failed': True}),
+            self.events.get(timeout=5)
+        )
+
+if __name__ == '__main__':
+    unittest.main()
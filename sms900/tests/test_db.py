@@ -0,0 +1,82 @@
+import unittest
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+
+sys.path.insert(0, os.getcwd() + '/..')
+
+import db
+
+class TestDatabase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmpdir.name, 'test.db')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_migrate(self):
+        instance = db.Database(self.db_path)
+        versions = [m[0] for m in db.MIGRATIONS]
+
+        self.assertEqual(versions, instance.migrate())
+        self.assertEqual([], db.Database(self.db_path).migrate())
+        self.assertEqual(
+            versions,
+            [row[0] for row in instance.execute("select version from schema_migrations order by version")]
+        )
+
+    def test_migrate_old_database(self):
+        conn = sqlite3.connect(self.db_path, isolation_level=None)
+        conn.execute("create table timers (uuid text primary key, timestamp integer, msg text)")
+        conn.execute("insert into timers values ('x', 1, 'hej')")
+        conn.close()
+
+        instance = db.Database(self.db_path)
+        instance.migrate()
+
+        self.assertEqual(
+            [('x', 1, 'hej', None, None)],
+            instance.execute("select uuid, timestamp, msg, owner, recurrence from timers").fetchall()
+        )
+
+    def test_transaction(self):
+        instance = db.Database(self.db_path)
+        instance.migrate()
+
+        with self.assertRaises(ValueError):
+            with instance.transaction() as conn:
+                conn.execute("insert into sms_outbox(number, msg) values ('+46700000001', 'a')")
+                raise ValueError()
+
+        with instance.transaction() as conn:
+            conn.execute("insert into sms_outbox(number, msg) values ('+46700000001', 'b')")
+            with instance.transaction():
+                instance.execute("insert into sms_outbox(number, msg) values ('+46700000001', 'c')")
+
+        self.assertEqual(['b', 'c'], [row[0] for row in instance.execute(
+            "select msg from sms_outbox order by id")])
+
+    def test_connection_per_thread(self):
+        instance = db.Database(self.db_path, synchronous='full', cache_size=1024)
+        connections = [instance.connection()]
+
+        thread = threading.Thread(target=lambda: connections.append(instance.connection()))
+        thread.start()
+        thread.join()
+
+        self.assertIs(connections[0], instance.connection())
+        self.assertIsNot(connections[0], connections[1])
+        self.assertEqual('wal', instance.execute("pragma journal_mode").fetchone()[0])
+        # 2 is full
+        self.assertEqual(2, instance.execute("pragma synchronous").fetchone()[0])
+        self.assertEqual(-1024, instance.execute("pragma cache_size").fetchone()[0])
+
+    def test_invalid_config(self):
+        with self.assertRaises(db.SMS900DatabaseException):
+            db.Database(self.db_path, synchronous='sometimes')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+import unittest
+from datetime import datetime, timedelta
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.getcwd() + '/..')
+
+import db
+import history
+
+class TestHistory(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmpdir.name, 'test.db')
+        self.db = db.Database(self.db_path)
+        self.db.migrate()
+        self.instance = history.History(self.db, 'sms900', cache_size=3)
+        self.start = datetime.now().astimezone() - timedelta(hours=1)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _append(self, instance, i, nickname, msg, channel='#c'):
+        instance.append({
+            'timestamp': self.start + timedelta(seconds=i),
+            'nickname': nickname,
+            'channel': channel,
+            'msg': msg,
+            'type': 'irc',
+        })
+
+    def _msgs(self, entries):
+        return [e['msg'] for e in entries]
+
+    def test_recent(self):
+        for i in range(5):
+            self._append(self.instance, i, 'kalle', 'msg %d' % i)
+        self._append(self.instance, 5, 'kalle', 'elsewhere', channel='#d')
+
+        self.assertEqual(['msg 3', 'msg 4'], self._msgs(self.instance.get_recent('#c', 2)))
+        # Not in the cache anymore
+        self.assertEqual(['msg 1', 'msg 2', 'msg 3', 'msg 4'],
+                         self._msgs(self.instance.get_recent('#c', 4)))
+
+    def test_involving_me(self):
+        self._append(self.instance, 0, 'kalle', 'hi sms900')
+        self._append(self.instance, 1, 'kalle', 'unrelated')
+        self._append(self.instance, 2, 'sms900', 'hello')
+
+        entries = self.instance.get_involving_me('#c', 10)
+        self.assertEqual(['hi sms900', 'hello'], self._msgs(entries))
+        self.assertEqual(self.start + timedelta(seconds=2), entries[1]['timestamp'])
+
+    def test_persistence_and_reset(self):
+        self._append(self.instance, 0, 'kalle', 'hi sms900')
+
+        reopened = history.History(db.Database(self.db_path), 'sms900', cache_size=3)
+        self.assertEqual(['hi sms900'], self._msgs(reopened.get_recent('#c', 3)))
+
+        reopened.reset('#c')
+        self.assertEqual([], reopened.get_recent('#c', 3))
+        self.assertEqual([], reopened.get_involving_me('#c', 3))
+
+        reopened = history.History(db.Database(self.db_path), 'sms900', cache_size=3)
+        self.assertEqual([], reopened.get_recent('#c', 10))
+
+if __name__ == '__main__':
+    unittest.main()
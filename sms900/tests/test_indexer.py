@@ -0,0 +1,231 @@
+import unittest
+import os
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.getcwd() + '/..')
+
+import db
+import indexer
+
+TEMPLATE_PATH = os.getcwd() + '/../../html'
+
+class TestManifest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.base_path = self.tmpdir.name
+        self.db = db.Database(':memory:')
+        self.db.migrate()
+
+        self.reads = []
+        self.ticks = 0
+        for name in ['a', 'b', 'c']:
+            self._add_mms(name, 'text of %s' % name)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _add_mms(self, name, text):
+        os.mkdir(os.path.join(self.base_path, name))
+        self._write(name, text)
+
+    def _write(self, name, text, filename='0-body-plain.txt'):
+        dir_path = os.path.join(self.base_path, name)
+        with open(os.path.join(dir_path, filename), 'w') as f:
+            f.write(text)
+
+        # Make sure the mtime changes, however coarse the file system's is
+        self.ticks += 1
+        mtime = os.stat(dir_path).st_mtime_ns + 10 ** 9 * self.ticks
+        os.utime(dir_path, ns=(mtime, mtime))
+
+    def _create(self):
+        instance = indexer.Indexer(self.db, template_path=TEMPLATE_PATH)
+        get_local_files = instance._get_local_files
+
+        def counting(local_path, prepend_path=None):
+            self.reads.append(prepend_path)
+            return get_local_files(local_path, prepend_path)
+
+        instance._get_local_files = counting
+        return instance
+
+    def _read_index(self):
+        with open(os.path.join(self.base_path, 'mms.html')) as f:
+            return f.read()
+
+    def test_unchanged_directories_are_reused(self):
+        self._create().generate_global_index(self.base_path)
+        self.assertEqual(['a', 'b', 'c'], sorted(self.reads))
+
+        self.reads.clear()
+        self._create().generate_global_index(self.base_path)
+        self.assertEqual([], self.reads)
+        self.assertIn('text of b', self._read_index())
+
+    def test_changed_directories_are_reread(self):
+        instance = self._create()
+        instance.generate_global_index(self.base_path)
+
+        self._write('b', 'more text', '1-subject.txt')
+        self.reads.clear()
+        self._create().generate_global_index(self.base_path)
+
+        self.assertEqual(['b'], self.reads)
+        self.assertIn('more text', self._read_index())
+
+    def test_add_to_global_index(self):
+        self._create().generate_global_index(self.base_path)
+
+        self._add_mms('d', 'text of d')
+        self.reads.clear()
+        instance = self._create()
+        instance.add_to_global_index(self.base_path, 'd')
+
+        self.assertEqual(['d'], self.reads)
+        index = self._read_index()
+        self.assertIn('text of a', index)
+        self.assertIn('text of d', index)
+
+        # The new entry was stored too
+        self.reads.clear()
+        self._create().generate_global_index(self.base_path)
+        self.assertEqual([], self.reads)
+
+    def test_removed_directories_are_dropped(self):
+        self._create().generate_global_index(self.base_path)
+
+        shutil.rmtree(os.path.join(self.base_path, 'c'))
+        self._create().generate_global_index(self.base_path)
+        self.assertNotIn('text of c', self._read_index())
+
+        instance = self._create()
+        self.assertEqual(['a', 'b'], sorted(instance._get_manifest(self.base_path)))
+
+    def test_manifest_is_not_served(self):
+        for filename in indexer.OLD_MANIFEST_FILENAMES:
+            with open(os.path.join(self.base_path, filename), 'w') as f:
+                f.write('old manifest')
+
+        self._create().generate_global_index(self.base_path)
+        self.assertEqual([], [f for f in os.listdir(self.base_path) if f.startswith('.')])
+
+    def test_bad_manifest_entry_is_reread(self):
+        self._create().generate_global_index(self.base_path)
+        self.db.execute("update mms_index_manifest set mms = 'not json' where dir_name = 'b'")
+
+        self.reads.clear()
+        self._create().generate_global_index(self.base_path)
+        self.assertEqual(['b'], self.reads)
+        self.assertIn('text of b', self._read_index())
+
+class TestPagination(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.base_path = self.tmpdir.name
+        self.db = db.Database(':memory:')
+        self.db.migrate()
+        self.written = []
+
+        for n in range(1, 5):
+            self._add_mms(n)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _add_mms(self, n):
+        """ MMS n is received n minutes after the first one """
+        name = 'mms%d' % n
+        os.mkdir(os.path.join(self.base_path, name))
+
+        filename = os.path.join(self.base_path, name, '0-body-plain.txt')
+        with open(filename, 'w') as f:
+            f.write('text of %s' % name)
+
+        timestamp = 1700000000 + n * 60
+        os.utime(filename, (timestamp, timestamp))
+        return name
+
+    def _create(self, page_size=2):
+        instance = indexer.Indexer(self.db, page_size=page_size, template_path=TEMPLATE_PATH)
+        write_file = instance._write_file
+
+        def recording(data, path):
+            self.written.append(os.path.basename(path))
+            write_file(data, path)
+
+        instance._write_file = recording
+        return instance
+
+    def _read(self, filename):
+        with open(os.path.join(self.base_path, filename)) as f:
+            return f.read()
+
+    def _pages(self):
+        return sorted(f for f in os.listdir(self.base_path) if f.startswith('mms-'))
+
+    def test_pages(self):
+        self._add_mms(5)
+        self._create().generate_global_index(self.base_path)
+
+        self.assertEqual(['mms-1.html', 'mms-2.html', 'mms-3.html'], self._pages())
+
+        # Numbered from the oldest
+        first = self._read('mms-1.html')
+        self.assertIn('text of mms1', first)
+        self.assertIn('text of mms2', first)
+        self.assertNotIn('text of mms3', first)
+        self.assertIn('href="mms-2.html">Newer', first)
+        self.assertNotIn('Older', first)
+
+        middle = self._read('mms-2.html')
+        self.assertIn('Page 2:', middle)
+        self.assertIn('href="mms-3.html">Newer', middle)
+        self.assertIn('href="mms-1.html">Older', middle)
+
+        last = self._read('mms-3.html')
+        self.assertIn('text of mms5', last)
+        self.assertNotIn('Newer', last)
+        self.assertIn('href="mms-2.html">Older', last)
+
+        # The landing page has the newest page and links to all of them
+        landing = self._read('mms.html')
+        self.assertIn('Page 3:', landing)
+        self.assertIn('text of mms5', landing)
+        self.assertNotIn('text of mms4', landing)
+        self.assertIn('href="mms-2.html">Older', landing)
+        for page in self._pages():
+            self.assertIn('href="%s"' % page, landing)
+
+    def test_only_newest_pages_are_rewritten(self):
+        instance = self._create()
+        instance.generate_global_index(self.base_path)
+
+        # A new page; the previous last page gets a "newer" link
+        self.written.clear()
+        instance.add_to_global_index(self.base_path, self._add_mms(5))
+        self.assertEqual(['mms-2.html', 'mms-3.html', 'mms.html'], self.written)
+        self.assertIn('href="mms-3.html">Newer', self._read('mms-2.html'))
+
+        # Room on the last page
+        self.written.clear()
+        instance.add_to_global_index(self.base_path, self._add_mms(6))
+        self.assertEqual(['mms-3.html', 'mms.html'], self.written)
+        self.assertIn('text of mms6', self._read('mms-3.html'))
+
+    def test_stale_pages_are_removed(self):
+        self._add_mms(5)
+        self._create().generate_global_index(self.base_path)
+
+        for n in [3, 4, 5]:
+            shutil.rmtree(os.path.join(self.base_path, 'mms%d' % n))
+        self._create().generate_global_index(self.base_path)
+        self.assertEqual(['mms-1.html'], self._pages())
+
+        self._create(page_size=None).generate_global_index(self.base_path)
+        self.assertEqual([], self._pages())
+        self.assertIn('text of mms2', self._read('mms.html'))
+
+if __name__ == '__main__':
+    unittest.main()
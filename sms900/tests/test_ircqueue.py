@@ -0,0 +1,57 @@
+import unittest
+import os
+import sys
+
+sys.path.insert(0, os.getcwd() + '/..')
+
+import ircqueue
+import ratelimit
+
+class FakeClock():
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+class TestOutboundQueue(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.instance = ircqueue.OutboundQueue(
+            ratelimit.TokenBucket(1, 2, clock=self.clock),
+            ratelimit.TokenBucket(100, 100, clock=self.clock),
+            max_lines=4
+        )
+
+    def test_priority(self):
+        self.instance.put('#c', 'a\nb', ircqueue.PRIORITY_BULK)
+        self.instance.put('#c', 'sms', ircqueue.PRIORITY_HIGH)
+        self.instance.put('#c', 'reply')
+
+        self.assertEqual(('#c', 'sms'), self.instance.pop_ready())
+        self.assertEqual(('#c', 'reply'), self.instance.pop_ready())
+
+        # Out of line tokens
+        self.assertEqual(None, self.instance.pop_ready())
+        self.assertEqual(1, self.instance.delay())
+
+        self.clock.now += 1
+        self.assertEqual(('#c', 'a'), self.instance.pop_ready())
+
+    def test_byte_limit(self):
+        self.instance.put('#c', 'x' * 80)
+        self.instance.put('#c', 'y' * 80)
+
+        self.assertEqual(('#c', 'x' * 80), self.instance.pop_ready())
+        self.assertEqual(None, self.instance.pop_ready())
+        self.assertAlmostEqual(0.88, self.instance.delay())
+
+    def test_drop(self):
+        self.instance.put('#c', 'a\n\nb\nc\nd\ne\nf')
+
+        self.assertEqual(4, len(self.instance))
+        self.assertEqual({'queued': 4, 'sent': 0, 'dropped': 2}, self.instance.stats)
+        self.assertEqual(None, ircqueue.OutboundQueue(None, None).delay())
+
+if __name__ == '__main__':
+    unittest.main()
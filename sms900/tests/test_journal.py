@@ -0,0 +1,99 @@
+import unittest
+import os
+import sys
+import tempfile
+import threading
+
+sys.path.insert(0, os.getcwd() + '/..')
+
+import db
+import journal
+
+class TestEventJournal(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmpdir.name, 'test.db')
+        db.Database(self.db_path).migrate()
+        self.instances = []
+
+    def tearDown(self):
+        for instance in self.instances:
+            instance.stop()
+
+        self.tmpdir.cleanup()
+
+    def _open(self):
+        instance = journal.EventJournal(db.Database(self.db_path))
+        pending = instance.pending()
+        instance.start()
+        self.instances.append(instance)
+        return (instance, pending)
+
+    def test_replay(self):
+        (instance, pending) = self._open()
+        self.assertEqual([], pending)
+
+        first = instance.append({'event_type': 'SMS_RECEIVED', 'number': '+46700000001', 'msg': 'hej'})
+        second = instance.append({'event_type': 'GITHUB_WEBHOOK', 'data': {'commits': []}})
+        instance.ack(first)
+        # Acks are written with the next batch
+        instance.append({'event_type': 'SMS_RECEIVED', 'number': '+46700000002', 'msg': 'då'})
+
+        (instance, pending) = self._open()
+        self.assertEqual(
+            [{'event_type': 'GITHUB_WEBHOOK', 'data': {'commits': []}, 'journal_id': second},
+             {'event_type': 'SMS_RECEIVED', 'number': '+46700000002', 'msg': 'då',
+              'journal_id': second + 1}],
+            pending
+        )
+
+    def test_concurrent_appends(self):
+        (instance, _pending) = self._open()
+        ids = []
+
+        def append(n):
+            for i in range(50):
+                ids.append(instance.append({'event_type': 'SMS_RECEIVED', 'msg': '%d-%d' % (n, i)}))
+
+        threads = [threading.Thread(target=append, args=(n,)) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(200, len(set(ids)))
+        # Several appends share a commit
+        self.assertLess(instance.batch, 200)
+
+        (_instance, pending) = self._open()
+        self.assertEqual(sorted(ids), [event['journal_id'] for event in pending])
+
+    def test_write_failure(self):
+        (instance, _pending) = self._open()
+        write = instance._write
+
+        def fail_once(appends, acks):
+            instance._write = write
+            raise RuntimeError("disk on fire")
+
+        instance._write = fail_once
+        self.assertIsNone(instance.append({'event_type': 'SMS_RECEIVED', 'msg': 'lost'}))
+        self.assertIsNotNone(instance.append({'event_type': 'SMS_RECEIVED', 'msg': 'kept'}))
+
+    def test_append_timeout(self):
+        # Never started, so nothing is ever written
+        instance = journal.EventJournal(db.Database(self.db_path), append_timeout=0.1)
+        self.assertIsNone(instance.append({'event_type': 'SMS_RECEIVED', 'msg': 'hej'}))
+
+    def test_stop(self):
+        (instance, _pending) = self._open()
+        first = instance.append({'event_type': 'SMS_RECEIVED', 'msg': 'hej'})
+        instance.ack(first)
+        instance.stop()
+
+        self.assertFalse(instance.is_alive())
+        self.assertIsNone(instance.append({'event_type': 'SMS_RECEIVED', 'msg': 'late'}))
+        self.assertEqual([], self._open()[1])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+import unittest
+import os
+import sys
+
+sys.path.insert(0, os.getcwd() + '/..')
+
+import metrics
+
+class TestMetrics(unittest.TestCase):
+    def test_counter(self):
+        counter = metrics.Counter('errors_total', 'Errors', ('event_type',))
+        counter.inc(('SEND_SMS',))
+        counter.inc(('SEND_SMS',), 2)
+        counter.inc(('SMS_RECEIVED',))
+
+        self.assertEqual(3, counter.get(('SEND_SMS',)))
+        self.assertEqual(0, counter.get(('REINDEX_ALL',)))
+        self.assertEqual([(('SEND_SMS',), 3), (('SMS_RECEIVED',), 1)], counter.items())
+
+    def test_histogram(self):
+        histogram = metrics.Histogram('seconds', 'Latency', ('event_type',), buckets=(0.1, 1))
+        for value in [0.05, 0.1, 0.5, 7]:
+            histogram.observe(value, ('SEND_SMS',))
+
+        (buckets, total, count) = histogram.get(('SEND_SMS',))
+        self.assertEqual([(0.1, 2), (1, 3), (float('inf'), 4)], buckets)
+        self.assertAlmostEqual(7.65, total)
+        self.assertEqual(4, count)
+
+        self.assertEqual(([], 0.0, 0), histogram.get(('SMS_RECEIVED',)))
+        self.assertEqual([('SEND_SMS',)], histogram.labels())
+
+    def test_gauge(self):
+        depth = [3]
+        gauge = metrics.Gauge('depth', 'Queue depth', func=lambda: depth[0])
+        self.assertEqual([((), 3)], gauge.items())
+
+        lag = metrics.Gauge('lag', 'Lag', func=lambda: None)
+        self.assertEqual([], lag.items())
+
+    def test_render(self):
+        registry = metrics.Registry()
+        registry.register(metrics.Gauge('depth', 'Queue depth', func=lambda: 2))
+        counter = registry.register(metrics.Counter('errors_total', 'Errors', ('event_type',)))
+        counter.inc(('SAY "HI"\\',))
+        histogram = registry.register(metrics.Histogram('seconds', 'Latency', buckets=(0.5,)))
+        histogram.observe(0.25)
+        histogram.observe(2.0)
+
+        self.assertEqual(
+            '# HELP depth Queue depth\n'
+            '# TYPE depth gauge\n'
+            'depth 2\n'
+            '# HELP errors_total Errors\n'
+            '# TYPE errors_total counter\n'
+            'errors_total{event_type="SAY \\"HI\\"\\\\"} 1\n'
+            '# HELP seconds Latency\n'
+            '# TYPE seconds histogram\n'
+            'seconds_bucket{le="0.5"} 1\n'
+            'seconds_bucket{le="+Inf"} 2\n'
+            'seconds_sum 2.25\n'
+            'seconds_count 2\n',
+            registry.render()
+        )
+
+if __name__ == '__main__':
+    unittest.main()
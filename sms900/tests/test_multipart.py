@@ -0,0 +1,82 @@
+import unittest
+import io
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.getcwd() + '/..')
+
+import multipart
+
+BOUNDARY = b'xyzzy'
+
+def body(parts, epilogue=b''):
+    data = b'preamble'
+    for (headers, content) in parts:
+        data += b'\r\n--' + BOUNDARY + b'\r\n' + headers + b'\r\n\r\n' + content
+    return data + b'\r\n--' + BOUNDARY + b'--\r\n' + epilogue
+
+MMS = body([
+    (b'Content-Disposition: form-data; name="from"', b'Kalle <kalle@example.com>'),
+    (b'Content-Disposition: form-data; name="subject"', b'  '),
+    (b'Content-Disposition: form-data; name="body-plain"', 'hej på dig'.encode('utf-8')),
+    (b'Content-Disposition: form-data; name="attachment-1"; filename="../../cat.jpg"\r\n'
+     b'Content-Type: image/jpeg', b'\xff\xd8' + b'\r\n--xyzz' * 1000 + b'\xff\xd9'),
+], epilogue=b'ignored')
+
+class TestMultipart(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_store(self):
+        for chunk_size in [1, 7, 64 * 1024]:
+            store = multipart.MMSPartStore(self.tmpdir.name)
+            multipart.parse_multipart(io.BytesIO(MMS), BOUNDARY, len(MMS), store.on_part,
+                                      chunk_size=chunk_size)
+
+            self.assertEqual('Kalle <kalle@example.com>', store.sender)
+            self.assertEqual(['0-body-plain.txt', '1-cat.jpg'],
+                             [os.path.basename(f) for f in store.files])
+
+            with open(store.files[0], 'r', encoding='utf-8') as f:
+                self.assertEqual('hej på dig', f.read())
+            with open(store.files[1], 'rb') as f:
+                self.assertEqual(b'\xff\xd8' + b'\r\n--xyzz' * 1000 + b'\xff\xd9', f.read())
+
+    def test_tee_and_epilogue(self):
+        stream = io.BytesIO(MMS + b'next request')
+        captured = []
+
+        multipart.parse_multipart(stream, BOUNDARY, len(MMS), lambda headers: None,
+                                  tee=captured.append, chunk_size=100)
+
+        self.assertEqual(MMS, b''.join(captured))
+        self.assertEqual(b'next request', stream.read())
+
+    def test_invalid(self):
+        self.assertEqual(b'xyzzy', multipart.get_boundary('multipart/form-data; boundary="xyzzy"'))
+        self.assertRaises(multipart.SMS900InvalidMultipart,
+                          multipart.get_boundary, 'multipart/form-data')
+
+        truncated = MMS[:len(MMS) // 2]
+        self.assertRaises(multipart.SMS900InvalidMultipart, multipart.parse_multipart,
+                          io.BytesIO(truncated), BOUNDARY, len(MMS), lambda headers: None)
+        self.assertRaises(multipart.SMS900InvalidMultipart, multipart.parse_multipart,
+                          io.BytesIO(truncated), BOUNDARY, len(truncated), lambda headers: None)
+
+    def test_rotating_capture(self):
+        capture = multipart.RotatingCapture(os.path.join(self.tmpdir.name, 'debug'), keep=2)
+        for i in range(4):
+            with capture.open('POST / HTTP/1.1', {'Content-Length': '1'}) as f:
+                f.write(b'%d' % i)
+
+        names = sorted(os.listdir(capture.directory))
+        self.assertEqual(2, len(names))
+        with open(os.path.join(capture.directory, names[-1]), 'rb') as f:
+            self.assertEqual(b'POST / HTTP/1.1\nContent-Length: 1\n\n3', f.read())
+
+if __name__ == '__main__':
+    unittest.main()
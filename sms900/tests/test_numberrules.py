@@ -0,0 +1,44 @@
+import unittest
+import os
+import sys
+
+sys.path.insert(0, os.getcwd() + '/..')
+
+import numberrules
+
+class TestNumberCanonicalizer(unittest.TestCase):
+    def setUp(self):
+        self.instance = numberrules.NumberCanonicalizer('SE')
+
+    def test_canonicalize(self):
+        for number in ['+46700000001', '0700000001', '070-000 00 01',
+                       '0046700000001', '+46 (0)70 000 00 01']:
+            self.assertEqual('+46700000001', self.instance.canonicalize(number))
+
+        # Other countries only in international format
+        self.assertEqual('+4791234567', self.instance.canonicalize('+47 912 34 567'))
+        self.assertEqual('+447700900123', self.instance.canonicalize('+44 (0)7700 900123'))
+
+    def test_invalid(self):
+        for number in ['12345', '0800000000', '+0123456789', '+1234567890123456', 'alice']:
+            self.assertRaises(numberrules.SMS900InvalidNumberFormatException,
+                              self.instance.canonicalize, number)
+
+    def test_config(self):
+        instance = numberrules.NumberCanonicalizer.from_config({
+            'number_default_region': 'XX',
+            'number_regions': {
+                'XX': {'country_code': '999', 'trunk_prefix': '0', 'national_pattern': r'9\d{7}'},
+            },
+        })
+
+        self.assertEqual('+99991234567', instance.canonicalize('091234567'))
+        self.assertEqual('+46700000001', instance.canonicalize('+46700000001'))
+        self.assertRaises(numberrules.SMS900InvalidNumberFormatException,
+                          instance.canonicalize, '0700000001')
+
+        self.assertRaises(numberrules.SMS900InvalidNumberFormatException,
+                          numberrules.NumberCanonicalizer, 'ZZ')
+
+if __name__ == '__main__':
+    unittest.main()
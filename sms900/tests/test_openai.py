@@ -1,4 +1,5 @@
 import unittest
+from datetime import datetime
 import os
 import sys
 
@@ -78,5 +79,172 @@ class TestOpenAiUtils(unittest.TestCase):
             self.instance.strip_imaginary_response("abcdefgh\n<kalle> xyzåäö\nok")
         )
 
+    def _stream(self, pieces):
+        lines = []
+        self.instance.stream_lines(iter(pieces), lines.append)
+        return lines
+
+    def test_stream_lines(self):
+        self.assertEqual(
+            ["abc", "def", "", "ghi"],
+            self._stream(["\n", "ab", "c\nde", "f\n", None, "\ng", "hi\n"])
+        )
+
+        self.instance.max_line_length = 10
+        self.assertEqual(
+            ["abcdef", "ghijklmnop", "qrstuv"],
+            self._stream(["abcdef ghij", "klmn", "opqrstuv"])
+        )
+
+        # Lines split by length are not checked for imaginary responses
+        self.instance.max_line_length = 3
+        self.assertEqual(
+            ["xy", "<ka", "lle", ">"],
+            self._stream(["xy <kalle>"])
+        )
+
+    def test_stream_lines_imaginary_response(self):
+        self.assertEqual(
+            ["abcdefgh"],
+            self._stream(["abcd", "efgh\n<ka", "lle> xyzåäö\nok"])
+        )
+        self.assertEqual(
+            ["abcdefgh"],
+            self._stream(["abcdefgh\n", "<kalle>"])
+        )
+        self.assertEqual(
+            ["<kalle> is a nick", "ok"],
+            self._stream(["<kalle> is a nick\nok"])
+        )
+
+    def _event(self, msg, channel = "#c"):
+        return {
+            "type": "irc",
+            "timestamp": datetime(2023, 1, 2, 3, 4, 5).astimezone(),
+            "nickname": "kalle",
+            "channel": channel,
+            "msg": msg,
+        }
+
+    def test_generate_prompt_budget(self):
+        # One token per line
+        self.instance.set_tokenizer(lambda text: max(text.count("\n"), 1))
+        self.instance.token_budget = 5
+
+        history = [self._event("msg %d" % i) for i in range(5)]
+        history.insert(3, self._event("elsewhere", channel = "#d"))
+
+        prompt = self.instance.generate_prompt("#c", "sms900", history)
+
+        # 2 for the instructions, 1 for the last line
+        lines = prompt.splitlines()
+        self.assertIn("nickname is sms900", lines[0])
+        self.assertTrue(lines[2].endswith("<kalle> msg 3"))
+        self.assertTrue(lines[3].endswith("<kalle> msg 4"))
+        self.assertTrue(lines[4].endswith("<sms900> "))
+        self.assertEqual(5, len(lines))
+
+        self.assertEqual(
+            {"tokens": 5, "events": 2, "candidates": 5, "budget": 5},
+            self.instance.last_prompt_stats
+        )
+
+    def test_generate_prompt_all(self):
+        history = [self._event("msg %d" % i) for i in range(3)]
+        prompt = self.instance.generate_prompt("#c", "sms900", history)
+
+        self.assertTrue(prompt.startswith("You're on an IRC channel called #c"))
+        self.assertIn(
+            "\n\n[2023-01-02 03:04:05 %s] <kalle> msg 0\n" % history[0]["timestamp"].strftime("%Z"),
+            prompt
+        )
+        self.assertEqual(3, self.instance.last_prompt_stats["events"])
+
+class FakeClock():
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+class TestResponseCache(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.instance = openai.ResponseCache(2, 10, clock=self.clock)
+
+    def test_lru(self):
+        self.instance.put("a", "1")
+        self.instance.put("b", "2")
+        self.assertEqual("1", self.instance.get("a"))
+
+        self.instance.put("c", "3")
+        self.assertEqual(None, self.instance.get("b"))
+        self.assertEqual("1", self.instance.get("a"))
+        self.assertEqual("3", self.instance.get("c"))
+
+        self.assertEqual({"entries": 2, "hits": 3, "misses": 1}, self.instance.stats())
+        self.assertEqual(2, self.instance.flush())
+        self.assertEqual(None, self.instance.get("a"))
+
+    def test_ttl(self):
+        self.instance.put("a", "1")
+        self.clock.now = 9
+        self.assertEqual("1", self.instance.get("a"))
+        self.clock.now = 10
+        self.assertEqual(None, self.instance.get("a"))
+        self.assertEqual(0, self.instance.stats()["entries"])
+
+class TestOpenAiCache(unittest.TestCase):
+    def setUp(self):
+        self.instance = openai.OpenAI({
+            "openai_api_key": 123,
+            "openai_engine": 123,
+            "openai_use_chat": True,
+            "openai_chat_model": "model",
+            "openai_cache_size": 10,
+            "openai_cache_context": 2,
+        })
+
+        self.completions = []
+        def complete(prompt):
+            self.completions.append(prompt)
+            return "answer %d" % len(self.completions)
+
+        self.instance.complete_prompt_chat = complete
+
+    def _history(self, *msgs):
+        return [{
+            "type": "irc",
+            "timestamp": datetime.now().astimezone(),
+            "nickname": "kalle",
+            "channel": "#c",
+            "msg": msg,
+        } for msg in msgs]
+
+    def test_cache(self):
+        self.assertEqual("answer 1", self.instance.generate_response(
+            "#c", "sms900", self._history("old", "hi", "sms900: what is 1+1?")
+        ))
+        # Only the last two events matter, and case/whitespace is ignored
+        self.assertEqual("answer 1", self.instance.generate_response(
+            "#c", "sms900", self._history("hi", "SMS900:  what is 1+1? ")
+        ))
+        self.assertEqual("answer 2", self.instance.generate_response(
+            "#c", "sms900", self._history("hi", "sms900: what is 1+2?")
+        ))
+
+        self.instance.set_prompt("Be nice")
+        self.assertEqual("answer 3", self.instance.generate_response(
+            "#c", "sms900", self._history("hi", "sms900: what is 1+1?")
+        ))
+
+        lines = []
+        self.assertEqual("answer 3", self.instance.generate_response_stream(
+            "#c", "sms900", self._history("hi", "sms900: what is 1+1?"), lines.append
+        ))
+        self.assertEqual(["answer 3"], lines)
+
+        self.assertEqual({"entries": 3, "hits": 2, "misses": 3}, self.instance.cache.stats())
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,99 @@
+import unittest
+import os
+import sys
+
+sys.path.insert(0, os.getcwd() + '/..')
+
+import db
+import phonebook
+
+class TestPhoneBook(unittest.TestCase):
+    def setUp(self):
+        self.db = db.Database(':memory:')
+        self.db.migrate()
+
+        self.instance = phonebook.PhoneBook(self.db)
+        self.instance.add_number('alice', '+46700000001')
+        self.instance.add_number('Bob', '+46700000002')
+
+    def test_lookups(self):
+        self.instance.add_email('Bob', 'Bob@example.com')
+
+        self.assertEqual('+46700000002', self.instance.get_number('BOB'))
+        self.assertEqual('bob', self.instance.get_nickname('+46700000002'))
+        self.assertEqual('bob', self.instance.get_nickname_from_email('bob@EXAMPLE.com'))
+
+        # A fresh instance loads the same entries from the database
+        reloaded = phonebook.PhoneBook(self.db)
+        self.assertEqual('alice', reloaded.get_nickname('+46700000001'))
+        self.assertEqual('bob', reloaded.get_nickname_from_email('bob@example.com'))
+
+        self.instance.del_entry('bob')
+        self.instance.del_email('BOB@example.com')
+        self.assertRaises(phonebook.SMS900InvalidAddressbookEntry,
+                          self.instance.get_number, 'bob')
+        self.assertRaises(phonebook.SMS900InvalidAddressbookEntry,
+                          self.instance.get_nickname, '+46700000002')
+        self.assertRaises(phonebook.SMS900InvalidAddressbookEntry,
+                          self.instance.get_nickname_from_email, 'bob@example.com')
+
+        # A failed insert leaves the cache alone
+        self.assertRaises(phonebook.SMS900InvalidAddressbookEntry,
+                          self.instance.add_number, 'carol', '+46700000001')
+        self.assertEqual('alice', self.instance.get_nickname('+46700000001'))
+        self.assertRaises(phonebook.SMS900InvalidAddressbookEntry,
+                          self.instance.get_number, 'carol')
+
+    def test_import(self):
+        self.instance.add_email('bob', 'bob@example.com')
+
+        report = self.instance.import_entries([
+            {'nickname': 'carol', 'number': '+46700000003', 'emails': ['carol@example.com']},
+            {'nickname': 'alice', 'number': '+46700000001', 'emails': []},
+            {'nickname': 'dave', 'number': '+46700000003', 'emails': []},
+            {'nickname': 'erin', 'number': None, 'emails': ['BOB@example.com']},
+            {'nickname': '1nvalid', 'number': '+46700000009', 'emails': []},
+        ])
+
+        self.assertEqual(1, report['added'])
+        self.assertEqual(1, report['unchanged'])
+        self.assertEqual(['dave', 'erin', '1nvalid'],
+                         [c['nickname'] for c in report['conflicts']])
+
+        self.assertEqual('carol', self.instance.get_nickname('+46700000003'))
+        self.assertEqual([
+            ('alice', '+46700000001', []),
+            ('bob', '+46700000002', ['bob@example.com']),
+            ('carol', '+46700000003', ['carol@example.com']),
+        ], self.instance.get_entries())
+        self.assertEqual(self.instance.get_entries(),
+                         phonebook.PhoneBook(self.db).get_entries())
+
+    def test_groups(self):
+        self.instance.add_to_group('team', ['alice', 'bob'])
+        self.instance.add_to_group('Team', ['alice'])
+
+        self.assertEqual({'team': ['alice', 'bob']}, self.instance.get_groups())
+        self.assertEqual(
+            [('alice', '+46700000001'), ('bob', '+46700000002')],
+            self.instance.get_group_numbers('TEAM')
+        )
+
+        self.instance.del_entry('bob')
+        self.assertEqual(
+            [('alice', '+46700000001'), ('bob', None)],
+            self.instance.get_group_numbers('team')
+        )
+
+        self.assertEqual(1, self.instance.del_from_group('team', ['bob']))
+        self.assertEqual(1, self.instance.del_from_group('team'))
+        self.assertRaises(phonebook.SMS900InvalidAddressbookEntry,
+                          self.instance.get_group_numbers, 'team')
+
+    def test_group_unknown_member(self):
+        self.assertRaises(phonebook.SMS900InvalidAddressbookEntry,
+                          self.instance.add_to_group, 'team', ['carol'])
+        self.assertEqual({}, self.instance.get_groups())
+
+if __name__ == '__main__':
+    unittest.main()
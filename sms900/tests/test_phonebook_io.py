@@ -0,0 +1,56 @@
+import unittest
+import os
+import sys
+
+sys.path.insert(0, os.getcwd() + '/..')
+
+import phonebook_io
+
+VCARDS = (
+    "BEGIN:VCARD\r\n"
+    "VERSION:3.0\r\n"
+    "FN:Alice Smith\r\n"
+    "TEL;TYPE=HOME:+46 8 123 456\r\n"
+    "TEL;TYPE=CELL:070-000 00 01\r\n"
+    "EMAIL:alice@exa\r\n"
+    " mple.com\r\n"
+    "END:VCARD\r\n"
+    "BEGIN:VCARD\r\n"
+    "VERSION:4.0\r\n"
+    "FN:Bob\r\n"
+    "NICKNAME:bobby,bob\r\n"
+    "item1.TEL;VALUE=uri;PREF=1:tel:+46700000002\r\n"
+    "END:VCARD\r\n"
+)
+
+class TestPhoneBookIO(unittest.TestCase):
+    def test_vcards(self):
+        self.assertEqual([
+            {'nickname': 'Alice', 'number': '0700000001', 'emails': ['alice@example.com']},
+            {'nickname': 'bobby', 'number': '+46700000002', 'emails': []},
+        ], phonebook_io.parse_contacts(VCARDS))
+
+    def test_csv(self):
+        data = "Nickname,Number,Email\nalice,+46 70 000 00 01,a@example.com;b@example.com\nbob,,\n"
+        self.assertEqual([
+            {'nickname': 'alice', 'number': '+46700000001',
+             'emails': ['a@example.com', 'b@example.com']},
+            {'nickname': 'bob', 'number': None, 'emails': []},
+        ], phonebook_io.parse_contacts(data))
+
+        self.assertRaises(phonebook_io.SMS900InvalidImport,
+                          phonebook_io.parse_contacts, "name,phone\nalice,123\n")
+
+    def test_roundtrip(self):
+        entries = [('alice', '+46700000001', ['a@example.com']), ('bob', None, ['b@example.com'])]
+        expected = [
+            {'nickname': 'alice', 'number': '+46700000001', 'emails': ['a@example.com']},
+            {'nickname': 'bob', 'number': None, 'emails': ['b@example.com']},
+        ]
+
+        for format in phonebook_io.FORMATS:
+            data = ''.join(phonebook_io.export_contacts(entries, format))
+            self.assertEqual(expected, phonebook_io.parse_contacts(data))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+import unittest
+import os
+import sys
+
+sys.path.insert(0, os.getcwd() + '/..')
+
+import ratelimit
+
+class FakeClock():
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+class TestTokenBucket(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.instance = ratelimit.TokenBucket(2, 4, clock=self.clock)
+
+    def test_burst(self):
+        for i in range(4):
+            self.assertTrue(self.instance.try_acquire())
+
+        self.assertFalse(self.instance.try_acquire())
+        self.assertEqual(0.5, self.instance.delay())
+
+    def test_refill(self):
+        self.assertTrue(self.instance.try_acquire(4))
+        self.clock.now += 1
+        self.assertTrue(self.instance.try_acquire(2))
+        self.assertFalse(self.instance.try_acquire())
+
+        # Never refills above the burst size
+        self.clock.now += 100
+        self.assertTrue(self.instance.try_acquire(4))
+        self.assertFalse(self.instance.try_acquire())
+
+    def test_larger_than_burst(self):
+        self.assertTrue(self.instance.try_acquire(10))
+        self.assertEqual(3.5, self.instance.delay(1))
+        self.assertEqual(5, self.instance.delay(10))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+import unittest
+import os
+import sys
+from datetime import datetime
+
+sys.path.insert(0, os.getcwd() + '/..')
+
+import recurrence
+
+def ts(*args):
+    return datetime(*args).timestamp()
+
+class TestRecurrence(unittest.TestCase):
+    def test_duration(self):
+        self.assertEqual(600, recurrence.parse_duration('10m'))
+        self.assertEqual(7200, recurrence.parse_duration('2 hours'))
+        self.assertEqual(86400, recurrence.parse_duration('day'))
+        self.assertRaises(recurrence.SMS900InvalidRecurrence,
+                          recurrence.parse_duration, '10 parsecs')
+
+    def test_interval(self):
+        r = recurrence.parse_recurrence('every 30 minutes')
+        start = ts(2024, 1, 1, 12, 0)
+        self.assertEqual(start + 1800, r.next_after(start))
+        # Occurrences missed while down are skipped
+        self.assertEqual(start + 3 * 1800, r.next_after(start, start + 2 * 1800))
+
+    def test_weekday(self):
+        r = recurrence.parse_recurrence('Every weekday at 9:00')
+        # 2024-01-05 is a friday
+        self.assertEqual(ts(2024, 1, 5, 9, 0), r.next_after(ts(2024, 1, 5, 8, 0)))
+        self.assertEqual(ts(2024, 1, 8, 9, 0), r.next_after(ts(2024, 1, 5, 9, 0)))
+
+        r = recurrence.parse_recurrence('every tue,thu 5pm')
+        self.assertEqual(ts(2024, 1, 9, 17, 0), r.next_after(ts(2024, 1, 5, 9, 0)))
+
+    def test_cron(self):
+        r = recurrence.parse_recurrence('*/15 9-17 * * 1-5')
+        self.assertEqual(ts(2024, 1, 5, 9, 15), r.next_after(ts(2024, 1, 5, 9, 0)))
+        self.assertEqual(ts(2024, 1, 8, 9, 0), r.next_after(ts(2024, 1, 5, 17, 45)))
+
+        r = recurrence.parse_recurrence('0 12 29 2 *')
+        self.assertEqual(ts(2028, 2, 29, 12, 0), r.next_after(ts(2024, 3, 1)))
+
+    def test_invalid(self):
+        for spec in ['every', 'every blursday 9:00', 'every day 25:00', '61 * * * *', 'tomorrow']:
+            self.assertRaises(recurrence.SMS900InvalidRecurrence,
+                              recurrence.parse_recurrence, spec)
+
+if __name__ == '__main__':
+    unittest.main()
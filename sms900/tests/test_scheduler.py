@@ -0,0 +1,60 @@
+import unittest
+import os
+import queue
+import sys
+import time
+
+sys.path.insert(0, os.getcwd() + '/..')
+
+import scheduler
+
+class TestTimerScheduler(unittest.TestCase):
+    def setUp(self):
+        self.fired = queue.Queue()
+        self.instance = scheduler.TimerScheduler(
+            lambda uuid, payload: self.fired.put((uuid, payload))
+        )
+        self.instance.start()
+
+    def test_order(self):
+        now = time.time()
+        self.instance.schedule('b', now + 0.2, 'second')
+        self.instance.schedule('a', now + 0.1, 'first')
+        self.instance.schedule('c', now - 1, 'overdue')
+
+        self.assertEqual(('c', 'overdue'), self.fired.get(timeout=5))
+        self.assertEqual(('a', 'first'), self.fired.get(timeout=5))
+        self.assertEqual(('b', 'second'), self.fired.get(timeout=5))
+        self.assertRaises(queue.Empty, self.fired.get, timeout=0.2)
+
+    def test_cancel_and_reschedule(self):
+        now = time.time()
+        self.instance.schedule('a', now + 0.1, 'cancelled')
+        self.instance.schedule('b', now + 0.1, 'moved')
+        self.instance.schedule('b', now + 0.2, 'moved later')
+        self.instance.schedule('c', now + 0.15, 'kept')
+
+        self.assertTrue(self.instance.cancel('a'))
+        self.assertFalse(self.instance.cancel('a'))
+
+        self.assertEqual(('c', 'kept'), self.fired.get(timeout=5))
+        self.assertEqual(('b', 'moved later'), self.fired.get(timeout=5))
+        self.assertTrue(time.time() >= now + 0.2)
+        self.assertRaises(queue.Empty, self.fired.get, timeout=0.2)
+
+    def test_compact(self):
+        at = time.time() + 0.5
+        for i in range(1000):
+            self.instance.schedule(str(i), at, None)
+        for i in range(990):
+            self.instance.cancel(str(i))
+
+        self.assertTrue(len(self.instance.heap) < 100)
+        self.assertEqual(
+            {str(i) for i in range(990, 1000)},
+            {self.fired.get(timeout=5)[0] for _ in range(10)}
+        )
+        self.assertRaises(queue.Empty, self.fired.get, timeout=0.2)
+
+if __name__ == '__main__':
+    unittest.main()
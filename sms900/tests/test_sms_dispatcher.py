@@ -0,0 +1,126 @@
+import unittest
+import os
+import queue
+import sys
+import tempfile
+
+sys.path.insert(0, os.getcwd() + '/..')
+
+from twilio.base.exceptions import TwilioRestException
+
+import db
+import metrics
+import ratelimit
+import sms_dispatcher
+
+class FakeMessage():
+    num_segments = 1
+
+class FakeMessages():
+    def __init__(self, failures):
+        self.failures = list(failures)
+        self.sent = []
+
+    def create(self, to, from_, body):
+        if self.failures:
+            raise TwilioRestException(self.failures.pop(0), 'uri', 'failure')
+
+        self.sent.append((to, body))
+        return FakeMessage()
+
+class FakeTwilio():
+    def __init__(self, failures = []):
+        self.messages = FakeMessages(failures)
+
+class TestSMSDispatcher(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db = db.Database(os.path.join(self.tmpdir.name, 'test.db'))
+        self.db.migrate()
+        self.notifications = queue.Queue()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _create(self, twilio, start = True, latency = None):
+        dispatcher = sms_dispatcher.SMSDispatcher(
+            twilio,
+            '+461234567',
+            self.db,
+            self.notifications.put,
+            ratelimit.TokenBucket(1000, 1000),
+            workers=2,
+            max_attempts=3,
+            backoff=0.01,
+            latency=latency
+        )
+
+        if start:
+            dispatcher.start()
+
+        return dispatcher
+
+    def test_send(self):
+        twilio = FakeTwilio()
+        dispatcher = self._create(twilio)
+        dispatcher.send('+46700000000', 'hello')
+
+        self.assertEqual('Sent 1 sms to number +46700000000',
+                         self.notifications.get(timeout=5))
+        self.assertEqual([('+46700000000', 'hello')], twilio.messages.sent)
+        self.assertEqual(0, dispatcher.pending_count())
+
+    def test_retry(self):
+        twilio = FakeTwilio([429, 503])
+        self._create(twilio).send('+46700000000', 'hello')
+
+        self.assertEqual('Sent 1 sms to number +46700000000',
+                         self.notifications.get(timeout=5))
+
+    def test_latency(self):
+        latency = metrics.Histogram('seconds', 'Latency', ('status',))
+        twilio = FakeTwilio([503])
+        self._create(twilio, latency=latency).send('+46700000000', 'hello')
+        self.notifications.get(timeout=5)
+
+        self.assertEqual([('503',), ('ok',)], latency.labels())
+        self.assertEqual(1, latency.get(('ok',))[2])
+
+    def test_no_retry_on_client_error(self):
+        twilio = FakeTwilio([400, 400])
+        self._create(twilio).send('+46700000000', 'hello')
+
+        self.assertTrue(self.notifications.get(timeout=5).startswith('Failed'))
+        self.assertEqual([400], twilio.messages.failures)
+
+    def test_give_up(self):
+        twilio = FakeTwilio([500, 500, 500, 500])
+        self._create(twilio).send('+46700000000', 'hello')
+
+        self.assertTrue(self.notifications.get(timeout=5).startswith('Failed'))
+        self.assertEqual([500], twilio.messages.failures)
+
+    def test_send_batch(self):
+        twilio = FakeTwilio([400])
+        self._create(twilio).send_batch(
+            'team',
+            [('alice', '+46700000001'), ('bob', '+46700000002')],
+            'hello'
+        )
+
+        summary = self.notifications.get(timeout=5)
+        self.assertTrue(
+            summary.startswith('Sent sms to team: 1/2 delivered (1 segments), failed: ')
+        )
+        self.assertTrue(self.notifications.empty())
+
+    def test_resume_pending(self):
+        self._create(FakeTwilio(), start = False).send('+46700000000', 'hello')
+
+        twilio = FakeTwilio()
+        self._create(twilio)
+        self.assertEqual('Sent 1 sms to number +46700000000',
+                         self.notifications.get(timeout=5))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+import unittest
+import os
+import sys
+
+sys.path.insert(0, os.getcwd() + '/..')
+
+import db
+import recurrence
+import timers
+
+class FakeScheduler():
+    """ Keeps what's scheduled, without ever firing it """
+    def __init__(self):
+        self.timers = {}
+
+    def schedule(self, uuid, at, payload):
+        self.timers[uuid] = (at, payload)
+
+    def cancel(self, uuid):
+        return self.timers.pop(uuid, None) is not None
+
+    def trigger(self, uuid):
+        """ Like TimerScheduler when a timer is due """
+        (_at, payload) = self.timers.pop(uuid)
+        return payload
+
+class TestTimers(unittest.TestCase):
+    def setUp(self):
+        self.db = db.Database(':memory:')
+        self.db.migrate()
+        self.scheduler = FakeScheduler()
+        self.now = 1700000000.0
+
+    def _create(self, window=100):
+        instance = timers.Timers(self.db, self.scheduler, recurrence,
+                                 window=window, clock=lambda: self.now)
+        instance.load()
+        return instance
+
+    def _stored(self, instance):
+        (_total, rows) = instance.list()
+        return {row[0]: row[1] for row in rows}
+
+    def test_refill(self):
+        instance = self._create()
+        self.assertEqual(self.now + 50, self.scheduler.timers[timers.Timers.REFILL][0])
+
+        soon = instance.add(self.now + 30, 'soon')
+        later = instance.add(self.now + 150, 'later')
+        self.assertIn(soon, self.scheduler.timers)
+        self.assertNotIn(later, self.scheduler.timers)
+
+        self.now += 50
+        instance.refill()
+        self.assertEqual(self.now + 100, self.scheduler.timers[later][0])
+        self.assertEqual(self.now + 50, self.scheduler.timers[timers.Timers.REFILL][0])
+
+    def test_too_soon(self):
+        instance = self._create()
+        with self.assertRaises(timers.SMS900InvalidTimerException):
+            instance.add(self.now + 5, 'now')
+
+    def test_snooze_out_of_window(self):
+        instance = self._create()
+        _uuid = instance.add(self.now + 30, 'soon')
+
+        self.assertEqual(_uuid, instance.snooze(_uuid, self.now + 500))
+        self.assertNotIn(_uuid, self.scheduler.timers)
+        self.assertEqual({_uuid: self.now + 500}, self._stored(instance))
+
+        self.now += 450
+        instance.refill()
+        self.assertEqual(self.now + 50, self.scheduler.timers[_uuid][0])
+
+    def test_recurrence(self):
+        instance = self._create(window=7200)
+        _uuid = instance.add(self.now + 60, 'stretch', 'alice', 'every 1h')
+
+        payload = self.scheduler.trigger(_uuid)
+        self.now += 60
+        self.assertTrue(instance.done(_uuid, payload['timestamp'], payload['recurrence']))
+
+        self.assertEqual({_uuid: self.now + 3600}, self._stored(instance))
+        self.assertEqual(self.now + 3600, self.scheduler.timers[_uuid][0])
+
+        # Missed while we were down
+        self.now += 3 * 3600
+        instance = self._create(window=7200)
+        self.assertEqual({_uuid: self.now + 3600}, self._stored(instance))
+
+    def test_done(self):
+        instance = self._create()
+        kept = instance.add(self.now + 30, 'one-off')
+        cleared = instance.add(self.now + 30, 'cleared')
+        snoozed = instance.add(self.now + 30, 'snoozed')
+
+        payloads = {_uuid: self.scheduler.trigger(_uuid) for _uuid in [kept, cleared, snoozed]}
+        self.now += 30
+
+        # Between triggering and the main loop getting to the reminder
+        self.assertEqual(1, instance.clear(cleared))
+        instance.snooze(snoozed, self.now + 60)
+
+        for (_uuid, expected) in [(kept, True), (cleared, False), (snoozed, False)]:
+            self.assertEqual(expected, instance.done(_uuid, payloads[_uuid]['timestamp'], None))
+
+        self.assertEqual({snoozed: self.now + 60}, self._stored(instance))
+
+if __name__ == '__main__':
+    unittest.main()
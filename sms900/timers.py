@@ -0,0 +1,192 @@
+""" Reminders, stored in the database and fired by a TimerScheduler """
+from datetime import datetime
+import logging
+import time
+import uuid
+
+
+class SMS900InvalidTimerException(Exception):
+    pass
+
+
+class Timers():
+    """ Only the timers due within the next `window` seconds are kept in
+    the scheduler; the REFILL timer loads the next ones every half window.
+    `recurrence` is the recurrence module (parse_recurrence and
+    SMS900InvalidRecurrence). """
+
+    # Scheduler uuid of the timer that loads the next window of timers
+    REFILL = 'refill'
+
+    def __init__(self, db, scheduler, recurrence, window=3600, clock=time.time):
+        self.db = db
+        self.scheduler = scheduler
+        self.recurrence = recurrence
+        self.window = window
+        self.clock = clock
+
+        # Everything due up to here is in the scheduler
+        self.horizon = 0
+
+    def load(self):
+        """ Catches up on recurring timers that came due while we were down,
+        drops the other missed ones and schedules the next window """
+        now = self.clock()
+
+        with self.db.transaction() as conn:
+            rows = conn.execute(
+                "select uuid, timestamp, recurrence from timers"
+                " where timestamp <= ? and recurrence is not null",
+                (now - 60,)
+            ).fetchall()
+            for (_uuid, timestamp, spec) in rows:
+                try:
+                    at = self.recurrence.parse_recurrence(spec).next_after(timestamp, now)
+                    conn.execute("update timers set timestamp = ? where uuid = ?",
+                                 (at, _uuid))
+                except self.recurrence.SMS900InvalidRecurrence as err:
+                    logging.info("Dropping timer %s: %s", _uuid, err)
+                    conn.execute("delete from timers where uuid = ?", (_uuid,))
+
+            conn.execute("delete from timers where timestamp <= ?", (now - 60,))
+
+        self.refill()
+
+    def refill(self):
+        """ Schedules the timers due within the next window """
+        now = self.clock()
+        horizon = now + self.window
+
+        # Everything up to the previous horizon is already scheduled
+        rows = self.db.execute(
+            "select uuid, timestamp, msg, owner, recurrence from timers"
+            " where timestamp > ? and timestamp <= ? order by timestamp",
+            (self.horizon, horizon)
+        ).fetchall()
+
+        self.horizon = horizon
+
+        for (_uuid, timestamp, msg, owner, recurrence) in rows:
+            self._schedule(_uuid, timestamp, msg, owner, recurrence)
+
+        self.scheduler.schedule(self.REFILL, now + self.window / 2, {'refill': True})
+
+        logging.info("Loaded %d timers due before %s", len(rows),
+                     datetime.fromtimestamp(horizon).isoformat(' '))
+
+    def add(self, at, msg, owner=None, recurrence=None):
+        in_seconds = at - self.clock()
+        if in_seconds <= 10:
+            raise SMS900InvalidTimerException(
+                f"Timer would trigger in {in_seconds:.0f}s; rejecting"
+            )
+
+        _uuid = str(uuid.uuid4())
+
+        self.db.execute(
+            "insert into timers(uuid, timestamp, msg, owner, recurrence)"
+            " values (?, ?, ?, ?, ?)",
+            (_uuid, at, msg, owner, recurrence)
+        )
+        self._schedule(_uuid, at, msg, owner, recurrence)
+
+        logging.info(f"Timer {_uuid} scheduled in {in_seconds} seconds")
+
+        return _uuid
+
+    def done(self, _uuid, at, recurrence):
+        """ Moves a recurring timer that triggered at `at` to its next time,
+        drops others. Returns False if the timer was cleared or moved after
+        it triggered, in which case it shouldn't fire. """
+        row = self.db.execute(
+            "select msg, owner from timers where uuid = ? and timestamp = ?",
+            (_uuid, at)
+        ).fetchone()
+        if not row:
+            return False
+
+        if recurrence:
+            try:
+                next_at = self.recurrence.parse_recurrence(recurrence).next_after(
+                    at, self.clock()
+                )
+
+                self.db.execute("update timers set timestamp = ? where uuid = ?",
+                                (next_at, _uuid))
+                self._schedule(_uuid, next_at, row[0], row[1], recurrence)
+
+                return True
+            except self.recurrence.SMS900InvalidRecurrence as err:
+                logging.info("Dropping timer %s: %s", _uuid, err)
+
+        self.db.execute("delete from timers where uuid = ?", (_uuid,))
+        return True
+
+    def snooze(self, _uuid, at):
+        """ Postpones a pending one-off timer. Snoozing a recurring timer
+        adds a one-off copy instead. Returns the uuid of the snoozed timer. """
+        row = self.db.execute(
+            "select msg, owner, recurrence from timers where uuid = ?",
+            (_uuid,)
+        ).fetchone()
+        if not row:
+            raise SMS900InvalidTimerException("No such timer: %s" % _uuid)
+
+        (msg, owner, recurrence) = row
+        if recurrence:
+            return self.add(at, msg, owner)
+
+        self.db.execute("update timers set timestamp = ? where uuid = ?", (at, _uuid))
+        self._schedule(_uuid, at, msg, owner, recurrence)
+
+        return _uuid
+
+    def list(self, owner=None, limit=20):
+        """ Returns (total, [(uuid, timestamp, msg, owner, recurrence), ...]),
+        the next `limit` timers first """
+        where = "where owner = ?" if owner else ""
+        args = (owner,) if owner else ()
+
+        total = self.db.execute(
+            "select count(*) from timers %s" % where, args
+        ).fetchone()[0]
+
+        rows = self.db.execute(
+            "select uuid, timestamp, msg, owner, recurrence from timers %s"
+            " order by timestamp limit ?" % where,
+            args + (limit,)
+        ).fetchall()
+
+        return (total, rows)
+
+    def clear(self, _uuid):
+        """ Deletes one timer, or 'all'. Returns how many were deleted. """
+        if _uuid == 'all':
+            uuids = [row[0] for row in self.db.execute("select uuid from timers")]
+        else:
+            uuids = [row[0] for row in self.db.execute(
+                "select uuid from timers where uuid = ?", (_uuid,)
+            )]
+
+        with self.db.transaction() as conn:
+            for timer_uuid in uuids:
+                conn.execute("delete from timers where uuid = ?", (timer_uuid,))
+
+        for timer_uuid in uuids:
+            self.scheduler.cancel(timer_uuid)
+
+        return len(uuids)
+
+    def _schedule(self, _uuid, at, msg, owner, recurrence):
+        """ Timers up to the horizon live in the scheduler, later ones only
+        in the database until refill() gets to them """
+        if at > self.horizon:
+            self.scheduler.cancel(_uuid)
+            return
+
+        self.scheduler.schedule(_uuid, at, {
+            'timestamp': at,
+            'msg': msg,
+            'owner': owner,
+            'recurrence': recurrence,
+        })
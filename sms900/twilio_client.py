@@ -0,0 +1,34 @@
+""" A long-lived, pooled Twilio REST client """
+from requests.adapters import HTTPAdapter
+from twilio.http.http_client import TwilioHttpClient
+from twilio.rest import Client
+
+
+class PooledTwilioHttpClient(TwilioHttpClient):
+    """ TwilioHttpClient that keeps its connections alive in a pool of
+    the given size, so that consecutive requests (from any thread) can
+    skip the TCP and TLS handshakes. """
+
+    def __init__(self, pool_size=4, timeout=None, max_retries=0):
+        super().__init__(pool_connections=True, timeout=timeout)
+
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=pool_size,
+            max_retries=max_retries
+        )
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+
+def create_twilio_client(config, http_client_class=PooledTwilioHttpClient):
+    http_client = http_client_class(
+        pool_size=config['twilio_pool_size']
+        if 'twilio_pool_size' in config else 4,
+        timeout=config['twilio_timeout']
+        if 'twilio_timeout' in config else 30
+    )
+
+    return Client(config['twilio_account_sid'],
+                  config['twilio_auth_token'],
+                  http_client=http_client)